@@ -5,6 +5,7 @@ import os
 
 import xraylib
 from PyQt5 import QtWidgets
+from PyQt5.QtCore import QTimer
 from oasys.menus.menu import OMenu
 from orangecanvas.scheme.link import SchemeLink
 
@@ -21,7 +22,12 @@ from orangecontrib.shadow.widgets.plots.ow_histogram import Histogram
 from orangecontrib.shadow.widgets.plots.ow_info import Info
 from orangecontrib.shadow.widgets.plots.ow_focnew import FocNew
 
-from orangecontrib.shadow.util.shadow_objects import ShadowFile
+from orangecontrib.shadow.util.shadow_objects import ShadowFile, ShadowBeam
+
+HISTORY_MODE_ACTIONS = ["Store full input beams in the O.E. history",
+                        "Store input beam references (rebuilt on demand) in the O.E. history"] # index = ShadowBeam history mode
+STORAGE_MODE_ACTIONS = ["Store accumulated rays in full precision (float64)",
+                        "Store accumulated rays in compact form (float32 electric vectors and phases)"] # index = ShadowBeam storage mode
 
 class ShadowToolsMenu(OMenu):
     is_weird_shadow_bug_fixed = False
@@ -52,8 +58,37 @@ class ShadowToolsMenu(OMenu):
         self.closeContainer()
         self.addSubMenu("Execute all the Preprocessor widgets")
         self.addSeparator()
+        self.openContainer()
+        self.addContainer("O.E. History")
+        for name in HISTORY_MODE_ACTIONS: self.addSubMenu(name)
+        self.closeContainer()
+        self.openContainer()
+        self.addContainer("Accumulated Rays")
+        for name in STORAGE_MODE_ACTIONS: self.addSubMenu(name)
+        self.closeContainer()
+        self.addSeparator()
         self.addSubMenu("Go to ShadowOui Tutorials Page")
 
+    def setCanvasMainWindow(self, canvas_main_window):
+        super().setCanvasMainWindow(canvas_main_window)
+
+        QTimer.singleShot(0, self.__set_mode_actions_checkable) # the actions are created by the main window after this call
+
+    # global modes: checkable and exclusive actions, showing the active one
+    def __set_mode_actions_checkable(self):
+        for names, active_mode in [(HISTORY_MODE_ACTIONS, ShadowBeam.history_mode),
+                                   (STORAGE_MODE_ACTIONS, ShadowBeam.storage_mode)]:
+            action_group = QtWidgets.QActionGroup(self.canvas_main_window)
+            action_group.setExclusive(True)
+
+            for mode, name in enumerate(names):
+                action = self.canvas_main_window.findChild(QtWidgets.QAction, name.lower() + "-action")
+
+                if not action is None:
+                    action.setCheckable(True)
+                    action.setChecked(mode == active_mode)
+                    action_group.addAction(action)
+
     def fixWeirdShadowBug(self):
         if not self.is_weird_shadow_bug_fixed:
             try:
@@ -233,7 +268,15 @@ class ShadowToolsMenu(OMenu):
                 QtWidgets.QMessageBox.Ok)
 
 
-    def executeAction_10(self, action):
+    def executeAction_10(self, action): ShadowBeam.set_history_mode(ShadowBeam.HISTORY_FULL_INPUT_BEAM)
+
+    def executeAction_11(self, action): ShadowBeam.set_history_mode(ShadowBeam.HISTORY_INPUT_BEAM_REFERENCE)
+
+    def executeAction_12(self, action): ShadowBeam.set_storage_mode(ShadowBeam.STORAGE_FULL)
+
+    def executeAction_13(self, action): ShadowBeam.set_storage_mode(ShadowBeam.STORAGE_COMPACT)
+
+    def executeAction_14(self, action):
         try:
             import webbrowser
             webbrowser.open("https://github.com/srio/ShadowOui-Tutorial")
@@ -83,6 +83,7 @@ def apply_fresnel_zone_plate(input_beam,
     print ("MZN", max_zones_number)
 
     focused_beam = input_beam.duplicate(history=False)
+    focused_beam.detach_rays()
    
     if type_of_zp == PHASE_ZP: 
         substrate_weight_factor = get_material_weight_factor(focused_beam, substrate_material, substrate_thickness) 
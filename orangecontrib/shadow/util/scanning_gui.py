@@ -65,7 +65,7 @@ from oasys.widgets import gui as oasysgui
 
 from oasys.util.oasys_util import get_sigma, get_average
 from oasys.util.scanning_gui import HistogramData
-from orangecontrib.shadow.util.shadow_util import ShadowPlot
+from orangecontrib.shadow.util.shadow_util import ShadowPlot, ShadowBeamAnalysis
 
 
 class AbstractScanHistoWidget(QWidget):
@@ -181,7 +181,7 @@ class Scan3DHistoWidget(AbstractScanHistoWidget):
         factor=ShadowPlot.get_factor(col, conv=self.workspace_units_to_cm)
 
         if histo_index==0 and xrange is None:
-            ticket = beam._beam.histo1(col, xrange=None, nbins=nbins, nolost=1, ref=ref)
+            ticket = ShadowBeamAnalysis.get_analysis(beam._beam).histo1(beam._beam, col, xrange=None, nbins=nbins, nolost=1, ref=ref)
 
             fwhm = ticket['fwhm']
             xrange = ticket['xrange']
@@ -189,7 +189,7 @@ class Scan3DHistoWidget(AbstractScanHistoWidget):
 
             if not fwhm is None: xrange = [centroid - 2*fwhm , centroid + 2*fwhm]
 
-        ticket = beam._beam.histo1(col, xrange=xrange, nbins=nbins, nolost=1, ref=ref)
+        ticket = ShadowBeamAnalysis.get_analysis(beam._beam).histo1(beam._beam, col, xrange=xrange, nbins=nbins, nolost=1, ref=ref)
 
         if not ytitle is None:  ytitle = ytitle + ' weighted by ' + ShadowPlot.get_shadow_label(ref)
 
@@ -373,7 +373,7 @@ class ScanHistoWidget(AbstractScanHistoWidget):
         factor=ShadowPlot.get_factor(col, conv=self.workspace_units_to_cm)
 
         if histo_index==0 and xrange is None:
-            ticket = beam._beam.histo1(col, xrange=None, nbins=nbins, nolost=1, ref=ref)
+            ticket = ShadowBeamAnalysis.get_analysis(beam._beam).histo1(beam._beam, col, xrange=None, nbins=nbins, nolost=1, ref=ref)
 
             fwhm = ticket['fwhm']
             xrange = ticket['xrange']
@@ -382,7 +382,7 @@ class ScanHistoWidget(AbstractScanHistoWidget):
             if not fwhm is None:
                 xrange = [centroid - 2*fwhm , centroid + 2*fwhm]
 
-        ticket = beam._beam.histo1(col, xrange=xrange, nbins=nbins, nolost=1, ref=ref)
+        ticket = ShadowBeamAnalysis.get_analysis(beam._beam).histo1(beam._beam, col, xrange=xrange, nbins=nbins, nolost=1, ref=ref)
 
         if not ytitle is None:  ytitle = ytitle + ' weighted by ' + ShadowPlot.get_shadow_label(ref)
 
@@ -1,7 +1,8 @@
 
-import os, copy, numpy, platform
+import os, copy, numpy, platform, hashlib, weakref, json, time
+import h5py
 import Shadow
-from .shadow_util import Properties
+from .shadow_util import Properties, ShadowBeamAnalysis
 
 class ShadowPreProcessorData:
 
@@ -72,23 +73,116 @@ class ShadowOEHistoryItem(object):
                  shadow_source_end=None,
                  shadow_oe_start=None,
                  shadow_oe_end=None,
-                 widget_class_name=None):
+                 widget_class_name=None,
+                 input_beam_reference=None):
         self._oe_number = oe_number
-        self._input_beam = input_beam
+        self.__input_beam = input_beam
+        self.__input_beam_reference = input_beam_reference
         self._shadow_source_start = shadow_source_start
         self._shadow_source_end = shadow_source_end
         self._shadow_oe_start = shadow_oe_start
         self._shadow_oe_end = shadow_oe_end
         self._widget_class_name = widget_class_name
 
+    # the input beam is rebuilt by ray-tracing only when someone asks for it
+    @property
+    def _input_beam(self):
+        if self.__input_beam is None and not self.__input_beam_reference is None:
+            self.__input_beam = self.__input_beam_reference.rebuild()
+
+        return self.__input_beam
+
+    @_input_beam.setter
+    def _input_beam(self, input_beam):
+        self.__input_beam = input_beam
+        self.__input_beam_reference = None
+
+    def has_input_beam_reference(self):
+        return not self.__input_beam_reference is None
+
     def duplicate(self):
         return ShadowOEHistoryItem(oe_number=self._oe_number,
-                                   input_beam=self._input_beam,
+                                   input_beam=self.__input_beam,
                                    shadow_source_start=self._shadow_source_start,
                                    shadow_source_end=self._shadow_source_end,
                                    shadow_oe_start=self._shadow_oe_start,
                                    shadow_oe_end=self._shadow_oe_end,
-                                   widget_class_name=self._widget_class_name)
+                                   widget_class_name=self._widget_class_name,
+                                   input_beam_reference=self.__input_beam_reference)
+
+####################################################################
+# LIGHTWEIGHT REPLACEMENT OF THE INPUT BEAM OF AN O.E. IN THE HISTORY:
+# source (with its seed) and upstream O.E.s are traced again on request,
+# the result is checked against the content hash of the original rays.
+# Only histories whose O.E.s do not draw random numbers are referenced
+# (otherwise the full input beam is stored). The rebuilt O.E.s write no
+# files, but the source trace re-seeds the Shadow random generator.
+####################################################################
+class ShadowInputBeamReference(object):
+    def __init__(self, input_beam, history=True):
+        self._oe_number             = input_beam._oe_number
+        self._history               = input_beam.history[:input_beam._oe_number + 1]
+        self._keep_history          = history
+        self._seed                  = self._history[0]._shadow_source_start.src.ISTAR1
+        self._scanned_variable_data = input_beam.scanned_variable_data
+        self._initial_flux          = input_beam.get_initial_flux()
+        self._content_hash          = ShadowInputBeamReference.get_content_hash(input_beam)
+
+    @classmethod
+    def is_referenceable(cls, input_beam):
+        return input_beam.is_rebuildable() and \
+               len(input_beam.history) > input_beam._oe_number and \
+               not input_beam.history[0]._shadow_source_start is None and \
+               input_beam.history[0]._shadow_source_start.src.ISTAR1 != 0 and \
+               all([cls.is_deterministic(history_item._shadow_oe_start) for history_item in input_beam.history[1:input_beam._oe_number + 1]])
+
+    # O.E. traced without random numbers: no mosaic crystal, no roughness, no random gaussian ripple
+    @classmethod
+    def is_deterministic(cls, shadow_oe):
+        if shadow_oe is None: return False
+
+        for oe in cls.__get_oes(shadow_oe):
+            if getattr(oe, "F_CRYSTAL", 0) == 1 and getattr(oe, "F_MOSAIC", 0) == 1: return False
+            if getattr(oe, "F_ROUGHNESS", 0) == 1: return False
+            if getattr(oe, "F_RIPPLE", 0) == 1 and getattr(oe, "F_G_S", 0) == 1 and getattr(oe, "F_R_RAN", 0) == 1: return False
+
+        return True
+
+    @classmethod
+    def __get_oes(cls, shadow_oe):
+        if isinstance(shadow_oe, ShadowCompoundOpticalElement): return [shadow_oe._oe.list[index] for index in range(shadow_oe._oe.number_oe())]
+        else:                                                   return [shadow_oe._oe]
+
+    @classmethod
+    def get_content_hash(cls, shadow_beam):
+        return hashlib.blake2b(numpy.ascontiguousarray(shadow_beam._beam.rays).data, digest_size=32).hexdigest()
+
+    def rebuild(self):
+        shadow_beam = ShadowBeam.traceFromSource(self._history[0]._shadow_source_start.duplicate(), history=False)
+
+        for history_item in self._history[1:]:
+            shadow_oe = history_item._shadow_oe_start.duplicate()
+
+            # no star/mirr/angle files: the rebuild may happen during another calculation, in the same directory
+            for oe in self.__get_oes(shadow_oe):
+                if hasattr(oe, "FWRITE"):  oe.FWRITE = 3
+                if hasattr(oe, "F_ANGLE"): oe.F_ANGLE = 0
+
+            if isinstance(shadow_oe, ShadowFreeSpaceElement):         shadow_beam = ShadowBeam.traceFreeSpace(shadow_beam, shadow_oe.distance, history=False) # numpy, as the original
+            elif isinstance(shadow_oe, ShadowCompoundOpticalElement): shadow_beam = ShadowBeam.traceFromCompoundOE(shadow_beam, shadow_oe, history=False)
+            elif isinstance(shadow_oe._oe, Shadow.IdealLensOE):        shadow_beam = ShadowBeam.traceIdealLensOE(shadow_beam, shadow_oe, history=False)
+            else:                                                      shadow_beam = ShadowBeam.traceFromOE(shadow_beam, shadow_oe, history=False)
+
+        if ShadowInputBeamReference.get_content_hash(shadow_beam) != self._content_hash:
+            raise Exception("Input beam of O.E. " + str(self._oe_number + 1) + " cannot be rebuilt from the history (source seed: " + str(self._seed) + "), " +
+                            "the beam has been modified outside the ray-tracing: use the full history mode")
+
+        shadow_beam._oe_number = self._oe_number
+        shadow_beam.setScanningData(self._scanned_variable_data)
+        shadow_beam.set_initial_flux(self._initial_flux)
+        if self._keep_history: shadow_beam.history = list(self._history)
+
+        return shadow_beam
 
 class ShadowFile:
 
@@ -110,8 +204,126 @@ class ShadowFile:
 
         return file, type
 
+####################################################################
+# COLUMNAR BEAM FILE (HDF5): the rays are stored column by column in
+# one contiguous dataset (18 x N), so each column is a contiguous
+# block on disk. Single columns are read without reading the others,
+# and the whole dataset can be memory-mapped: nothing is read until
+# the rays are used. Flux, O.E. number and scanning data are stored
+# as attributes.
+####################################################################
+
+class ShadowBeamFile(object):
+    EXTENSIONS = (".h5", ".hdf5", ".hdf")
+    RAYS = "rays"
+
+    @classmethod
+    def is_columnar_file(cls, file_name):
+        return os.path.splitext(file_name)[1].lower() in cls.EXTENSIONS
+
+    @classmethod
+    def write(cls, file_name, shadow_beam):
+        rays = shadow_beam._beam.rays
+
+        with h5py.File(file_name, "w") as file:
+            file.attrs["creator"]      = "ShadowOui"
+            file.attrs["file_time"]    = time.time()
+            file.attrs["h5py_version"] = h5py.version.version
+
+            # contiguous layout (no chunks, no compression): needed for the memory mapping
+            dataset = file.create_dataset(cls.RAYS, shape=(rays.shape[1], rays.shape[0]), dtype=rays.dtype)
+            for column in range(rays.shape[1]): dataset[column] = rays[:, column]
+
+            for name, value in cls.__get_metadata(shadow_beam).items(): dataset.attrs[name] = value
+
+    @classmethod
+    def read(cls, file_name, shadow_beam, memory_map=True):
+        """
+        :param shadow_beam: the ShadowBeam receiving rays, initial flux and scanning data
+        :param memory_map: if True the rays are a copy-on-write memory-mapped view of the file (N x 18: the pages
+                           are read when used, the modified ones are private, the file is never written),
+                           otherwise they are read in memory
+        """
+        with h5py.File(file_name, "r") as file:
+            dataset = file[cls.RAYS]
+
+            metadata = dict(dataset.attrs)
+            offset = dataset.id.get_offset() if memory_map and dataset.chunks is None and dataset.compression is None else None
+
+            if offset is None: columns = dataset[()]
+            else:              columns = numpy.asarray(numpy.memmap(file_name, dtype=dataset.dtype, mode="c", offset=offset, shape=dataset.shape))
+
+        rays = columns.T
+
+        shadow_beam.setBeam(Shadow.Beam())
+        shadow_beam._beam.rays = rays
+        shadow_beam.set_initial_flux(metadata.get("initial_flux", None))
+        shadow_beam.setScanningData(cls.__get_scanning_data(metadata))
+
+    @classmethod
+    def read_columns(cls, file_name, columns):
+        """
+        :param columns: Shadow columns (1 to 18) to be read, e.g. [1, 3, 10]
+        :return: a dictionary column -> array (the other columns are not read)
+        """
+        with h5py.File(file_name, "r") as file:
+            dataset = file[cls.RAYS]
+
+            return {column : dataset[column - 1] for column in columns}
+
+    @classmethod
+    def read_metadata(cls, file_name):
+        with h5py.File(file_name, "r") as file:
+            metadata = dict(file[cls.RAYS].attrs)
+            metadata["number_of_rays"] = file[cls.RAYS].shape[1]
+
+        return metadata
+
+    @classmethod
+    def __get_metadata(cls, shadow_beam):
+        metadata = {"oe_number" : shadow_beam._oe_number}
+
+        if not shadow_beam.get_initial_flux() is None: metadata["initial_flux"] = shadow_beam.get_initial_flux()
+
+        scanning_data = shadow_beam.scanned_variable_data
+        if not scanning_data is None and not scanning_data.get_scanned_variable_name() is None:
+            metadata["scanned_variable_name"]         = scanning_data.get_scanned_variable_name()
+            if not scanning_data.get_scanned_variable_value() is None:
+                metadata["scanned_variable_value"]    = scanning_data.get_scanned_variable_value()
+            metadata["scanned_variable_display_name"] = str(scanning_data.get_scanned_variable_display_name())
+            metadata["scanned_variable_um"]           = str(scanning_data.get_scanned_variable_um())
+            try:
+                metadata["scanned_variable_additional_parameters"] = json.dumps(scanning_data.get_additional_parameters())
+            except (TypeError, ValueError):
+                pass # not serializable: not saved
+
+        return metadata
+
+    @classmethod
+    def __get_scanning_data(cls, metadata):
+        if not "scanned_variable_name" in metadata: return None
+
+        value = metadata.get("scanned_variable_value", None)
+        if isinstance(value, numpy.generic): value = value.item()
+
+        return ShadowBeam.ScanningData(metadata["scanned_variable_name"],
+                                       value,
+                                       metadata["scanned_variable_display_name"],
+                                       metadata["scanned_variable_um"],
+                                       json.loads(metadata.get("scanned_variable_additional_parameters", "{}")))
+
 class ShadowBeam:
 
+    HISTORY_FULL_INPUT_BEAM = 0
+    HISTORY_INPUT_BEAM_REFERENCE = 1
+
+    history_mode = HISTORY_FULL_INPUT_BEAM
+
+    STORAGE_FULL = 0
+    STORAGE_COMPACT = 1
+
+    storage_mode = STORAGE_FULL
+
     class ScanningData(object):
         def __init__(self,
                      scanned_variable_name,
@@ -143,6 +355,9 @@ class ShadowBeam:
         def get_additional_parameter(self, name):
             return self.__additional_parameters[name]
 
+        def get_additional_parameters(self):
+            return self.__additional_parameters
+
     def __new__(cls, oe_number=0, beam=None, number_of_rays=0):
         __shadow_beam = super().__new__(cls)
         __shadow_beam._oe_number = oe_number
@@ -155,6 +370,8 @@ class ShadowBeam:
         __shadow_beam.history = []
         __shadow_beam.scanned_variable_data = None
         __shadow_beam.__initial_flux = None
+        __shadow_beam._traced_rays = None
+        __shadow_beam._angles = None
 
         return __shadow_beam
 
@@ -173,12 +390,21 @@ class ShadowBeam:
     def get_number_of_rays(self, nolost=0):
         if not hasattr(self._beam, "rays"): return 0
         if nolost==0:     return self._beam.rays.shape[0]
-        elif nolost==1:   return self._beam.rays[numpy.where(self._beam.rays[:, 9] > 0)].shape[0]
-        elif nolost == 2: return self._beam.rays[numpy.where(self._beam.rays[:, 9] < 0)].shape[0]
-        else: raise ValueError("nolost flag value not valid")
+        else:             return ShadowBeamAnalysis.get_analysis(self._beam).get_number_of_rays(nolost)
 
     def setBeam(self, beam):
         self._beam = beam
+        self._traced_rays = None
+        self._angles = None
+
+    @classmethod
+    def set_history_mode(cls, history_mode=HISTORY_FULL_INPUT_BEAM):
+        cls.history_mode = history_mode
+
+    # storage of the accumulated rays (see ShadowCompactRays)
+    @classmethod
+    def set_storage_mode(cls, storage_mode=STORAGE_FULL):
+        cls.storage_mode = storage_mode
 
     def setScanningData(self, scanned_variable_data=ScanningData(None, None, None, None)):
         self.scanned_variable_data=scanned_variable_data
@@ -186,19 +412,148 @@ class ShadowBeam:
     def loadFromFile(self, file_name):
         if not self._beam is None:
             if os.path.exists(file_name):
-                self._beam.load(file_name)
+                if ShadowBeamFile.is_columnar_file(file_name): ShadowBeamFile.read(file_name, self)
+                else:                                          self._beam.load(file_name)
+                self._angles = None
             else:
                 raise Exception("File " + file_name + " not existing")
 
     def writeToFile(self, file_name):
         if not self._beam is None:
-            self._beam.write(file_name)
+            if ShadowBeamFile.is_columnar_file(file_name):
+                ShadowBeamFile.write(file_name, self)
+            else:
+                # Shadow reads the buffer as C-ordered rows (e.g. memory-mapped columnar rays are not)
+                if not self._beam.rays.flags.c_contiguous: self._beam.rays = numpy.ascontiguousarray(self._beam.rays)
+                self._beam.write(file_name)
+
+    ####################################################################
+    # COPY-ON-WRITE RAYS: inside the trace chain (next O.E., history) the
+    # duplicates get a read-only view of the same buffer, a private copy
+    # is made only by the duplicate that writes (detach_rays). The owner
+    # of the buffer is not changed: its rays stay writable.
+    # duplicate() without share_rays=True still returns a private copy.
+    ####################################################################
+
+    def share_rays(self):
+        rays = getattr(self._beam, "rays", None)
+
+        if rays is None: return None
+
+        shared_rays = rays.view()
+        shared_rays.flags.writeable = False
+
+        return shared_rays
+
+    def is_rays_shared(self):
+        return not getattr(self._beam, "rays", None) is None and not self._beam.rays.flags.writeable
+
+    def detach_rays(self):
+        rays = getattr(self._beam, "rays", None)
+
+        if not rays is None:
+            if self.is_rays_shared() or not rays.flags.c_contiguous: self._beam.rays = rays.copy() # C-ordered, as needed by the tracer
+            else:                                                    ShadowBeamAnalysis.invalidate(rays) # modified in place
+
+        self._traced_rays = None # rays are going to be modified: no more reproducible by ray-tracing
+
+        return getattr(self._beam, "rays", None)
+
+    ####################################################################
+    # COLUMN PROJECTION: columns are read-only views of the (maybe
+    # shared or memory-mapped) rays, nothing is copied; a selection of
+    # rays or columns copies only what is selected, once
+    ####################################################################
+
+    def get_column(self, column):
+        """
+        :param column: Shadow column, 1 to 18
+        :return: read-only view of the column
+        """
+        column_view = self._beam.rays[:, column - 1]
+        column_view.flags.writeable = False
+
+        return column_view
+
+    def get_columns(self, columns, selection=None):
+        """
+        :param columns: Shadow columns, 1 to 18
+        :param selection: boolean mask (or indexes) of the rays, None for all the rays
+        :return: a new array (number of rays x number of columns) with the requested columns only
+        """
+        rays = self._beam.rays
+
+        if selection is None: return numpy.stack([rays[:, column - 1] for column in columns], axis=1)
+        else:                 return numpy.stack([rays[selection, column - 1] for column in columns], axis=1)
+
+    def select_rays(self, selection, renumber=False):
+        """
+        :param selection: boolean mask (or indexes) of the rays
+        :param renumber: if True the ray index (column 12) of the selected rays restarts from 1
+        :return: a new array with the selected rays (a private copy, free to be modified)
+        """
+        rays = self._beam.rays[selection]
+        if renumber: rays[:, 11] = numpy.arange(1, len(rays) + 1, 1)
+
+        return rays
+
+    ####################################################################
+    # INCIDENCE/REFLECTION ANGLES: read right after the trace (F_ANGLE=1)
+    # and kept in memory, one row per ray, with the angle.xx columns:
+    # ray index, incidence angle, reflection angle [deg, from the
+    # normal], flag
+    ####################################################################
+
+    def get_angles(self):
+        if self._angles is None: raise Exception("Incidence/reflection angles not calculated by the trace of this beam (F_ANGLE=0)")
+
+        return self._angles
+
+    def get_incidence_angles(self):
+        return self.get_angles()[:, 1]
+
+    def get_reflection_angles(self):
+        return self.get_angles()[:, 2]
 
-    def duplicate(self, copy_rays=True, history=True):
+    @classmethod
+    def read_angle_file(cls, file_name):
+        file_name = os.path.abspath(file_name)
+
+        if not os.path.exists(file_name): raise Exception("File " + file_name + " not existing")
+
+        with open(file_name, "r") as file: number_of_columns = len(file.readline().split())
+
+        # parsed by numpy in C, all at once (no python loop over lines)
+        angles = numpy.fromfile(file_name, sep=" ")
+        angles = angles.reshape((angles.size // number_of_columns, number_of_columns))
+        angles.flags.writeable = False # shared by duplicates
+
+        return angles
+
+    # rays still untouched since generated by the source/O.E.s in the history (or a shared view of them)
+    def is_rebuildable(self):
+        if self._traced_rays is None: return False
+
+        rays        = getattr(self._beam, "rays", None)
+        traced_rays = self._traced_rays()
+
+        return not traced_rays is None and (rays is traced_rays or (not rays is None and rays.base is traced_rays))
+
+    def duplicate(self, copy_rays=True, history=True, share_rays=False):
+        """
+        :param share_rays: if True the duplicate gets a read-only view of the rays of this beam (copy-on-write, this
+                           beam is not changed), otherwise it gets a private copy
+        """
         beam = Shadow.Beam()
-        if copy_rays: beam.rays = copy.deepcopy(self._beam.rays)
+        if copy_rays:
+            if share_rays: beam.rays = self.share_rays()
+            else:          beam.rays = copy.deepcopy(self._beam.rays)
 
         new_shadow_beam = ShadowBeam(self._oe_number, beam)
+        if copy_rays:
+            if share_rays:               new_shadow_beam._traced_rays = self._traced_rays
+            elif self.is_rebuildable():  new_shadow_beam._traced_rays = weakref.ref(beam.rays) # same content
+            new_shadow_beam._angles = self._angles
         new_shadow_beam.setScanningData(self.scanned_variable_data)
         new_shadow_beam.set_initial_flux(self.get_initial_flux())
 
@@ -210,53 +565,70 @@ class ShadowBeam:
     @classmethod
     def mergeBeams(cls, beam_1, beam_2, which_flux=3, merge_history=1):
         if beam_1 and beam_2:
-            rays_1 = None
-            rays_2 = None
+            return ShadowBeam.mergeBeamsList([beam_1, beam_2], which_flux=which_flux, merge_history=merge_history)
+        else:
+            raise Exception("Both input beams should provided for merging")
 
-            if len(getattr(beam_1._beam, "rays", numpy.zeros(0))) > 0:
-                rays_1 = copy.deepcopy(beam_1._beam.rays)
-            if len(getattr(beam_2._beam, "rays", numpy.zeros(0))) > 0:
-                rays_2 = copy.deepcopy(beam_2._beam.rays)
+    # N-ary merge: the output rays are allocated once and each beam is copied (and weighted) in its slice.
+    # Same result of folding mergeBeams over the list: flux and history are those of beam_1 merged with the
+    # others in sequence. Weights multiply the intensity (the electric field by sqrt(weight))
+    @classmethod
+    def mergeBeamsList(cls, beams, weights=None, which_flux=3, merge_history=1):
+        if not beams or None in beams: raise Exception("All the input beams should provided for merging")
+        if not weights is None and len(weights) != len(beams): raise ValueError("Weights and beams must have the same length")
+
+        rays_list = [getattr(beam._beam, "rays", None) for beam in beams]
+        rays_list = [rays if not rays is None and len(rays) > 0 else numpy.zeros((0, 18)) for rays in rays_list]
+
+        first_beam = beams[0]
+
+        merged_beam = first_beam.duplicate(copy_rays=False, history=True)
+        merged_beam._oe_number = first_beam._oe_number
+
+        merged_rays = numpy.empty((sum([len(rays) for rays in rays_list]), 18), dtype=numpy.result_type(*rays_list))
 
-            #if len(rays_2) != len(rays_1): raise ValueError("The two beams must have the same amount of rays for merging")
+        start = 0
+        for index, rays in enumerate(rays_list):
+            end = start + len(rays)
+            merged_rays[start:end] = rays
 
-            merged_beam = beam_1.duplicate(copy_rays=False, history=True)
+            if not weights is None and weights[index] != 1.0:
+                electric_field_factor = numpy.sqrt(weights[index])
 
-            merged_beam._oe_number = beam_1._oe_number
-            merged_beam._beam.rays = numpy.append(rays_1, rays_2, axis=0)
+                for column in [6, 7, 8, 15, 16, 17]: # As, Ap
+                    numpy.multiply(rays[:, column], electric_field_factor, out=merged_rays[start:end, column])
+            start = end
 
-            merged_beam._beam.rays[:, 11] = numpy.arange(1, len(merged_beam._beam.rays) + 1, 1) # ray_index
+        merged_rays[:, 11] = numpy.arange(1, len(merged_rays) + 1, 1) # ray_index
 
+        merged_beam._beam.rays = merged_rays
+
+        initial_flux = first_beam.get_initial_flux()
+        for beam in beams[1:]:
             if which_flux==1:
-                if not beam_1.get_initial_flux() is None:
-                    merged_beam.set_initial_flux(beam_1.get_initial_flux())
+                pass
             elif which_flux==2:
-                if not beam_2.get_initial_flux() is None:
-                    merged_beam.set_initial_flux(beam_2.get_initial_flux())
+                if not beam.get_initial_flux() is None: initial_flux = beam.get_initial_flux()
             else:
-                if not beam_1.get_initial_flux() is None and not beam_2.get_initial_flux() is None:
-                    merged_beam.set_initial_flux(beam_1.get_initial_flux() + beam_2.get_initial_flux())
-
-            if merge_history > 0:
-                if beam_1.history and beam_2.history:
-                    if len(beam_1.history) == len(beam_2.history):
-                        for index in range(1, beam_1._oe_number + 1):
-                            history_element_1 =  beam_1.getOEHistory(index)
-                            history_element_2 =  beam_2.getOEHistory(index)
-
-                            merged_history_element = merged_beam.getOEHistory(index)
-                            if merge_history == 1:
-                                merged_history_element._input_beam = ShadowBeam.mergeBeams(history_element_1._input_beam, history_element_2._input_beam, which_flux, merge_history=0)
-                            else:
-                                merged_history_element._input_beam = ShadowBeam.mergeBeams(history_element_1._input_beam, history_element_2._input_beam, which_flux, merge_history=1)
-                    else:
-                        raise ValueError("Histories must have the same path to be merged")
+                if not initial_flux is None and not beam.get_initial_flux() is None: initial_flux = initial_flux + beam.get_initial_flux()
+        merged_beam.set_initial_flux(initial_flux)
+
+        if merge_history > 0 and len(beams) > 1:
+            for beam in beams[1:]:
+                if first_beam.history and beam.history:
+                    if len(first_beam.history) != len(beam.history): raise ValueError("Histories must have the same path to be merged")
                 else:
                     raise ValueError("Both beams must have a history to be merged")
 
-            return merged_beam
-        else:
-            raise Exception("Both input beams should provided for merging")
+            merged_beam.history = [history_element.duplicate() for history_element in first_beam.history]
+
+            for index in range(1, first_beam._oe_number + 1):
+                merged_history_element = merged_beam.getOEHistory(index)
+                merged_history_element._input_beam = ShadowBeam.mergeBeamsList([beam.getOEHistory(index)._input_beam for beam in beams],
+                                                                               which_flux=which_flux,
+                                                                               merge_history=0 if merge_history == 1 else 1)
+
+        return merged_beam
 
     @classmethod
     def traceFromSource(cls, shadow_src, write_begin_file=0, write_start_file=0, write_end_file=0, history=True, widget_class_name=None):
@@ -270,6 +642,7 @@ class ShadowBeam:
             shadow_src.src.write("start.00")
 
         __shadow_beam._beam.genSource(shadow_src.src)
+        __shadow_beam._traced_rays = weakref.ref(__shadow_beam._beam.rays)
 
         shadow_src.self_repair()
 
@@ -297,7 +670,11 @@ class ShadowBeam:
         if history: history_shadow_oe_start = shadow_oe.duplicate()
         if write_start_file == 1: shadow_oe._oe.write("start.%02d"%__shadow_beam._oe_number)
 
+        __shadow_beam.detach_rays()
+
         __shadow_beam._beam.traceOE(shadow_oe._oe, __shadow_beam._oe_number)
+        if input_beam.is_rebuildable(): __shadow_beam._traced_rays = weakref.ref(__shadow_beam._beam.rays)
+        if shadow_oe._oe.F_ANGLE == 1: __shadow_beam._angles = cls.read_angle_file("angle.%02d"%__shadow_beam._oe_number)
 
         shadow_oe.self_repair()
 
@@ -308,21 +685,57 @@ class ShadowBeam:
 
             #N.B. history[0] = Source
             if not __shadow_beam._oe_number == 0:
-                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number:
-                    __shadow_beam.history.append(ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                     input_beam=input_beam.duplicate(history=recursive_history),
-                                                                     shadow_oe_start=history_shadow_oe_start,
-                                                                     shadow_oe_end=history_shadow_oe_end,
-                                                                     widget_class_name=widget_class_name))
-                else:
-                    __shadow_beam.history[__shadow_beam._oe_number]=ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                      input_beam=input_beam.duplicate(history=recursive_history),
-                                                                      shadow_oe_start=history_shadow_oe_start,
-                                                                      shadow_oe_end=history_shadow_oe_end,
-                                                                      widget_class_name=widget_class_name)
+                history_item = cls.__create_oe_history_item(input_beam, history_shadow_oe_start, history_shadow_oe_end, widget_class_name, recursive_history)
+
+                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number: __shadow_beam.history.append(history_item)
+                else:                                                         __shadow_beam.history[__shadow_beam._oe_number] = history_item
 
         return __shadow_beam
 
+    ####################################################################
+    # FREE SPACE: same result of traceFromOE with an empty element
+    # (T_SOURCE=0, T_IMAGE=distance, T_INCIDENCE=0, T_REFLECTION=180),
+    # computed in numpy without the Fortran trace. The history item
+    # records the equivalent empty element.
+    ####################################################################
+
+    @classmethod
+    def traceFreeSpace(cls, input_beam, distance, history=True, widget_class_name=None, recursive_history=True):
+        __shadow_beam = cls.initializeFromPreviousBeam(input_beam)
+
+        rays = __shadow_beam.detach_rays()
+        if not rays is None: cls.propagate_rays(rays, distance)
+        if input_beam.is_rebuildable(): __shadow_beam._traced_rays = weakref.ref(__shadow_beam._beam.rays)
+
+        if history and not __shadow_beam._oe_number == 0:
+            shadow_oe = ShadowOpticalElement.create_free_space_oe(distance)
+
+            history_item = cls.__create_oe_history_item(input_beam, shadow_oe, shadow_oe.duplicate(), widget_class_name, recursive_history)
+
+            if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number: __shadow_beam.history.append(history_item)
+            else:                                                         __shadow_beam.history[__shadow_beam._oe_number] = history_item
+
+        return __shadow_beam
+
+    @classmethod
+    def propagate_rays(cls, rays, distance):
+        # in place: rays moved to the plane at distance along Y, which becomes the new origin (Y=0)
+        # as in the Fortran IMAGE routine: rays flagged below -1e6 are not moved, rays parallel to
+        # the plane (vy = 0) are flagged -3e6 and not moved, rays going backwards (path < 0) are
+        # moved backwards, with a positive optical path
+        moved = rays[:, 9] >= -1.0e6
+        parallel = numpy.logical_and(moved, rays[:, 4] == 0.0)
+
+        rays[parallel, 9] = -3.0e6
+        moved[parallel] = False
+
+        path = (distance - rays[moved, 1]) / rays[moved, 4]
+
+        rays[moved, 0]  += path * rays[moved, 3]
+        rays[moved, 1]   = 0.0
+        rays[moved, 2]  += path * rays[moved, 5]
+        rays[moved, 12] += numpy.abs(path) # optical path
+
     @classmethod
     def traceIdealLensOE(cls, input_beam, shadow_oe, history=True, widget_class_name=None, recursive_history=True):
         __shadow_beam = cls.initializeFromPreviousBeam(input_beam)
@@ -331,7 +744,10 @@ class ShadowBeam:
 
         if history: history_shadow_oe_start = shadow_oe.duplicate()
 
+        __shadow_beam.detach_rays()
+
         __shadow_beam._beam.traceIdealLensOE(shadow_oe._oe, __shadow_beam._oe_number)
+        if input_beam.is_rebuildable(): __shadow_beam._traced_rays = weakref.ref(__shadow_beam._beam.rays)
 
         shadow_oe.self_repair()
 
@@ -340,18 +756,10 @@ class ShadowBeam:
 
             #N.B. history[0] = Source
             if not __shadow_beam._oe_number == 0:
-                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number:
-                    __shadow_beam.history.append(ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                     input_beam=input_beam.duplicate(history=recursive_history),
-                                                                     shadow_oe_start=history_shadow_oe_start,
-                                                                     shadow_oe_end=history_shadow_oe_end,
-                                                                     widget_class_name=widget_class_name))
-                else:
-                    __shadow_beam.history[__shadow_beam._oe_number]=ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                                        input_beam=input_beam.duplicate(history=recursive_history),
-                                                                                        shadow_oe_start=history_shadow_oe_start,
-                                                                                        shadow_oe_end=history_shadow_oe_end,
-                                                                                        widget_class_name=widget_class_name)
+                history_item = cls.__create_oe_history_item(input_beam, history_shadow_oe_start, history_shadow_oe_end, widget_class_name, recursive_history)
+
+                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number: __shadow_beam.history.append(history_item)
+                else:                                                         __shadow_beam.history[__shadow_beam._oe_number] = history_item
 
         return __shadow_beam
 
@@ -372,39 +780,50 @@ class ShadowBeam:
 
         if history: history_shadow_oe_start = shadow_oe.duplicate()
 
+        __shadow_beam.detach_rays()
+
         __shadow_beam._beam.traceCompoundOE(shadow_oe._oe,
                                             from_oe=__shadow_beam._oe_number,
                                             write_start_files=write_start_files,
                                             write_end_files=write_end_files,
                                             write_star_files=write_star_files,
                                             write_mirr_files=write_mirr_files)
+        if input_beam.is_rebuildable(): __shadow_beam._traced_rays = weakref.ref(__shadow_beam._beam.rays)
 
         shadow_oe.self_repair()
 
         if history:
             history_shadow_oe_end = shadow_oe.duplicate()
 
-            # N.B. history[0] = Source
+            #N.B. history[0] = Source
             if not __shadow_beam._oe_number == 0:
-                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number:
-                    __shadow_beam.history.append(ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                     input_beam=input_beam.duplicate(history=recursive_history),
-                                                                     shadow_oe_start=history_shadow_oe_start,
-                                                                     shadow_oe_end=history_shadow_oe_end,
-                                                                     widget_class_name=widget_class_name))
-                else:
-                    __shadow_beam.history[__shadow_beam._oe_number] = ShadowOEHistoryItem(oe_number=__shadow_beam._oe_number,
-                                                                                          input_beam=input_beam.duplicate(history=recursive_history),
-                                                                                          shadow_oe_start=history_shadow_oe_start,
-                                                                                          shadow_oe_end=history_shadow_oe_end,
-                                                                                          widget_class_name=widget_class_name)
+                history_item = cls.__create_oe_history_item(input_beam, history_shadow_oe_start, history_shadow_oe_end, widget_class_name, recursive_history)
+
+                if len(__shadow_beam.history) - 1 < __shadow_beam._oe_number: __shadow_beam.history.append(history_item)
+                else:                                                         __shadow_beam.history[__shadow_beam._oe_number] = history_item
 
         return __shadow_beam
 
+    @classmethod
+    def __create_oe_history_item(cls, input_beam, shadow_oe_start, shadow_oe_end, widget_class_name, recursive_history):
+        if cls.history_mode == ShadowBeam.HISTORY_INPUT_BEAM_REFERENCE and ShadowInputBeamReference.is_referenceable(input_beam):
+            return ShadowOEHistoryItem(oe_number=input_beam._oe_number + 1,
+                                       input_beam_reference=ShadowInputBeamReference(input_beam, history=recursive_history),
+                                       shadow_oe_start=shadow_oe_start,
+                                       shadow_oe_end=shadow_oe_end,
+                                       widget_class_name=widget_class_name)
+        else:
+            return ShadowOEHistoryItem(oe_number=input_beam._oe_number + 1,
+                                       input_beam=input_beam.duplicate(history=recursive_history, share_rays=True),
+                                       shadow_oe_start=shadow_oe_start,
+                                       shadow_oe_end=shadow_oe_end,
+                                       widget_class_name=widget_class_name)
+
     @classmethod
     def initializeFromPreviousBeam(cls, input_beam):
-        __shadow_beam = input_beam.duplicate()
+        __shadow_beam = input_beam.duplicate(share_rays=True) # detached by the trace
         __shadow_beam._oe_number = input_beam._oe_number + 1
+        __shadow_beam._angles = None # angles of the previous O.E.
 
         return __shadow_beam
 
@@ -417,6 +836,173 @@ class ShadowBeam:
     def historySize(self):
         return len(self.history)
 
+####################################################################
+# COMPACT RAYS: the rays stored with one type per column, float64 for
+# positions, directions, wavenumber and optical path, float32 for the
+# electric vectors and the phases, int32 for flag and ray index: 104
+# bytes per ray instead of 144. Promoted back to the N x 18 float64
+# array of Shadow when a beam is created from them.
+####################################################################
+class ShadowCompactRays(object):
+    COLUMN_TYPES = [numpy.float64, numpy.float64, numpy.float64, # position
+                    numpy.float64, numpy.float64, numpy.float64, # direction
+                    numpy.float32, numpy.float32, numpy.float32, # Es
+                    numpy.int32,                                 # flag
+                    numpy.float64,                               # wavenumber
+                    numpy.int32,                                 # ray index
+                    numpy.float64,                               # optical path
+                    numpy.float32, numpy.float32,                # phases
+                    numpy.float32, numpy.float32, numpy.float32] # Ep
+
+    DTYPE = numpy.dtype([("col%02d" % (column + 1), column_type) for column, column_type in enumerate(COLUMN_TYPES)])
+
+    def __init__(self, rays, selection=None):
+        """
+        :param rays: N x 18 rays (not modified)
+        :param selection: boolean mask (or indexes) of the rays to be stored, None for all the rays
+        """
+        self.__columns = numpy.empty(len(rays) if selection is None else len(rays[selection, 0]), dtype=self.DTYPE)
+
+        for column in range(18):
+            self.__columns[self.DTYPE.names[column]] = rays[:, column] if selection is None else rays[selection, column]
+
+    def __len__(self):
+        return len(self.__columns)
+
+    def get_column(self, column):
+        """
+        :param column: Shadow column, 1 to 18
+        :return: the stored column (a view, in its storage type)
+        """
+        return self.__columns[self.DTYPE.names[column - 1]]
+
+    def get_rays(self, out=None):
+        """
+        :param out: N x 18 float64 array to be filled, None to create it
+        :return: the rays as N x 18 float64 array
+        """
+        if out is None: out = numpy.empty((len(self), 18))
+
+        for column in range(18):
+            out[:, column] = self.__columns[self.DTYPE.names[column]]
+
+        return out
+
+    @classmethod
+    def concatenate_rays(cls, compact_rays_list):
+        rays = numpy.empty((sum([len(compact_rays) for compact_rays in compact_rays_list]), 18))
+
+        start = 0
+        for compact_rays in compact_rays_list:
+            compact_rays.get_rays(out=rays[start:start + len(compact_rays)])
+            start += len(compact_rays)
+
+        return rays
+
+####################################################################
+# ACCUMULATION OF MANY BEAMS: appending copies only the new rays in a
+# list of chunks, the contiguous beam is created only when requested.
+# Same result of a sequence of:
+# ShadowBeam.mergeBeams(accumulated_beam, beam, which_flux, merge_history)
+####################################################################
+class ShadowBeamAccumulator(object):
+    def __init__(self, which_flux=3, merge_history=1):
+        self._which_flux = which_flux
+        self._merge_history = merge_history
+        self.reset()
+
+    def reset(self):
+        self._compact              = False
+        self._first_beam           = None
+        self._chunks               = []
+        self._number_of_rays       = 0
+        self._number_of_good_rays  = 0
+        self._intensity            = 0.0
+        self._initial_flux         = None
+        self._history_accumulators = None
+
+    def is_empty(self):
+        return self._first_beam is None
+
+    def get_number_of_rays(self, nolost=0):
+        if nolost==0:     return self._number_of_rays
+        elif nolost==1:   return self._number_of_good_rays
+        elif nolost == 2: return self._number_of_rays - self._number_of_good_rays
+        else: raise ValueError("nolost flag value not valid")
+
+    # intensity of the good rays, as histo1(..., nolost=1, ref=23)['intensity']
+    def get_intensity(self):
+        return self._intensity
+
+    def append(self, shadow_beam, good_only=False):
+        analysis = ShadowBeamAnalysis.get_analysis(shadow_beam._beam)
+
+        # storage decided at the first beam, for the whole accumulation
+        if self._first_beam is None: self._compact = ShadowBeam.storage_mode == ShadowBeam.STORAGE_COMPACT
+
+        if self._compact:
+            rays = ShadowCompactRays(shadow_beam._beam.rays, selection=analysis.get_mask(nolost=1)[0] if good_only else None)
+            ray_index = rays.get_column(12)
+        else:
+            if good_only: rays = shadow_beam._beam.rays[analysis.get_mask(nolost=1)[0]] # fancy indexing: already a copy
+            else:         rays = shadow_beam._beam.rays.copy()
+            ray_index = rays[:, 11]
+
+        ray_index[:] = numpy.arange(self._number_of_rays + 1, self._number_of_rays + len(rays) + 1, 1)
+
+        if self._first_beam is None:
+            self._first_beam   = shadow_beam.duplicate(copy_rays=False, history=True)
+            self._initial_flux = shadow_beam.get_initial_flux()
+        else:
+            if self._merge_history > 0: self.__append_history(shadow_beam)
+
+            if self._which_flux == 2:
+                if not shadow_beam.get_initial_flux() is None:
+                    self._initial_flux = shadow_beam.get_initial_flux()
+            elif self._which_flux == 3:
+                if not self._initial_flux is None and not shadow_beam.get_initial_flux() is None:
+                    self._initial_flux += shadow_beam.get_initial_flux()
+
+        self._chunks.append(rays)
+        self._number_of_rays      += len(rays)
+        self._number_of_good_rays += analysis.get_number_of_rays(nolost=1)
+        self._intensity           += analysis.get_intensity(nolost=1, ref=23)
+
+    def __append_history(self, shadow_beam):
+        if self._first_beam.history and shadow_beam.history:
+            if len(self._first_beam.history) == len(shadow_beam.history):
+                if self._history_accumulators is None:
+                    self._history_accumulators = {}
+
+                    for index in range(1, self._first_beam._oe_number + 1):
+                        self._history_accumulators[index] = ShadowBeamAccumulator(which_flux=self._which_flux, merge_history=0 if self._merge_history == 1 else 1)
+                        self._history_accumulators[index].append(self._first_beam.getOEHistory(index)._input_beam)
+
+                for index in range(1, self._first_beam._oe_number + 1):
+                    self._history_accumulators[index].append(shadow_beam.getOEHistory(index)._input_beam)
+            else:
+                raise ValueError("Histories must have the same path to be merged")
+        else:
+            raise ValueError("Both beams must have a history to be merged")
+
+    def get_accumulated_beam(self):
+        if self._first_beam is None: return None
+
+        accumulated_beam = self._first_beam.duplicate(copy_rays=False, history=True)
+
+        # a private float64 array for Shadow (writable by who receives it), the chunks stay in the accumulator
+        if self._compact: accumulated_beam._beam.rays = ShadowCompactRays.concatenate_rays(self._chunks)
+        else:             accumulated_beam._beam.rays = numpy.concatenate(self._chunks, axis=0)
+        accumulated_beam.set_initial_flux(self._initial_flux)
+
+        if not self._history_accumulators is None:
+            accumulated_beam.history = [history_item.duplicate() for history_item in self._first_beam.history]
+
+            for index, history_accumulator in self._history_accumulators.items():
+                accumulated_beam.getOEHistory(index)._input_beam = history_accumulator.get_accumulated_beam()
+
+        return accumulated_beam
+
 class ShadowSource:
     def __new__(cls, src=None):
         __shadow_source = super().__new__(cls)
@@ -605,6 +1191,23 @@ class ShadowOpticalElement:
 
         return __shadow_oe
 
+    @classmethod
+    def create_free_space_oe(cls, distance):
+        __shadow_oe = cls.create_empty_oe()
+
+        __shadow_oe._oe.DUMMY = 1.0
+
+        __shadow_oe._oe.T_SOURCE     = 0.0
+        __shadow_oe._oe.T_IMAGE      = distance
+        __shadow_oe._oe.T_INCIDENCE  = 0.0
+        __shadow_oe._oe.T_REFLECTION = 180.0
+        __shadow_oe._oe.ALPHA        = 0.0
+
+        __shadow_oe._oe.FWRITE = 3
+        __shadow_oe._oe.F_ANGLE = 0
+
+        return ShadowFreeSpaceElement(oe=__shadow_oe._oe, distance=distance)
+
     @classmethod
     def create_oe_from_file(cls, filename):
         __shadow_oe = cls.create_empty_oe()
@@ -918,6 +1521,18 @@ class ShadowOpticalElement:
                              cz_slit,
                              numpy.array(file_scr_ext))
 
+####################################################################
+# EMPTY ELEMENT OF A FREE-SPACE PROPAGATION (ShadowBeam.traceFreeSpace):
+# recognized in the history, so it is traced again in numpy
+####################################################################
+class ShadowFreeSpaceElement(ShadowOpticalElement):
+    def __init__(self, oe=None, distance=0.0):
+        super().__init__(oe)
+        self.distance = distance
+
+    def duplicate(self):
+        return ShadowFreeSpaceElement(oe=self._oe.duplicate(), distance=self.distance)
+
 class ShadowCompoundOpticalElement:
     def __init__(self, oe=None):
         self._oe = oe
@@ -4,6 +4,8 @@ import os
 import random
 import sys
 import copy
+import weakref
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy
 import xraylib
@@ -38,6 +40,7 @@ except ImportError:
     print(sys.exc_info()[1])
     pass
 
+import Shadow
 import Shadow.ShadowToolsPrivate as stp
 
 import scipy.constants as codata
@@ -203,6 +206,456 @@ class ShadowCongruence():
 
         return numbers
 
+####################################################################
+# HISTOGRAMS WITH UNIFORM BINS: the bin of each value is computed
+# arithmetically and checked against the edges, the sums are done by
+# numpy.bincount. Same bins of numpy.histogram/histogram2d (and so of
+# Shadow.Beam.histo1/histo2), with fewer passes and temporaries.
+# Columns are not converted: float32 columns are binned as they are.
+#
+# The rays are split in chunks of fixed size, binned in a pool of
+# threads (numpy releases the GIL) and the partial histograms are
+# summed in the order of the chunks: the result does not depend on
+# the number of threads.
+####################################################################
+
+class ShadowHistogram(object):
+    CHUNK_SIZE = 2**20
+
+    __number_of_threads = None # None: from the preferences
+    __executor = None
+    __executor_threads = 0
+
+    @classmethod
+    def set_number_of_threads(cls, number_of_threads=None):
+        """
+        :param number_of_threads: worker threads for the histograms, 0 = one per core, None = from the
+                                  preferences ("output/shadow-histogram-threads", default 0)
+        """
+        cls.__number_of_threads = number_of_threads
+
+    @classmethod
+    def get_number_of_threads(cls):
+        number_of_threads = cls.__number_of_threads
+
+        if number_of_threads is None:
+            try:
+                number_of_threads = QSettings().value("output/shadow-histogram-threads", 0, int)
+            except:
+                number_of_threads = 0
+
+        if number_of_threads <= 0: number_of_threads = os.cpu_count() or 1
+
+        return number_of_threads
+
+    @classmethod
+    def get_edges(cls, value_range, nbins):
+        first_edge, last_edge = value_range
+        if first_edge == last_edge: first_edge, last_edge = first_edge - 0.5, last_edge + 0.5
+
+        return numpy.linspace(first_edge, last_edge, nbins + 1)
+
+    # same range of Shadow.Beam.get_good_range
+    @classmethod
+    def get_good_range(cls, column, mask=None):
+        if (column.size if mask is None else numpy.count_nonzero(mask)) == 0: return [-1, 1]
+
+        rmin0, rmax0 = cls.get_minimum_maximum(column, mask)
+
+        rmin = rmin0 * 0.95 if rmin0 > 0.0 else rmin0 * 1.05
+        rmax = rmax0 * 0.95 if rmax0 < 0.0 else rmax0 * 1.05
+
+        if rmin0 == rmax0 and rmin0 != 0.0:
+            rmin = rmin0 * 0.95
+            rmax = rmax0 * 1.05
+        if rmin0 == 0.0:
+            rmin = -1.0
+            rmax = 1.0
+        if (rmax - rmin) / 1.25 > (rmax0 - rmin0) and rmin0 != rmax0:
+            rmin = 0.5 * (rmax0 + rmin0) - 0.55 * (rmax0 - rmin0)
+            rmax = 0.5 * (rmax0 + rmin0) + 0.55 * (rmax0 - rmin0)
+
+        return [rmin, rmax]
+
+    @classmethod
+    def get_minimum_maximum(cls, column, mask=None): # nan ignored
+        where = True if mask is None else mask
+
+        return numpy.fmin.reduce(column, initial=numpy.inf, where=where), numpy.fmax.reduce(column, initial=-numpy.inf, where=where)
+
+    @classmethod
+    def histogram1d(cls, values, edges, weights=None, mask=None):
+        """
+        :param values: the column (all the rays)
+        :param edges: uniform bin edges (from get_edges)
+        :param weights: weight column or None (counts)
+        :param mask: rays to be histogrammed (boolean column) or None (all)
+        :return: the histogram and the histogram of the squared weights, as numpy.histogram
+        """
+        def histogram_chunk(chunk):
+            index, selected = cls.__get_bin_indexes(values[chunk], edges, None if mask is None else mask[chunk])
+            index = index[selected]
+
+            if weights is None:
+                histogram = numpy.bincount(index, minlength=len(edges) - 1).astype(float)
+
+                return numpy.stack((histogram, histogram))
+            else:
+                chunk_weights = weights[chunk][selected]
+
+                return numpy.stack((numpy.bincount(index, weights=chunk_weights, minlength=len(edges) - 1),
+                                    numpy.bincount(index, weights=chunk_weights*chunk_weights, minlength=len(edges) - 1)))
+
+        histogram, histogram_squared_weights = cls.__sum_chunks(histogram_chunk, len(values))
+
+        return histogram, histogram_squared_weights
+
+    @classmethod
+    def histogram2d(cls, values_h, values_v, edges_h, edges_v, weights=None, mask=None):
+        """
+        :param values_h, values_v: the columns (all the rays)
+        :param edges_h, edges_v: uniform bin edges (from get_edges)
+        :param weights: weight column or None (counts)
+        :param mask: rays to be histogrammed (boolean column) or None (all)
+        :return: the histogram (nbins_h x nbins_v), as numpy.histogram2d
+        """
+        nbins_h, nbins_v = len(edges_h) - 1, len(edges_v) - 1
+
+        def histogram_chunk(chunk):
+            index_h, selected = cls.__get_bin_indexes(values_h[chunk], edges_h, None if mask is None else mask[chunk])
+            index_v, selected = cls.__get_bin_indexes(values_v[chunk], edges_v, selected)
+
+            index = index_h[selected]
+            index *= nbins_v
+            index += index_v[selected]
+
+            histogram = numpy.bincount(index, weights=None if weights is None else weights[chunk][selected], minlength=nbins_h*nbins_v)
+
+            return histogram.astype(float, copy=False)
+
+        return cls.__sum_chunks(histogram_chunk, len(values_h)).reshape((nbins_h, nbins_v))
+
+    @classmethod
+    def __sum_chunks(cls, histogram_chunk, number_of_values):
+        chunks = [slice(start, start + cls.CHUNK_SIZE) for start in range(0, max(number_of_values, 1), cls.CHUNK_SIZE)]
+
+        number_of_threads = min(cls.get_number_of_threads(), len(chunks))
+
+        if number_of_threads <= 1:
+            partial_histograms = map(histogram_chunk, chunks)
+        else:
+            if cls.__executor is None or cls.__executor_threads != number_of_threads:
+                if not cls.__executor is None: cls.__executor.shutdown(wait=False)
+
+                cls.__executor = ThreadPoolExecutor(max_workers=number_of_threads, thread_name_prefix="ShadowHistogram")
+                cls.__executor_threads = number_of_threads
+
+            partial_histograms = cls.__executor.map(histogram_chunk, chunks) # results in the order of the chunks
+
+        histogram = None
+        for partial_histogram in partial_histograms:
+            if histogram is None: histogram = partial_histogram
+            else:                 histogram += partial_histogram
+
+        return histogram
+
+    # bin index of each value (left edge included, the last bin includes also the right edge), and the values in range
+    @classmethod
+    def __get_bin_indexes(cls, values, edges, selected):
+        nbins = len(edges) - 1
+        first_edge, last_edge = float(edges[0]), float(edges[-1])
+
+        in_range = values >= first_edge
+        in_range &= values <= last_edge
+        if not selected is None: in_range &= selected
+
+        scaled = values - first_edge
+        scaled *= nbins / (last_edge - first_edge)
+        scaled[~in_range] = 0.0
+
+        index = scaled.astype(numpy.intp)
+        numpy.minimum(index, nbins - 1, out=index)
+
+        # rounding of the arithmetic binning: the edges decide
+        index[values < edges[index]] -= 1
+        index[(values >= edges[index + 1]) & (index != nbins - 1)] += 1
+
+        return index, in_range
+
+####################################################################
+# ANALYSIS OF A RAY BUFFER: good/lost masks, intensity columns and
+# histogram tickets are computed once and shared by all the beams
+# and widgets looking at the same rays array (or at read-only views
+# of it, see ShadowBeam.share_rays). The rays flags are never changed:
+# ShadowBeam.detach_rays invalidates the analysis of rays going to be
+# modified in place, a new rays array gets a new analysis.
+####################################################################
+
+class ShadowBeamAnalysis(object):
+    MAXIMUM_NUMBER_OF_TICKETS = 16
+
+    __analyses = {}
+
+    @classmethod
+    def get_analysis(cls, beam): # Shadow.Beam
+        rays = cls.__get_buffer(beam.rays)
+
+        try:
+            analysis = cls.__analyses[id(rays)]
+            if analysis.get_rays() is rays: return analysis
+        except KeyError:
+            pass
+
+        analysis = ShadowBeamAnalysis(rays)
+        cls.__analyses[id(rays)] = analysis
+
+        return analysis
+
+    # rays going to be modified in place
+    @classmethod
+    def invalidate(cls, rays):
+        cls.__analyses.pop(id(cls.__get_buffer(rays)), None)
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__analyses.clear()
+
+    # a view of the whole rays array has the same analysis of the array
+    @classmethod
+    def __get_buffer(cls, rays):
+        base = rays.base
+
+        if isinstance(base, numpy.ndarray) and base.shape == rays.shape and base.strides == rays.strides and \
+                base.__array_interface__["data"][0] == rays.__array_interface__["data"][0]: return base
+        else:
+            return rays
+
+    def __init__(self, rays):
+        key = id(rays)
+        self.__rays = weakref.ref(rays, lambda reference: ShadowBeamAnalysis.__remove(key, reference))
+        self.__masks = {}
+        self.__intensity_columns = {}
+        self.__intensities = {}
+        self.__tickets = OrderedDict()
+
+    @classmethod
+    def __remove(cls, key, reference):
+        analysis = cls.__analyses.get(key, None)
+        if not analysis is None and analysis.__rays is reference: del cls.__analyses[key]
+
+    def get_rays(self):
+        return self.__rays()
+
+    # same selection of Shadow.Beam.getshonecol: 0 all, 1 good (flag > 0), 2 lost (flag < 0)
+    def get_mask(self, nolost=1):
+        if nolost == 0: return None
+
+        try:
+            return self.__masks[nolost]
+        except KeyError:
+            if nolost == 1:   mask = self.get_rays()[:, 9] > 0
+            elif nolost == 2: mask = self.get_rays()[:, 9] < 0
+            else: raise ValueError("nolost flag value not valid")
+
+            mask.flags.writeable = False
+            self.__masks[nolost] = (mask, int(numpy.count_nonzero(mask)))
+
+            return self.__masks[nolost]
+
+    def get_number_of_rays(self, nolost=0):
+        if nolost == 0: return self.get_rays().shape[0]
+        else:           return self.get_mask(nolost)[1]
+
+    # Shadow column 23 (total intensity), 24 (s), 25 (p) or any other weight column, for all the rays
+    def get_intensity_column(self, ref=23):
+        try:
+            return self.__intensity_columns[ref]
+        except KeyError:
+            rays = self.get_rays()
+
+            if ref == 23:   column = numpy.sum(rays[:, [6, 7, 8, 15, 16, 17]]**2, axis=1)
+            elif ref == 24: column = numpy.sum(rays[:, 6:9]**2, axis=1)
+            elif ref == 25: column = numpy.sum(rays[:, 15:18]**2, axis=1)
+            else:
+                beam = Shadow.Beam()
+                beam.rays = rays
+                column = beam.getshonecol(ref, nolost=0)
+
+            column.flags.writeable = False
+            self.__intensity_columns[ref] = column
+
+            return column
+
+    def get_intensity(self, nolost=1, ref=23):
+        try:
+            return self.__intensities[(nolost, ref)]
+        except KeyError:
+            column = self.get_intensity_column(ref)
+            if nolost != 0: column = column[self.get_mask(nolost)[0]]
+
+            self.__intensities[(nolost, ref)] = column.sum()
+
+            return self.__intensities[(nolost, ref)]
+
+    def histo1(self, beam, col, nbins=100, xrange=None, nolost=0, ref=0):
+        if ref is None: ref = 0
+
+        return self.__get_ticket(("histo1", col, nbins, self.__range_key(xrange), nolost, ref),
+                                 lambda: self.__calculate_histo1(beam, col, nbins, xrange, nolost, ref))
+
+    def histo2(self, beam, col_h, col_v, nbins=25, nbins_h=None, nbins_v=None, xrange=None, yrange=None, nolost=0, ref=23):
+        if nbins_h is None: nbins_h = nbins
+        if nbins_v is None: nbins_v = nbins
+        if ref is None: ref = 0
+
+        return self.__get_ticket(("histo2", col_h, col_v, nbins_h, nbins_v, self.__range_key(xrange), self.__range_key(yrange), nolost, ref),
+                                 lambda: self.__calculate_histo2(beam, col_h, col_v, nbins_h, nbins_v, xrange, yrange, nolost, ref))
+
+    # column of all the rays: a view of the rays array when possible
+    def get_column(self, beam, col):
+        if 1 <= col <= 18 and col != 11: return self.get_rays()[:, col - 1]
+        elif col in [23, 24, 25]:        return self.get_intensity_column(col)
+        else:                            return beam.getshonecol(col, nolost=0)
+
+    # same ticket of Shadow.Beam.histo1 (factor=1, calculate_widths=1), histogram by ShadowHistogram
+    def __calculate_histo1(self, beam, col, nbins, xrange, nolost, ref):
+        ticket = {'error':1}
+
+        ticket['col'] = col
+        ticket['write'] = None
+        ticket['nolost'] = nolost
+        ticket['nbins'] = nbins
+        ticket['factor'] = 1.0
+        ticket['ref'] = ref
+
+        mask = self.get_mask(nolost)
+        if not mask is None: mask = mask[0]
+
+        number_of_rays = self.get_number_of_rays(nolost)
+        if number_of_rays == 0: raise ValueError("No rays to be histogrammed")
+
+        column = self.get_column(beam, col)
+
+        if xrange is None: xrange = list(ShadowHistogram.get_minimum_maximum(column, mask))
+
+        bins = ShadowHistogram.get_edges(xrange, nbins)
+
+        h, h2 = ShadowHistogram.histogram1d(column, bins, weights=None if ref == 0 else self.get_column(beam, ref), mask=mask)
+
+        h_sigma = numpy.sqrt(h2 - h*h/float(number_of_rays))
+
+        ticket['error'] = 0
+        ticket['histogram'] = h
+        ticket['bins'] = bins
+        ticket['histogram_sigma'] = h_sigma
+        bin_center = bins[:-1]+(bins[1]-bins[0])*0.5
+        ticket['bin_center'] = bin_center
+        ticket['bin_left'] = bins[:-1]
+        ticket['bin_right'] = bins[:-1]+(bins[1]-bins[0])
+        ticket['xrange'] = xrange
+        ticket['intensity'] = self.get_intensity(nolost=nolost, ref=23)
+        ticket['fwhm'] = None
+        ticket['nrays'] = self.get_number_of_rays(nolost=0)
+        ticket['good_rays'] = self.get_number_of_rays(nolost=0) - self.get_number_of_rays(nolost=2) # Shadow.Beam.nrays: flag >= 0
+
+        ticket['histogram_path'] = numpy.repeat(h, 2)
+        ticket['bin_path'] = numpy.stack((ticket['bin_left'], ticket['bin_right']), axis=1).ravel()
+
+        tt = numpy.where(h >= h.max()*0.5)
+        if h[tt].size > 1:
+            binSize = bins[1]-bins[0]
+            ticket['fwhm'] = binSize*(tt[0][-1]-tt[0][0])
+            ticket['fwhm_coordinates'] = (bin_center[tt[0][0]], bin_center[tt[0][-1]])
+
+            # fwhm with subpixel resolution
+            ixl_e = tt[0][0]
+            ixr_e = tt[0][-1]
+            try:
+                xl = ixl_e - (h[ixl_e] - h.max()*0.5) / (h[ixl_e] - h[ixl_e - 1])
+                xr = ixr_e - (h[ixr_e] - h.max()*0.5) / (h[ixr_e + 1] - h[ixr_e])
+                ticket['fwhm_subpixel'] = binSize * numpy.abs(xr - xl)
+                ticket['fwhm_subpixel_coordinates'] = (numpy.interp(xl, range(bin_center.size), bin_center),
+                                                       numpy.interp(xr, range(bin_center.size), bin_center))
+            except:
+                ticket['fwhm_subpixel'] = None
+        else:
+            ticket['fwhm_subpixel'] = None
+
+        return ticket
+
+    # same ticket of Shadow.Beam.histo2 (calculate_widths=1), histogram by ShadowHistogram
+    def __calculate_histo2(self, beam, col_h, col_v, nbins_h, nbins_v, xrange, yrange, nolost, ref):
+        ticket = {'error':1}
+
+        ticket['col_h'] = col_h
+        ticket['col_v'] = col_v
+        ticket['nolost'] = nolost
+        ticket['nbins_h'] = nbins_h
+        ticket['nbins_v'] = nbins_v
+        ticket['ref'] = ref
+
+        mask = self.get_mask(nolost)
+        if not mask is None: mask = mask[0]
+
+        column_h = self.get_column(beam, col_h)
+        column_v = self.get_column(beam, col_v)
+
+        if xrange is None: xrange = ShadowHistogram.get_good_range(column_h, mask)
+        if yrange is None: yrange = ShadowHistogram.get_good_range(column_v, mask)
+
+        edges_h = ShadowHistogram.get_edges(xrange, nbins_h)
+        edges_v = ShadowHistogram.get_edges(yrange, nbins_v)
+
+        histogram = ShadowHistogram.histogram2d(column_h, column_v, edges_h, edges_v,
+                                                weights=None if ref == 0 else self.get_column(beam, ref),
+                                                mask=mask)
+
+        ticket['xrange'] = xrange
+        ticket['yrange'] = yrange
+        ticket['bin_h_edges'] = edges_h
+        ticket['bin_v_edges'] = edges_v
+        ticket['bin_h_left'] = numpy.delete(edges_h, -1)
+        ticket['bin_v_left'] = numpy.delete(edges_v, -1)
+        ticket['bin_h_right'] = numpy.delete(edges_h, 0)
+        ticket['bin_v_right'] = numpy.delete(edges_v, 0)
+        ticket['bin_h_center'] = 0.5*(ticket['bin_h_left']+ticket['bin_h_right'])
+        ticket['bin_v_center'] = 0.5*(ticket['bin_v_left']+ticket['bin_v_right'])
+        ticket['histogram'] = histogram
+        ticket['histogram_h'] = histogram.sum(axis=1)
+        ticket['histogram_v'] = histogram.sum(axis=0)
+        ticket['intensity'] = self.get_intensity(nolost=nolost, ref=23)
+        ticket['nrays'] = self.get_number_of_rays(nolost=0)
+        ticket['good_rays'] = self.get_number_of_rays(nolost=0) - self.get_number_of_rays(nolost=2) # Shadow.Beam.nrays: flag >= 0
+
+        for direction in ["h", "v"]:
+            h = ticket['histogram_' + direction]
+            tt = numpy.where(h >= h.max()*0.5)
+            if h[tt].size > 1:
+                bin_center = ticket['bin_' + direction + '_center']
+                ticket['fwhm_' + direction] = (bin_center[1]-bin_center[0])*(tt[0][-1]-tt[0][0])
+                ticket['fwhm_coordinates_' + direction] = (bin_center[tt[0][0]], bin_center[tt[0][-1]])
+            else:
+                ticket['fwhm_' + direction] = None
+
+        return ticket
+
+    # tickets are modified by the plots: each caller receives a copy
+    def __get_ticket(self, key, calculate):
+        try:
+            self.__tickets.move_to_end(key)
+            ticket = self.__tickets[key]
+        except KeyError:
+            ticket = calculate()
+
+            self.__tickets[key] = ticket
+            if len(self.__tickets) > self.MAXIMUM_NUMBER_OF_TICKETS: self.__tickets.popitem(last=False)
+
+        return copy.deepcopy(ticket)
+
+    @classmethod
+    def __range_key(cls, value_range):
+        return None if value_range is None else tuple(float(value) for value in value_range)
+
 class ShadowStatisticData:
     intensity = 0.0
     total_number_of_rays = 0
@@ -519,8 +972,10 @@ try:
 
             def plot_histo(self, beam, col, nolost, xrange, ref, title, xtitle, ytitle, nbins = 100, xum="", conv=1.0, ticket_to_add=None, flux=None):
 
-                ticket = beam.histo1(col, nbins=nbins, xrange=xrange, nolost=nolost, ref=ref)
-                if ref in [24, 25]: ticket['intensity'] = beam.getshonecol(ref, nolost=nolost).sum()
+                analysis = ShadowBeamAnalysis.get_analysis(beam)
+
+                ticket = analysis.histo1(beam, col, nbins=nbins, xrange=xrange, nolost=nolost, ref=ref)
+                if ref in [24, 25]: ticket['intensity'] = analysis.get_intensity(nolost=nolost, ref=ref)
 
                 # TODO: check congruence between tickets
                 if not ticket_to_add is None:
@@ -627,8 +1082,10 @@ try:
                 if nbins_h == None: nbins_h = nbins
                 if nbins_v == None: nbins_v = nbins
 
-                ticket = beam.histo2(var_x, var_y, nbins=nbins, nbins_h=nbins_h, nbins_v=nbins_v, xrange=xrange, yrange=yrange, nolost=nolost, ref=ref)
-                if ref in [24, 25]: ticket['intensity'] = beam.getshonecol(ref, nolost=nolost).sum()
+                analysis = ShadowBeamAnalysis.get_analysis(beam)
+
+                ticket = analysis.histo2(beam, var_x, var_y, nbins=nbins, nbins_h=nbins_h, nbins_v=nbins_v, xrange=xrange, yrange=yrange, nolost=nolost, ref=ref)
+                if ref in [24, 25]: ticket['intensity'] = analysis.get_intensity(nolost=nolost, ref=ref)
 
                 # TODO: check congruence between tickets
                 if not ticket_to_add is None:
@@ -819,7 +1276,7 @@ try:
 
             factor=ShadowPlot.get_factor(col, conv)
 
-            ticket = beam.histo1(col, nbins=100, xrange=None, nolost=nolost, ref=ref)
+            ticket = ShadowBeamAnalysis.get_analysis(beam).histo1(beam, col, nbins=100, xrange=None, nolost=nolost, ref=ref)
 
             if ref != 0 and not ytitle is None:  ytitle = ytitle + ' weighted by ' + ShadowPlot.get_shadow_label(ref)
 
@@ -1035,6 +1492,7 @@ try:
 except:
     pass
 
+from collections import OrderedDict
 from scipy.interpolate import RectBivariateSpline
 
 class ShadowPreProcessor:
@@ -1119,109 +1577,88 @@ class ShadowPreProcessor:
 
         return x_coords, y_coords, z_values
 
+    ####################################################################
+    # USER PROFILES (diffraction profiles, reflectivities, efficiencies):
+    # the files are parsed once and the prepared tables/interpolators are
+    # kept in a process-wide cache, keyed by path, modification time and
+    # size of the file (i.e. reloaded when the file changes)
+    ####################################################################
+
+    __profile_cache = OrderedDict()
+    __MAX_PROFILE_CACHE_SIZE = 32
+
     @classmethod
-    def apply_user_diffraction_profile(cls, crystal, h, k, l, asymmetry_angle, file_diffraction_profile, input_beam):
-        values = numpy.loadtxt(os.path.abspath(os.path.curdir + "/angle." +
-                                               ("0" + str(input_beam._oe_number) if (input_beam._oe_number < 10) else
-                                                str(input_beam._oe_number))))
+    def clear_profile_cache(cls):
+        cls.__profile_cache.clear()
 
-        beam_incident_angles = values[:, 1]
-        beam_wavelengths     = ShadowPhysics.getWavelengthFromShadowK(input_beam._beam.rays[:, 10])
-        d_spacing            = xraylib.Crystal_dSpacing(xraylib.Crystal_GetCrystal(crystal), h, k, l)
-        bragg_angles         = numpy.degrees(numpy.arcsin(0.5*beam_wavelengths/d_spacing))
-        diffraction_angles   = 90 - (bragg_angles - asymmetry_angle)
-        delta_thetas         = diffraction_angles - beam_incident_angles
+    @classmethod
+    def get_profile_file_path(cls, file_name):
+        return os.path.abspath(file_name) if file_name.startswith('/') else os.path.abspath(os.path.curdir + "/" + file_name)
 
-        values = numpy.loadtxt(os.path.abspath(file_diffraction_profile) if file_diffraction_profile.startswith('/') else
-                               os.path.abspath(os.path.curdir + "/" + file_diffraction_profile))
+    @classmethod
+    def __get_cached_profile(cls, file_name, profile_type, build_profile, *parameters):
+        file_path = cls.get_profile_file_path(file_name)
+        file_stat = os.stat(file_path)
 
-        crystal_delta_thetas     = values[:, 0]
-        crystal_reflectivities_s = values[:, 1]
+        key = (file_path, file_stat.st_mtime_ns, file_stat.st_size, profile_type) + parameters
 
-        interpolated_weight_s = numpy.sqrt(numpy.interp(delta_thetas,
-                                                        crystal_delta_thetas,
-                                                        crystal_reflectivities_s,
-                                                        left=crystal_reflectivities_s[0],
-                                                        right=crystal_reflectivities_s[-1]))
-        if values.shape[1] == 2: interpolated_weight_p = interpolated_weight_s
-        elif values.shape[1] >= 3:
-            crystal_reflectivities_p = values[:, 2]
+        try:
+            cls.__profile_cache.move_to_end(key)
 
-            interpolated_weight_p = numpy.sqrt(numpy.interp(delta_thetas,
-                                                            crystal_delta_thetas,
-                                                            crystal_reflectivities_p,
-                                                            left=crystal_reflectivities_p[0],
-                                                            right=crystal_reflectivities_p[-1]))
+            return cls.__profile_cache[key]
+        except KeyError:
+            profile = build_profile(numpy.loadtxt(file_path))
 
-        output_beam = input_beam.duplicate()
+            for item in profile:
+                if isinstance(item, numpy.ndarray): item.flags.writeable = False
 
-        output_beam._beam.rays[:, 6]  = output_beam._beam.rays[:, 6]  * interpolated_weight_s
-        output_beam._beam.rays[:, 7]  = output_beam._beam.rays[:, 7]  * interpolated_weight_s
-        output_beam._beam.rays[:, 8]  = output_beam._beam.rays[:, 8]  * interpolated_weight_s
-        output_beam._beam.rays[:, 15] = output_beam._beam.rays[:, 15] * interpolated_weight_p
-        output_beam._beam.rays[:, 16] = output_beam._beam.rays[:, 16] * interpolated_weight_p
-        output_beam._beam.rays[:, 17] = output_beam._beam.rays[:, 17] * interpolated_weight_p
+            cls.__profile_cache[key] = profile
+            if len(cls.__profile_cache) > cls.__MAX_PROFILE_CACHE_SIZE: cls.__profile_cache.popitem(last=False)
 
-        return output_beam
+            return profile
 
     @classmethod
-    def apply_user_reflectivity(cls, file_type, angle_units, energy_units, file_reflectivity, input_beam):
-        if file_type == 0: # angle vs refl.
-            values = numpy.loadtxt(os.path.abspath(os.path.curdir + "/angle." +
-                                                   ("0" + str(input_beam._oe_number) if (input_beam._oe_number < 10) else
-                                                    str(input_beam._oe_number))))
+    def get_diffraction_profile(cls, file_diffraction_profile):
+        def build_profile(values):
+            crystal_delta_thetas     = values[:, 0].copy()
+            crystal_reflectivities_s = values[:, 1].copy()
+            crystal_reflectivities_p = values[:, 2].copy() if values.shape[1] >= 3 else crystal_reflectivities_s
 
-            beam_incident_angles = 90.0 - values[:, 1]
+            return crystal_delta_thetas, crystal_reflectivities_s, crystal_reflectivities_p
 
-            values = numpy.loadtxt(os.path.abspath(file_reflectivity) if file_reflectivity.startswith('/') else
-                                   os.path.abspath(os.path.curdir + "/" + file_reflectivity))
+        return cls.__get_cached_profile(file_diffraction_profile, "diffraction_profile", build_profile)
 
-            mirror_grazing_angles = values[:, 0]
-            mirror_reflectivities = values[:, 1]
+    @classmethod
+    def get_reflectivity_vs_angle(cls, file_reflectivity, angle_units):
+        def build_profile(values):
+            mirror_grazing_angles = values[:, 0].copy()
+            mirror_reflectivities = values[:, 1].copy()
 
             if mirror_grazing_angles[-1] < mirror_grazing_angles[0]: # XOPPY MLayer gives angles in descendent order
-                mirror_grazing_angles = values[:, 0][::-1]
-                mirror_reflectivities = values[:, 1][::-1]
+                mirror_grazing_angles = mirror_grazing_angles[::-1].copy()
+                mirror_reflectivities = mirror_reflectivities[::-1].copy()
 
             if angle_units == 0: mirror_grazing_angles = numpy.degrees(1e-3 * mirror_grazing_angles) # mrad to deg
 
-            interpolated_weight_s = numpy.sqrt(numpy.interp(beam_incident_angles,
-                                                            mirror_grazing_angles,
-                                                            mirror_reflectivities,
-                                                            left=mirror_reflectivities[0],
-                                                            right=mirror_reflectivities[-1]))
-            interpolated_weight_p = interpolated_weight_s
-
-        elif file_type == 1: # Energy vs Refl.
-            beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
+            return mirror_grazing_angles, mirror_reflectivities
 
-            values = numpy.loadtxt(os.path.abspath(os.path.abspath(file_reflectivity)  if file_reflectivity.startswith('/') else
-                                                   os.path.abspath(os.path.curdir + "/" + file_reflectivity)))
+        return cls.__get_cached_profile(file_reflectivity, "reflectivity_vs_angle", build_profile, angle_units)
 
-            mirror_energies = values[:, 0]
-            mirror_reflectivities = values[:, 1]
+    @classmethod
+    def get_reflectivity_vs_energy(cls, file_reflectivity, energy_units):
+        def build_profile(values):
+            mirror_energies       = values[:, 0].copy()
+            mirror_reflectivities = values[:, 1].copy()
 
             if energy_units == 1: mirror_energies *= 1e3 # KeV to eV
 
-            interpolated_weight_s = numpy.sqrt(numpy.interp(beam_energies,
-                                                            mirror_energies,
-                                                            mirror_reflectivities,
-                                                            left=mirror_reflectivities[0],
-                                                            right=mirror_reflectivities[-1]))
-            interpolated_weight_p = interpolated_weight_s
-
-        elif file_type == 2: # 2D Energy vs Angle vs Reflectivity
-            values = numpy.loadtxt(os.path.abspath(os.path.curdir + "/angle." +
-                                                   ("0" + str(input_beam._oe_number) if (input_beam._oe_number < 10) else
-                                                    str(input_beam._oe_number))))
+            return mirror_energies, mirror_reflectivities
 
-            beam_incident_angles = 90.0 - values[:, 1]
-
-            beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
-
-            values = numpy.loadtxt(os.path.abspath(os.path.abspath(file_reflectivity)  if file_reflectivity.startswith('/') else
-                                                   os.path.abspath(os.path.curdir + "/" + file_reflectivity)))
+        return cls.__get_cached_profile(file_reflectivity, "reflectivity_vs_energy", build_profile, energy_units)
 
+    @classmethod
+    def get_reflectivity_interpolators_2D(cls, file_reflectivity, angle_units, energy_units):
+        def build_profile(values):
             mirror_energies       = values[:, 0]
             mirror_grazing_angles = values[:, 1]
             mirror_energies         = numpy.unique(mirror_energies)
@@ -1229,37 +1666,55 @@ class ShadowPreProcessor:
             if angle_units  == 0: mirror_grazing_angles = numpy.degrees(1e-3 * mirror_grazing_angles)
             if energy_units == 1: mirror_energies *= 1e3 # KeV to eV
 
-            def get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities):
+            def get_interpolator_2D(mirror_reflectivities):
                 mirror_reflectivities = numpy.reshape(mirror_reflectivities, (mirror_energies.shape[0], mirror_grazing_angles.shape[0]))
 
-                interpolator = RectBivariateSpline(mirror_energies, mirror_grazing_angles, mirror_reflectivities, kx=2, ky=2)
-
-                interpolated_weight = numpy.zeros(beam_energies.shape[0])
-                for energy, angle, i in zip(beam_energies, beam_incident_angles, range(interpolated_weight.shape[0])):
-                    interpolated_weight[i] = numpy.sqrt(interpolator(energy, angle))
-                interpolated_weight[numpy.where(numpy.isnan(interpolated_weight))] = 0.0
-
-                return interpolated_weight
+                return RectBivariateSpline(mirror_energies, mirror_grazing_angles, mirror_reflectivities, kx=2, ky=2)
 
             if values.shape[1] == 3:
-                mirror_reflectivities = values[:, 2]
-
-                interpolated_weight_s = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities)
-                interpolated_weight_p = interpolated_weight_s
+                interpolator_s = get_interpolator_2D(values[:, 2])
+                interpolator_p = interpolator_s
             elif values.shape[1] == 4:
-                mirror_reflectivities_s = values[:, 2]
-                mirror_reflectivities_p = values[:, 3]
-
-                interpolated_weight_s = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_s)
-                interpolated_weight_p = get_interpolator_weight_2D(mirror_energies, mirror_grazing_angles, mirror_reflectivities_p)
+                interpolator_s = get_interpolator_2D(values[:, 2])
+                interpolator_p = get_interpolator_2D(values[:, 3])
             else:
                 raise ValueError("User input is inconsistent: not a 2D reflectivity profile")
 
+            return interpolator_s, interpolator_p
+
+        return cls.__get_cached_profile(file_reflectivity, "reflectivity_2D", build_profile, angle_units, energy_units)
+
+    @classmethod
+    def get_grating_efficiency(cls, grating_file_efficiency):
+        def build_profile(values):
+            grating_energies       = values[:, 0].copy()
+            grating_efficiencies_s = values[:, 1].copy()
+            grating_efficiencies_p = values[:, 2].copy() if values.shape[1] >= 3 else grating_efficiencies_s
+
+            return grating_energies, grating_efficiencies_s, grating_efficiencies_p
+
+        return cls.__get_cached_profile(grating_file_efficiency, "grating_efficiency", build_profile)
+
+    @classmethod
+    def __get_interpolated_weight(cls, x, profile_x, profile_y):
+        return numpy.sqrt(numpy.interp(x, profile_x, profile_y, left=profile_y[0], right=profile_y[-1]))
+
+    @classmethod
+    def __get_interpolated_weights(cls, x, profile_x, profile_y_s, profile_y_p):
+        interpolated_weight_s = cls.__get_interpolated_weight(x, profile_x, profile_y_s)
+        if profile_y_p is profile_y_s: interpolated_weight_p = interpolated_weight_s
+        else:                          interpolated_weight_p = cls.__get_interpolated_weight(x, profile_x, profile_y_p)
+
+        return interpolated_weight_s, interpolated_weight_p
+
+    @classmethod
+    def __apply_weights(cls, input_beam, interpolated_weight_s, interpolated_weight_p):
         output_beam = input_beam.duplicate()
+        output_beam.detach_rays()
 
-        output_beam._beam.rays[:, 6] = output_beam._beam.rays[:, 6] * interpolated_weight_s
-        output_beam._beam.rays[:, 7] = output_beam._beam.rays[:, 7] * interpolated_weight_s
-        output_beam._beam.rays[:, 8] = output_beam._beam.rays[:, 8] * interpolated_weight_s
+        output_beam._beam.rays[:, 6]  = output_beam._beam.rays[:, 6]  * interpolated_weight_s
+        output_beam._beam.rays[:, 7]  = output_beam._beam.rays[:, 7]  * interpolated_weight_s
+        output_beam._beam.rays[:, 8]  = output_beam._beam.rays[:, 8]  * interpolated_weight_s
         output_beam._beam.rays[:, 15] = output_beam._beam.rays[:, 15] * interpolated_weight_p
         output_beam._beam.rays[:, 16] = output_beam._beam.rays[:, 16] * interpolated_weight_p
         output_beam._beam.rays[:, 17] = output_beam._beam.rays[:, 17] * interpolated_weight_p
@@ -1267,43 +1722,74 @@ class ShadowPreProcessor:
         return output_beam
 
     @classmethod
-    def apply_user_grating_efficiency(cls, grating_file_efficiency, input_beam):
-        beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
+    def apply_user_diffraction_profile(cls, crystal, h, k, l, asymmetry_angle, file_diffraction_profile, input_beam):
+        beam_incident_angles = input_beam.get_incidence_angles()
+        beam_wavelengths     = ShadowPhysics.getWavelengthFromShadowK(input_beam._beam.rays[:, 10])
+        d_spacing            = xraylib.Crystal_dSpacing(xraylib.Crystal_GetCrystal(crystal), h, k, l)
+        bragg_angles         = numpy.degrees(numpy.arcsin(0.5*beam_wavelengths/d_spacing))
+        diffraction_angles   = 90 - (bragg_angles - asymmetry_angle)
+        delta_thetas         = diffraction_angles - beam_incident_angles
 
-        values = numpy.loadtxt(os.path.abspath(os.path.abspath(grating_file_efficiency) if grating_file_efficiency.startswith('/') else
-                                               os.path.abspath(os.path.curdir + "/" + grating_file_efficiency)))
+        crystal_delta_thetas, crystal_reflectivities_s, crystal_reflectivities_p = cls.get_diffraction_profile(file_diffraction_profile)
 
-        grating_energies     = values[:, 0]
-        grating_efficiencies_s = values[:, 1]
+        interpolated_weight_s, interpolated_weight_p = cls.__get_interpolated_weights(delta_thetas,
+                                                                                      crystal_delta_thetas,
+                                                                                      crystal_reflectivities_s,
+                                                                                      crystal_reflectivities_p)
 
-        interpolated_weight_s = numpy.sqrt(numpy.interp(beam_energies,
-                                                        grating_energies,
-                                                        grating_efficiencies_s,
-                                                        left=grating_efficiencies_s[0],
-                                                        right=grating_efficiencies_s[-1]))
+        return cls.__apply_weights(input_beam, interpolated_weight_s, interpolated_weight_p)
 
+    @classmethod
+    def apply_user_reflectivity(cls, file_type, angle_units, energy_units, file_reflectivity, input_beam):
+        if file_type == 0: # angle vs refl.
+            beam_incident_angles = 90.0 - input_beam.get_incidence_angles()
 
-        if values.shape[1] == 2: interpolated_weight_p = interpolated_weight_s
-        elif values.shape[1] >= 3:
-            grating_efficiencies_p = values[:, 2]
+            mirror_grazing_angles, mirror_reflectivities = cls.get_reflectivity_vs_angle(file_reflectivity, angle_units)
 
-            interpolated_weight_p = numpy.sqrt(numpy.interp(beam_energies,
-                                                            grating_energies,
-                                                            grating_efficiencies_p,
-                                                            left=grating_efficiencies_p[0],
-                                                            right=grating_efficiencies_p[-1]))
+            interpolated_weight_s = cls.__get_interpolated_weight(beam_incident_angles, mirror_grazing_angles, mirror_reflectivities)
+            interpolated_weight_p = interpolated_weight_s
 
+        elif file_type == 1: # Energy vs Refl.
+            beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
 
-        output_beam = input_beam.duplicate()
+            mirror_energies, mirror_reflectivities = cls.get_reflectivity_vs_energy(file_reflectivity, energy_units)
 
-        output_beam._beam.rays[:, 6] = output_beam._beam.rays[:, 6] * interpolated_weight_s
-        output_beam._beam.rays[:, 7] = output_beam._beam.rays[:, 7] * interpolated_weight_s
-        output_beam._beam.rays[:, 8] = output_beam._beam.rays[:, 8] * interpolated_weight_s
-        output_beam._beam.rays[:, 15] = output_beam._beam.rays[:, 15] * interpolated_weight_p
-        output_beam._beam.rays[:, 16] = output_beam._beam.rays[:, 16] * interpolated_weight_p
-        output_beam._beam.rays[:, 17] = output_beam._beam.rays[:, 17] * interpolated_weight_p
+            interpolated_weight_s = cls.__get_interpolated_weight(beam_energies, mirror_energies, mirror_reflectivities)
+            interpolated_weight_p = interpolated_weight_s
 
-        return output_beam
+        elif file_type == 2: # 2D Energy vs Angle vs Reflectivity
+            beam_incident_angles = 90.0 - input_beam.get_incidence_angles()
+
+            beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
+
+            interpolator_s, interpolator_p = cls.get_reflectivity_interpolators_2D(file_reflectivity, angle_units, energy_units)
+
+            def get_interpolator_weight_2D(interpolator):
+                # all the rays at once: ev() evaluates the spline on the (energy, angle) pairs
+                with numpy.errstate(invalid="ignore"):
+                    interpolated_weight = numpy.sqrt(interpolator.ev(beam_energies, beam_incident_angles))
+                interpolated_weight[numpy.where(numpy.isnan(interpolated_weight))] = 0.0
+
+                return interpolated_weight
+
+            interpolated_weight_s = get_interpolator_weight_2D(interpolator_s)
+            if interpolator_p is interpolator_s: interpolated_weight_p = interpolated_weight_s
+            else:                                interpolated_weight_p = get_interpolator_weight_2D(interpolator_p)
+
+        return cls.__apply_weights(input_beam, interpolated_weight_s, interpolated_weight_p)
+
+    @classmethod
+    def apply_user_grating_efficiency(cls, grating_file_efficiency, input_beam):
+        beam_energies = ShadowPhysics.getEnergyFromShadowK(input_beam._beam.rays[:, 10])
+
+        grating_energies, grating_efficiencies_s, grating_efficiencies_p = cls.get_grating_efficiency(grating_file_efficiency)
+
+        interpolated_weight_s, interpolated_weight_p = cls.__get_interpolated_weights(beam_energies,
+                                                                                      grating_energies,
+                                                                                      grating_efficiencies_s,
+                                                                                      grating_efficiencies_p)
+
+        return cls.__apply_weights(input_beam, interpolated_weight_s, interpolated_weight_p)
 
 class ShadowMath:
 
@@ -1625,6 +2111,156 @@ class ShadowPhysics:
         else:
             return int(round(background-noise, 0))
 
+####################################################################
+# MATERIAL PROPERTIES ON RAY ARRAYS: xraylib is sampled once on an
+# adaptive energy grid (per quantity, material and density, kept in
+# a LRU cache), the rays are evaluated by interpolation, all at once
+####################################################################
+
+class ShadowMaterialTables:
+    RELATIVE_TOLERANCE     = 1e-4 # interpolation error, checked in the middle of each interval of the grid
+    MINIMUM_RELATIVE_STEP  = 1e-7 # intervals are not refined below this width (absorption edges)
+    POINTS_PER_DECADE      = 20   # initial grid
+    EXACT_EVALUATION_LIMIT = 64   # up to this number of distinct energies xraylib is called on each of them
+    MAX_EXACT_VALUES       = 1024 # exact values kept for each table (LRU)
+
+    __tables = OrderedDict()
+    __MAX_TABLES = 32
+
+    @classmethod
+    def clear_cache(cls):
+        cls.__tables.clear()
+
+    @classmethod
+    def get_mass_attenuation_coefficient(cls, material, energy): # energy in eV, scalar or array
+        return cls.__evaluate(("CS_Total", material),
+                              lambda energy_in_eV: xraylib.CS_Total_CP(material, energy_in_eV/1000), # cm2/g
+                              energy)
+
+    @classmethod
+    def get_linear_absorption_coefficient(cls, material, density, energy): # energy in eV, density in g/cm3
+        return cls.get_mass_attenuation_coefficient(material, energy)*density # cm-1
+
+    @classmethod
+    def get_delta_beta(cls, material, density, energy): # energy in eV, density in g/cm3
+        delta = cls.__evaluate(("delta", material, density),
+                               lambda energy_in_eV: 1 - xraylib.Refractive_Index_Re(material, energy_in_eV/1000, density),
+                               energy)
+        beta  = cls.__evaluate(("beta", material, density),
+                               lambda energy_in_eV: xraylib.Refractive_Index_Im(material, energy_in_eV/1000, density),
+                               energy)
+
+        return delta, beta
+
+    @classmethod
+    def __evaluate(cls, key, function, energy):
+        try:
+            cls.__tables.move_to_end(key)
+            table = cls.__tables[key]
+        except KeyError:
+            table = _EnergyTable(function)
+
+            cls.__tables[key] = table
+            if len(cls.__tables) > cls.__MAX_TABLES: cls.__tables.popitem(last=False)
+
+        return table.evaluate(energy)
+
+class _EnergyTable:
+    def __init__(self, function):
+        self.__function = function
+        self.__values = OrderedDict() # exact values, by energy (LRU)
+        self.__grid_energies = None
+        self.__grid_values = None
+        self.__log_log = True
+
+    def evaluate(self, energy):
+        energy = numpy.asarray(energy, dtype=float)
+        result = numpy.full(energy.shape, numpy.nan)
+
+        valid = numpy.logical_and(numpy.isfinite(energy), energy > 0)
+        unique_energies, inverse = numpy.unique(energy[valid], return_inverse=True)
+
+        if len(unique_energies) == 0:
+            pass
+        elif len(unique_energies) <= ShadowMaterialTables.EXACT_EVALUATION_LIMIT:
+            result[valid] = numpy.array([self.__get_value(value) for value in unique_energies])[inverse]
+        else:
+            if self.__grid_energies is None:
+                self.__build_grid(unique_energies[0], unique_energies[-1])
+            elif unique_energies[0] < self.__grid_energies[0] or unique_energies[-1] > self.__grid_energies[-1]:
+                self.__build_grid(min(unique_energies[0], self.__grid_energies[0]), max(unique_energies[-1], self.__grid_energies[-1]))
+
+            if self.__log_log:
+                result[valid] = numpy.exp(numpy.interp(numpy.log(energy[valid]), numpy.log(self.__grid_energies), numpy.log(self.__grid_values)))
+            else:
+                result[valid] = numpy.interp(energy[valid], self.__grid_energies, self.__grid_values)
+
+        return result if result.ndim > 0 else result[()]
+
+    def __get_value(self, energy):
+        energy = float(energy)
+
+        try:
+            self.__values.move_to_end(energy)
+            return self.__values[energy]
+        except KeyError:
+            value = self.__values[energy] = float(self.__function(energy))
+            if len(self.__values) > ShadowMaterialTables.MAX_EXACT_VALUES: self.__values.popitem(last=False)
+
+            return value
+
+    def __get_grid_value(self, grid, energy):
+        energy = float(energy)
+
+        try:
+            return grid[energy]
+        except KeyError:
+            value = grid[energy] = float(self.__function(energy))
+
+            return value
+
+    @classmethod
+    def __interpolate(cls, energy_0, value_0, energy_1, value_1, energy):
+        if value_0 > 0 and value_1 > 0: # power law between two points (absorption, refraction)
+            return value_0*numpy.exp(numpy.log(value_1/value_0)*numpy.log(energy/energy_0)/numpy.log(energy_1/energy_0))
+        else:
+            return value_0 + (value_1 - value_0)*(energy - energy_0)/(energy_1 - energy_0)
+
+    def __build_grid(self, minimum_energy, maximum_energy):
+        # initial grid aligned on a fixed logarithmic scale, so the points are reused when the range is extended
+        points_per_decade = ShadowMaterialTables.POINTS_PER_DECADE
+
+        indexes = numpy.arange(numpy.floor(numpy.log10(minimum_energy)*points_per_decade),
+                               numpy.ceil(numpy.log10(maximum_energy)*points_per_decade) + 1)
+        energies = 10**(indexes/points_per_decade)
+
+        # grid values apart from the exact ones: the current grid points are reused, the exact values are not
+        if self.__grid_energies is None: grid = {}
+        else:                            grid = dict(zip(self.__grid_energies.tolist(), self.__grid_values.tolist()))
+
+        intervals = [(energies[index], energies[index + 1]) for index in range(len(energies) - 1)]
+
+        # bisection of the intervals where the interpolation in the middle is not accurate enough
+        while len(intervals) > 0:
+            energy_0, energy_1 = intervals.pop()
+
+            value_0 = self.__get_grid_value(grid, energy_0)
+            value_1 = self.__get_grid_value(grid, energy_1)
+
+            if energy_1 - energy_0 > ShadowMaterialTables.MINIMUM_RELATIVE_STEP*energy_0:
+                energy = numpy.sqrt(energy_0*energy_1)
+                value  = self.__get_grid_value(grid, energy)
+
+                if numpy.abs(self.__interpolate(energy_0, value_0, energy_1, value_1, energy) - value) > ShadowMaterialTables.RELATIVE_TOLERANCE*numpy.abs(value):
+                    intervals.append((energy_0, energy))
+                    intervals.append((energy, energy_1))
+
+        grid_energies = numpy.array(sorted(grid.keys()))
+
+        self.__grid_energies = grid_energies
+        self.__grid_values = numpy.array([grid[energy] for energy in grid_energies])
+        self.__log_log = numpy.all(self.__grid_values > 0)
+
 import re
 import time
 
@@ -0,0 +1,599 @@
+#
+# Tests of the ShadowBeam operations done in numpy instead of the Shadow tracer
+#
+
+import unittest
+import os
+import tempfile
+import numpy
+
+from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowSource, ShadowOpticalElement, ShadowFreeSpaceElement, ShadowBeamAccumulator, ShadowOEHistoryItem, ShadowBeamFile, ShadowCompactRays
+from orangecontrib.shadow.util.shadow_util import ShadowBeamAnalysis
+
+#
+# Auxiliary functions
+#
+
+def _create_source_beam(number_of_rays=5000, seed=6775431):
+    shadow_src = ShadowSource.create_src()
+    shadow_src.src.NPOINT = number_of_rays
+    shadow_src.src.ISTAR1 = seed
+
+    return ShadowBeam.traceFromSource(shadow_src, history=True)
+
+def _create_beam(number_of_rays=1000, seed=1234567):
+    random_generator = numpy.random.default_rng(seed)
+
+    shadow_beam = ShadowBeam()
+    shadow_beam._beam.rays = random_generator.normal(size=(number_of_rays, 18))
+    shadow_beam._beam.rays[:, 9]  = numpy.where(random_generator.random(number_of_rays) < 0.8, 1.0, -11.0)
+    shadow_beam._beam.rays[:, 10] = random_generator.uniform(50000.0, 51000.0, number_of_rays)
+    shadow_beam._beam.rays[:, 11] = numpy.arange(1, number_of_rays + 1)
+
+    return shadow_beam
+
+def _create_beam_with_history(oe_number=2, seed=1234567): # a beam after oe_number O.E.s, with the input beams of each O.E. in the history
+    shadow_beam = _create_beam(seed=seed)
+    shadow_beam.history = [ShadowOEHistoryItem()]
+
+    for index in range(1, oe_number + 1):
+        output_beam = _create_beam(number_of_rays=1000 + 100*index, seed=seed + index)
+        output_beam._oe_number = index
+        output_beam.history = shadow_beam.history + [ShadowOEHistoryItem(oe_number=index, input_beam=shadow_beam)]
+
+        shadow_beam = output_beam
+
+    return shadow_beam
+
+def _good_rays_beam(shadow_beam):
+    good_rays_beam = shadow_beam.duplicate()
+    good_rays_beam._beam.rays = shadow_beam._beam.rays[shadow_beam._beam.rays[:, 9] > 0]
+
+    return good_rays_beam
+
+def _merge_beams(beams, which_flux=3, merge_history=1): # fold of the two beams merge, as done by the accumulating widgets before
+    merged_beam = beams[0]
+    for shadow_beam in beams[1:]:
+        merged_beam = ShadowBeam.mergeBeams(merged_beam, shadow_beam, which_flux=which_flux, merge_history=merge_history)
+
+    return merged_beam
+
+def _good_rays_intensity(rays):
+    good_rays = rays[rays[:, 9] > 0]
+
+    return numpy.sum(good_rays[:, [6, 7, 8, 15, 16, 17]]**2) # column 23
+
+#
+# Tests
+#
+
+class TestCopyOnWrite(unittest.TestCase):
+
+    def test_owner_rays_not_changed_by_sharing(self):
+        shadow_beam = _create_beam()
+        rays = shadow_beam._beam.rays
+
+        next_beam = ShadowBeam.initializeFromPreviousBeam(shadow_beam)
+
+        self.assertIs(shadow_beam._beam.rays, rays)
+        self.assertTrue(rays.flags.writeable)
+        self.assertTrue(next_beam.is_rays_shared())
+        self.assertTrue(numpy.shares_memory(next_beam._beam.rays, rays))
+
+        rays[0, 0] = 1.0 # the owner still writes in place
+
+        next_rays = next_beam.detach_rays()
+        next_rays[0, 0] = 2.0
+
+        self.assertFalse(numpy.shares_memory(next_rays, rays))
+        self.assertTrue(next_rays.flags.c_contiguous)
+        self.assertEqual(rays[0, 0], 1.0)
+
+    def test_analysis_of_a_traced_beam_shared(self):
+        traced_beam = ShadowBeam.traceFreeSpace(_create_beam(), 10.0, history=False)
+
+        analysis = ShadowBeamAnalysis.get_analysis(traced_beam._beam)
+
+        self.assertIs(ShadowBeamAnalysis.get_analysis(traced_beam._beam), analysis) # e.g. many plot widgets
+        self.assertIs(ShadowBeamAnalysis.get_analysis(traced_beam.duplicate(share_rays=True)._beam), analysis)
+
+        traced_beam.detach_rays() # not shared: modified in place
+
+        self.assertIsNot(ShadowBeamAnalysis.get_analysis(traced_beam._beam), analysis)
+
+    def test_duplicate_is_private(self):
+        shadow_beam = _create_beam()
+
+        duplicate_beam = shadow_beam.duplicate()
+
+        self.assertFalse(duplicate_beam.is_rays_shared())
+        self.assertFalse(numpy.shares_memory(duplicate_beam._beam.rays, shadow_beam._beam.rays))
+
+
+class TestPropagateRays(unittest.TestCase):
+
+    def test_propagate_rays(self):
+        rays = numpy.zeros((5, 18))
+        rays[:, 0]  = [1.0, 1.0, 1.0, 1.0, 1.0]     # X
+        rays[:, 1]  = [0.0, 0.0, 0.0, 0.0, 0.0]     # Y
+        rays[:, 3]  = [0.6, 0.6, 1.0, 0.6, 0.6]     # vx
+        rays[:, 4]  = [0.8, -0.8, 0.0, 0.8, 0.8]    # vy
+        rays[:, 9]  = [1.0, 1.0, 1.0, -11.0, -2.0e6] # flags
+        rays[:, 12] = 5.0                            # optical path
+
+        ShadowBeam.propagate_rays(rays, 8.0)
+
+        numpy.testing.assert_array_equal(rays[:, 9], [1.0, 1.0, -3.0e6, -11.0, -2.0e6])
+        numpy.testing.assert_allclose(rays[:, 0], [7.0, -5.0, 1.0, 7.0, 1.0])
+        numpy.testing.assert_allclose(rays[:, 1], [0.0, 0.0, 0.0, 0.0, 0.0])
+        numpy.testing.assert_allclose(rays[:, 12], [15.0, 15.0, 5.0, 15.0, 5.0])
+        self.assertTrue(numpy.all(numpy.isfinite(rays)))
+
+    def test_propagate_beam_rays(self):
+        shadow_beam = _create_beam()
+        rays = shadow_beam._beam.rays.copy()
+
+        traced_beam = ShadowBeam.traceFreeSpace(shadow_beam, 10.0, history=False)
+        traced_rays = traced_beam._beam.rays
+
+        path = (10.0 - rays[:, 1]) / rays[:, 4]
+
+        numpy.testing.assert_array_equal(traced_rays[:, 9], rays[:, 9]) # lost rays (-11) moved as the good ones
+        numpy.testing.assert_allclose(traced_rays[:, 0], rays[:, 0] + path * rays[:, 3])
+        numpy.testing.assert_allclose(traced_rays[:, 2], rays[:, 2] + path * rays[:, 5])
+        numpy.testing.assert_allclose(traced_rays[:, 12], rays[:, 12] + numpy.abs(path))
+        numpy.testing.assert_array_equal(traced_rays[:, 1], 0.0)
+        numpy.testing.assert_array_equal(shadow_beam._beam.rays, rays) # input beam unchanged
+
+
+class TestFreeSpace(unittest.TestCase):
+
+    def setUp(self):
+        self.__current_directory = os.getcwd()
+        self.__working_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.__working_directory.name)
+
+    def tearDown(self):
+        os.chdir(self.__current_directory)
+        self.__working_directory.cleanup()
+
+    def test_propagate_rays_as_shadow_empty_element(self):
+        for distance in [0.0, 25.0, -3.5, 1000.0]:
+            source_beam = _create_source_beam()
+
+            free_space_oe = ShadowOpticalElement.create_free_space_oe(distance)
+            self.assertIsInstance(free_space_oe, ShadowFreeSpaceElement)
+
+            shadow_beam = ShadowBeam.traceFromOE(source_beam, free_space_oe, history=False)
+            numpy_beam  = ShadowBeam.traceFreeSpace(source_beam, distance, history=False)
+
+            shadow_rays = shadow_beam._beam.rays
+            numpy_rays  = numpy_beam._beam.rays
+
+            self.assertEqual(shadow_rays.shape, numpy_rays.shape)
+            numpy.testing.assert_array_equal(numpy_rays[:, 9], shadow_rays[:, 9]) # flags
+            for column in [0, 1, 2, 3, 4, 5, 12]: # positions, directions, optical path
+                numpy.testing.assert_allclose(numpy_rays[:, column], shadow_rays[:, column], rtol=1e-9, atol=1e-12)
+            numpy.testing.assert_array_equal(numpy_rays[:, 10], shadow_rays[:, 10]) # wavenumber
+
+    def test_free_space_history_rebuilt_in_reference_mode(self):
+        history_mode = ShadowBeam.history_mode
+        try:
+            ShadowBeam.set_history_mode(ShadowBeam.HISTORY_INPUT_BEAM_REFERENCE)
+
+            source_beam = _create_source_beam()
+            beam_1 = ShadowBeam.traceFreeSpace(source_beam, 10.0, history=True)
+            beam_2 = ShadowBeam.traceFreeSpace(beam_1, 5.0, history=True)
+
+            self.assertIsInstance(beam_2.getOEHistory(2)._shadow_oe_start, ShadowFreeSpaceElement)
+            self.assertTrue(beam_2.getOEHistory(2).has_input_beam_reference())
+
+            rebuilt_beam = beam_2.getOEHistory(2)._input_beam # raises if the content hash does not match
+
+            numpy.testing.assert_array_equal(rebuilt_beam._beam.rays, beam_1._beam.rays)
+        finally:
+            ShadowBeam.set_history_mode(history_mode)
+
+class TestAngles(unittest.TestCase):
+
+    def setUp(self):
+        self.__current_directory = os.getcwd()
+        self.__working_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.__working_directory.name)
+
+    def tearDown(self):
+        os.chdir(self.__current_directory)
+        self.__working_directory.cleanup()
+
+    def __trace_with_angles(self, source_beam, distance):
+        shadow_oe = ShadowOpticalElement.create_free_space_oe(distance)
+        shadow_oe._oe.F_ANGLE = 1
+
+        return ShadowBeam.traceFromOE(source_beam, shadow_oe, history=False)
+
+    def test_angles_read_from_the_traced_file(self):
+        shadow_beam = self.__trace_with_angles(_create_source_beam(), 10.0)
+
+        angles = shadow_beam.get_angles()
+
+        self.assertEqual(angles.shape[0], shadow_beam.get_number_of_rays())
+        numpy.testing.assert_array_equal(angles, ShadowBeam.read_angle_file("angle.01"))
+        self.assertIs(shadow_beam.duplicate().get_angles(), angles)
+
+    def test_angles_kept_in_memory(self):
+        source_beam = _create_source_beam()
+
+        shadow_beam_1 = self.__trace_with_angles(source_beam, 10.0)
+        shadow_beam_1_copy = shadow_beam_1.duplicate()
+        angles = shadow_beam_1.get_angles().copy()
+
+        self.__trace_with_angles(source_beam, 20.0) # another O.E. number 1, same directory
+        os.remove("angle.01")
+
+        numpy.testing.assert_array_equal(shadow_beam_1.get_angles(), angles)
+        numpy.testing.assert_array_equal(shadow_beam_1_copy.get_angles(), angles)
+
+    def test_read_angle_file(self):
+        angles = numpy.array([[1, 89.5, 89.5, 1], [2, 89.25, 89.75, -11], [3, 88.0, 88.0, 1]])
+        numpy.savetxt("angle.03", angles, fmt="%d %.6f %.6f %d")
+
+        numpy.testing.assert_array_equal(ShadowBeam.read_angle_file("angle.03"), angles) # relative to the working directory
+        numpy.testing.assert_array_equal(ShadowBeam.read_angle_file(os.path.abspath("angle.03")), angles)
+        self.assertRaises(Exception, ShadowBeam.read_angle_file, "angle.04")
+
+    def test_no_angles_without_angle_file(self):
+        shadow_beam = ShadowBeam.traceFromOE(_create_source_beam(), ShadowOpticalElement.create_free_space_oe(10.0), history=False)
+
+        self.assertRaises(Exception, shadow_beam.get_angles)
+
+class TestBeamAccumulator(unittest.TestCase):
+
+    def __create_beams(self):
+        beams = [_create_beam(number_of_rays, seed) for number_of_rays, seed in [(1000, 11), (700, 12), (1300, 13)]]
+        for index, shadow_beam in enumerate(beams): shadow_beam.set_initial_flux(1e12*(index + 1))
+
+        return beams
+
+    def __accumulate(self, beams, which_flux=3, good_only=False):
+        accumulator = ShadowBeamAccumulator(which_flux=which_flux, merge_history=0)
+        for shadow_beam in beams: accumulator.append(shadow_beam, good_only=good_only)
+
+        return accumulator
+
+    def test_as_merged_beams(self):
+        for which_flux in [1, 2, 3]:
+            beams = self.__create_beams()
+            rays = [shadow_beam._beam.rays.copy() for shadow_beam in beams]
+
+            accumulator = self.__accumulate(beams, which_flux=which_flux)
+            accumulated_beam = accumulator.get_accumulated_beam()
+            merged_beam = _merge_beams(beams, which_flux=which_flux, merge_history=0)
+
+            numpy.testing.assert_array_equal(accumulated_beam._beam.rays, merged_beam._beam.rays)
+            numpy.testing.assert_array_equal(accumulated_beam._beam.rays[:, 11], numpy.arange(1, 3001)) # ray index renumbered
+            self.assertEqual(accumulated_beam.get_initial_flux(), merged_beam.get_initial_flux())
+            self.assertEqual(accumulator.get_number_of_rays(), 3000)
+            self.assertEqual(accumulator.get_number_of_rays(nolost=1), numpy.count_nonzero(merged_beam._beam.rays[:, 9] > 0))
+            self.assertEqual(accumulator.get_number_of_rays(nolost=2), numpy.count_nonzero(merged_beam._beam.rays[:, 9] < 0))
+
+            for shadow_beam, original_rays in zip(beams, rays): # input beams not renumbered
+                numpy.testing.assert_array_equal(shadow_beam._beam.rays, original_rays)
+
+    def test_good_only(self):
+        beams = self.__create_beams()
+
+        accumulator = self.__accumulate(beams, good_only=True)
+        accumulated_beam = accumulator.get_accumulated_beam()
+        merged_beam = _merge_beams([_good_rays_beam(shadow_beam) for shadow_beam in beams], merge_history=0)
+
+        numpy.testing.assert_array_equal(accumulated_beam._beam.rays, merged_beam._beam.rays)
+        self.assertTrue(numpy.all(accumulated_beam._beam.rays[:, 9] > 0))
+        numpy.testing.assert_array_equal(accumulated_beam._beam.rays[:, 11], numpy.arange(1, len(merged_beam._beam.rays) + 1))
+        self.assertEqual(accumulator.get_number_of_rays(), accumulator.get_number_of_rays(nolost=1))
+        self.assertEqual(accumulator.get_number_of_rays(nolost=2), 0)
+
+    def test_intensity(self):
+        for good_only in [False, True]:
+            beams = self.__create_beams()
+
+            accumulator = self.__accumulate(beams, good_only=good_only)
+            merged_beam = _merge_beams(beams, merge_history=0)
+
+            self.assertAlmostEqual(accumulator.get_intensity(), _good_rays_intensity(merged_beam._beam.rays), delta=1e-9*accumulator.get_intensity())
+
+    def test_accumulated_beam_is_private(self):
+        accumulator = self.__accumulate(self.__create_beams())
+
+        accumulated_beam = accumulator.get_accumulated_beam()
+        accumulated_rays = accumulated_beam._beam.rays.copy()
+        accumulated_beam._beam.rays[:, 0] = 0.0
+
+        numpy.testing.assert_array_equal(accumulator.get_accumulated_beam()._beam.rays, accumulated_rays)
+
+    def test_reset(self):
+        accumulator = self.__accumulate(self.__create_beams())
+
+        accumulator.reset()
+
+        self.assertTrue(accumulator.is_empty())
+        self.assertIsNone(accumulator.get_accumulated_beam())
+        self.assertEqual(accumulator.get_number_of_rays(), 0)
+        self.assertEqual(accumulator.get_number_of_rays(nolost=1), 0)
+        self.assertEqual(accumulator.get_intensity(), 0.0)
+
+        beams = [_create_beam(500, 21), _create_beam(400, 22)]
+        for shadow_beam in beams: accumulator.append(shadow_beam)
+
+        merged_beam = _merge_beams(beams, merge_history=0)
+
+        numpy.testing.assert_array_equal(accumulator.get_accumulated_beam()._beam.rays, merged_beam._beam.rays) # numbering restarted from 1
+        self.assertEqual(accumulator.get_number_of_rays(), 900)
+        self.assertAlmostEqual(accumulator.get_intensity(), _good_rays_intensity(merged_beam._beam.rays), delta=1e-9*accumulator.get_intensity())
+
+class TestMergeBeams(unittest.TestCase):
+
+    def test_weights(self):
+        beams   = [_create_beam(1000, 31), _create_beam(600, 32), _create_beam(1200, 33)]
+        weights = [1.0, 4.0, 0.25]
+        rays    = [shadow_beam._beam.rays.copy() for shadow_beam in beams]
+
+        merged_beam = ShadowBeam.mergeBeamsList(beams, weights=weights, merge_history=0)
+
+        weighted_beams = [shadow_beam.duplicate() for shadow_beam in beams]
+        for weighted_beam, weight in zip(weighted_beams, weights):
+            weighted_beam._beam.rays[:, [6, 7, 8, 15, 16, 17]] *= numpy.sqrt(weight) # As, Ap
+
+        numpy.testing.assert_allclose(merged_beam._beam.rays, _merge_beams(weighted_beams, merge_history=0)._beam.rays, rtol=1e-15)
+        self.assertAlmostEqual(_good_rays_intensity(merged_beam._beam.rays),
+                               sum([weight*_good_rays_intensity(shadow_beam._beam.rays) for shadow_beam, weight in zip(beams, weights)]),
+                               delta=1e-9*_good_rays_intensity(merged_beam._beam.rays))
+
+        for shadow_beam, original_rays in zip(beams, rays): # input beams not changed
+            numpy.testing.assert_array_equal(shadow_beam._beam.rays, original_rays)
+
+        self.assertRaises(ValueError, ShadowBeam.mergeBeamsList, beams, weights=[1.0, 2.0])
+
+    def test_flux(self):
+        for which_flux in [1, 2, 3]:
+            for fluxes in [[1e12, 2e12, 3e12], [1e12, None, 3e12], [None, 2e12, 3e12]]:
+                beams = [_create_beam(500, 41), _create_beam(400, 42), _create_beam(300, 43)]
+                for shadow_beam, flux in zip(beams, fluxes): shadow_beam.set_initial_flux(flux)
+
+                merged_beam = ShadowBeam.mergeBeamsList(beams, which_flux=which_flux, merge_history=0)
+
+                numpy.testing.assert_array_equal(merged_beam._beam.rays, _merge_beams(beams, which_flux=which_flux, merge_history=0)._beam.rays)
+                numpy.testing.assert_array_equal(merged_beam._beam.rays[:, 11], numpy.arange(1, 1201))
+                self.assertEqual(merged_beam.get_initial_flux(), _merge_beams(beams, which_flux=which_flux, merge_history=0).get_initial_flux())
+
+    def test_history(self):
+        for merge_history in [1, 2]:
+            beams = [_create_beam_with_history(seed=seed) for seed in [51, 61, 71]]
+
+            beam_1_history = list(beams[0].history)
+            beam_1_input_beams = [history_item._input_beam for history_item in beam_1_history]
+
+            merged_beam = ShadowBeam.mergeBeamsList(beams, merge_history=merge_history)
+            folded_beam = _merge_beams(beams, merge_history=merge_history)
+
+            self.assertEqual(len(merged_beam.history), 3)
+            for index in [1, 2]:
+                merged_input_beam = merged_beam.getOEHistory(index)._input_beam
+
+                self.assertIsNot(merged_beam.getOEHistory(index), beams[0].getOEHistory(index)) # duplicated history items
+                numpy.testing.assert_array_equal(merged_input_beam._beam.rays, folded_beam.getOEHistory(index)._input_beam._beam.rays)
+                self.assertEqual(len(merged_input_beam._beam.rays), sum([len(shadow_beam.getOEHistory(index)._input_beam._beam.rays) for shadow_beam in beams]))
+
+            if merge_history == 2: # input beams merged with their own history
+                numpy.testing.assert_array_equal(merged_beam.getOEHistory(2)._input_beam.getOEHistory(1)._input_beam._beam.rays,
+                                                 merged_beam.getOEHistory(1)._input_beam._beam.rays)
+
+            # history of beam_1 not changed by the merge
+            self.assertEqual(len(beams[0].history), len(beam_1_history))
+            for history_item, original_history_item, original_input_beam in zip(beams[0].history, beam_1_history, beam_1_input_beams):
+                self.assertIs(history_item, original_history_item)
+                self.assertIs(history_item._input_beam, original_input_beam)
+
+    def test_history_not_merged(self):
+        beams = [_create_beam_with_history(seed=51), _create_beam_with_history(seed=61)]
+
+        merged_beam = ShadowBeam.mergeBeamsList(beams, merge_history=0)
+
+        self.assertIs(merged_beam.getOEHistory(1)._input_beam, beams[0].getOEHistory(1)._input_beam)
+        self.assertRaises(ValueError, ShadowBeam.mergeBeamsList, [beams[0], _create_beam_with_history(oe_number=1)], merge_history=1)
+        self.assertRaises(ValueError, ShadowBeam.mergeBeamsList, [beams[0], _create_beam()], merge_history=1)
+
+class TestBeamFile(unittest.TestCase):
+
+    def setUp(self):
+        self.__current_directory = os.getcwd()
+        self.__working_directory = tempfile.TemporaryDirectory()
+        os.chdir(self.__working_directory.name)
+
+    def tearDown(self):
+        os.chdir(self.__current_directory)
+        self.__working_directory.cleanup()
+
+    def __create_beam(self):
+        shadow_beam = _create_beam()
+        shadow_beam._oe_number = 3
+        shadow_beam.set_initial_flux(2.5e12)
+        shadow_beam.setScanningData(ShadowBeam.ScanningData("T_IMAGE", 1250.0, "Image Distance", "[cm]", {"start" : 1000.0, "stop" : 1500.0}))
+
+        return shadow_beam
+
+    def test_write_read(self):
+        shadow_beam = self.__create_beam()
+        self.assertTrue(ShadowBeamFile.is_columnar_file("beam.h5"))
+        ShadowBeamFile.write("beam.h5", shadow_beam)
+
+        for memory_map in [True, False]:
+            read_beam = ShadowBeam()
+            ShadowBeamFile.read("beam.h5", read_beam, memory_map=memory_map)
+
+            numpy.testing.assert_array_equal(read_beam._beam.rays, shadow_beam._beam.rays)
+            self.assertEqual(read_beam._beam.rays.dtype, numpy.float64)
+            self.assertEqual(read_beam.get_initial_flux(), 2.5e12)
+
+            scanning_data = read_beam.scanned_variable_data
+            self.assertEqual(scanning_data.get_scanned_variable_name(), "T_IMAGE")
+            self.assertEqual(scanning_data.get_scanned_variable_value(), 1250.0)
+            self.assertEqual(scanning_data.get_scanned_variable_display_name(), "Image Distance")
+            self.assertEqual(scanning_data.get_scanned_variable_um(), "[cm]")
+            self.assertEqual(scanning_data.get_additional_parameters(), {"start" : 1000.0, "stop" : 1500.0})
+
+    def test_memory_mapped_rays_are_private(self):
+        shadow_beam = self.__create_beam()
+        shadow_beam.writeToFile("beam.h5")
+
+        read_beam = ShadowBeam()
+        read_beam.loadFromFile("beam.h5")
+
+        self.assertTrue(read_beam._beam.rays.flags.writeable)
+        read_beam._beam.rays[:, 0] = 0.0 # copy-on-write: the file is not changed
+
+        read_beam = ShadowBeam()
+        read_beam.loadFromFile("beam.h5")
+
+        numpy.testing.assert_array_equal(read_beam._beam.rays, shadow_beam._beam.rays)
+
+    def test_read_columns(self):
+        shadow_beam = self.__create_beam()
+        ShadowBeamFile.write("beam.h5", shadow_beam)
+
+        columns = ShadowBeamFile.read_columns("beam.h5", [1, 3, 10, 12])
+
+        self.assertEqual(sorted(columns.keys()), [1, 3, 10, 12])
+        for column in [1, 3, 10, 12]:
+            numpy.testing.assert_array_equal(columns[column], shadow_beam._beam.rays[:, column - 1])
+
+    def test_read_metadata(self):
+        ShadowBeamFile.write("beam.h5", self.__create_beam())
+
+        metadata = ShadowBeamFile.read_metadata("beam.h5")
+
+        self.assertEqual(metadata["oe_number"], 3)
+        self.assertEqual(metadata["number_of_rays"], 1000)
+        self.assertEqual(metadata["initial_flux"], 2.5e12)
+        self.assertEqual(metadata["scanned_variable_name"], "T_IMAGE")
+        self.assertEqual(metadata["scanned_variable_value"], 1250.0)
+
+    def test_no_flux_no_scanning_data(self):
+        ShadowBeamFile.write("beam.h5", _create_beam())
+
+        read_beam = ShadowBeam()
+        ShadowBeamFile.read("beam.h5", read_beam)
+
+        self.assertIsNone(read_beam.get_initial_flux())
+        self.assertIsNone(read_beam.scanned_variable_data)
+        self.assertNotIn("initial_flux", ShadowBeamFile.read_metadata("beam.h5"))
+
+class TestColumnProjection(unittest.TestCase):
+
+    def test_get_column(self):
+        shadow_beam = _create_beam()
+
+        column = shadow_beam.get_column(11)
+
+        numpy.testing.assert_array_equal(column, shadow_beam._beam.rays[:, 10])
+        self.assertTrue(numpy.shares_memory(column, shadow_beam._beam.rays)) # a view, nothing copied
+        self.assertFalse(column.flags.writeable)
+        self.assertTrue(shadow_beam._beam.rays.flags.writeable)
+
+    def test_get_columns(self):
+        shadow_beam = _create_beam()
+        selection = shadow_beam._beam.rays[:, 9] > 0
+
+        columns = shadow_beam.get_columns([1, 3, 11])
+        numpy.testing.assert_array_equal(columns, shadow_beam._beam.rays[:, [0, 2, 10]])
+
+        columns = shadow_beam.get_columns([1, 3, 11], selection=selection)
+        numpy.testing.assert_array_equal(columns, shadow_beam._beam.rays[selection][:, [0, 2, 10]])
+        self.assertFalse(numpy.shares_memory(columns, shadow_beam._beam.rays))
+
+    def test_select_rays(self):
+        for share_rays in [False, True]:
+            shadow_beam = _create_beam()
+            if share_rays: shadow_beam = shadow_beam.duplicate(share_rays=True) # read-only rays
+            rays = shadow_beam._beam.rays.copy()
+
+            for selection in [rays[:, 9] > 0, numpy.array([4, 2, 999, 0])]:
+                selected_rays = shadow_beam.select_rays(selection, renumber=True)
+
+                numpy.testing.assert_array_equal(selected_rays[:, 11], numpy.arange(1, len(selected_rays) + 1))
+                numpy.testing.assert_array_equal(selected_rays[:, :11], rays[selection][:, :11])
+                self.assertFalse(numpy.shares_memory(selected_rays, shadow_beam._beam.rays)) # private copy
+                self.assertTrue(selected_rays.flags.writeable)
+
+                selected_rays[:, 0] = 0.0
+                numpy.testing.assert_array_equal(shadow_beam._beam.rays, rays) # the beam is not changed, ray index included
+
+            numpy.testing.assert_array_equal(shadow_beam.select_rays(rays[:, 9] < 0), rays[rays[:, 9] < 0]) # ray index kept
+
+class TestCompactRays(unittest.TestCase):
+
+    def test_column_types(self):
+        for column in [1, 2, 3, 4, 5, 6, 11, 13]: # positions, directions, wavenumber, optical path
+            self.assertEqual(ShadowCompactRays.COLUMN_TYPES[column - 1], numpy.float64)
+        for column in [10, 12]: # flag, ray index
+            self.assertEqual(ShadowCompactRays.COLUMN_TYPES[column - 1], numpy.int32)
+
+    def test_round_trip(self):
+        rays = _create_beam()._beam.rays
+        rays[:3, 9] = [-3.0e6, -1.1e4, 0.0] # lost rays codes
+
+        compact_rays = ShadowCompactRays(rays)
+        compact_rays_as_rays = compact_rays.get_rays()
+
+        self.assertEqual(len(compact_rays), 1000)
+        self.assertEqual(compact_rays_as_rays.dtype, numpy.float64)
+        for column in [1, 2, 3, 4, 5, 6, 10, 11, 12, 13]: # exact
+            self.assertEqual(compact_rays.get_column(column).dtype, ShadowCompactRays.COLUMN_TYPES[column - 1])
+            numpy.testing.assert_array_equal(compact_rays_as_rays[:, column - 1], rays[:, column - 1])
+        for column in [7, 8, 9, 14, 15, 16, 17, 18]: # float32
+            numpy.testing.assert_allclose(compact_rays_as_rays[:, column - 1], rays[:, column - 1], rtol=1e-6)
+
+    def test_selection(self):
+        rays = _create_beam()._beam.rays
+        selection = rays[:, 9] > 0
+
+        numpy.testing.assert_array_equal(ShadowCompactRays(rays, selection=selection).get_rays()[:, :6], rays[selection, :6])
+        numpy.testing.assert_array_equal(ShadowCompactRays(rays, selection=selection).get_column(12), rays[selection, 11])
+
+    def test_concatenate_rays(self):
+        rays_list = [_create_beam(number_of_rays, seed)._beam.rays for number_of_rays, seed in [(100, 81), (0, 82), (250, 83)]]
+
+        rays = ShadowCompactRays.concatenate_rays([ShadowCompactRays(rays) for rays in rays_list])
+
+        self.assertEqual(rays.shape, (350, 18))
+        numpy.testing.assert_array_equal(rays[:, [9, 10, 11]], numpy.concatenate(rays_list)[:, [9, 10, 11]])
+
+    def test_compact_accumulation(self):
+        storage_mode = ShadowBeam.storage_mode
+        try:
+            beams = [_create_beam(1000, 91), _create_beam(500, 92)]
+
+            full_accumulator = ShadowBeamAccumulator(merge_history=0)
+            for shadow_beam in beams: full_accumulator.append(shadow_beam)
+
+            ShadowBeam.set_storage_mode(ShadowBeam.STORAGE_COMPACT)
+
+            compact_accumulator = ShadowBeamAccumulator(merge_history=0)
+            for shadow_beam in beams: compact_accumulator.append(shadow_beam)
+
+            ShadowBeam.set_storage_mode(ShadowBeam.STORAGE_FULL) # storage decided at the first beam
+
+            compact_accumulator.append(_create_beam(200, 93))
+            full_accumulator.append(_create_beam(200, 93))
+
+            full_rays    = full_accumulator.get_accumulated_beam()._beam.rays
+            compact_rays = compact_accumulator.get_accumulated_beam()._beam.rays
+
+            self.assertEqual(compact_rays.dtype, numpy.float64)
+            numpy.testing.assert_array_equal(compact_rays[:, [0, 1, 2, 3, 4, 5, 9, 10, 11, 12]], full_rays[:, [0, 1, 2, 3, 4, 5, 9, 10, 11, 12]])
+            numpy.testing.assert_allclose(compact_rays, full_rays, rtol=1e-6)
+            self.assertEqual(compact_accumulator.get_intensity(), full_accumulator.get_intensity()) # from the input beams
+        finally:
+            ShadowBeam.set_storage_mode(storage_mode)
+
+if __name__ == "__main__":
+    unittest.main()
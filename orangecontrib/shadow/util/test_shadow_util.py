@@ -0,0 +1,171 @@
+#
+# Tests of the numpy analysis of the Shadow beams
+#
+
+import unittest
+import numpy
+
+import Shadow
+
+from orangecontrib.shadow.util.shadow_util import ShadowBeamAnalysis, ShadowHistogram
+
+#
+# Auxiliary functions
+#
+
+def _create_beam(number_of_rays=10000, seed=1234567):
+    random_generator = numpy.random.default_rng(seed)
+
+    beam = Shadow.Beam(N=number_of_rays)
+    beam.rays[:, 0:3]  = random_generator.normal(size=(number_of_rays, 3))
+    beam.rays[:, 3:6]  = random_generator.normal(scale=(1e-3, 1.0, 1e-3), size=(number_of_rays, 3))
+    beam.rays[:, 3:6] /= numpy.linalg.norm(beam.rays[:, 3:6], axis=1)[:, numpy.newaxis]
+    beam.rays[:, 6:9]  = random_generator.normal(size=(number_of_rays, 3))
+    beam.rays[:, 9]    = numpy.where(random_generator.random(number_of_rays) < 0.8, 1.0, -11.0)
+    beam.rays[:, 10]   = random_generator.uniform(50000.0, 51000.0, number_of_rays)
+    beam.rays[:, 11]   = numpy.arange(1, number_of_rays + 1)
+    beam.rays[:, 15:18] = random_generator.normal(size=(number_of_rays, 3))
+
+    return beam
+
+def _assert_same_ticket(test_case, expected, ticket, exact=True):
+    test_case.assertEqual(set(expected.keys()), set(ticket.keys()))
+
+    for key, value in expected.items():
+        if value is None or isinstance(value, str):
+            test_case.assertEqual(value, ticket[key], key)
+        elif exact:
+            numpy.testing.assert_array_equal(numpy.asarray(ticket[key]), numpy.asarray(value), err_msg=key)
+        else: # histo1: the weights are summed in a different order than numpy.histogram
+            numpy.testing.assert_allclose(numpy.asarray(ticket[key]), numpy.asarray(value), rtol=1e-12, atol=1e-12, err_msg=key)
+
+#
+# Tests
+#
+
+class TestShadowBeamAnalysis(unittest.TestCase):
+
+    def test_rays_cached_and_not_changed(self):
+        beam = _create_beam()
+
+        analysis = ShadowBeamAnalysis.get_analysis(beam)
+
+        self.assertTrue(beam.rays.flags.writeable)
+        self.assertIs(ShadowBeamAnalysis.get_analysis(beam), analysis)
+
+    def test_view_of_the_rays_cached(self):
+        beam = _create_beam()
+        view_beam = Shadow.Beam()
+        view_beam.rays = beam.rays.view()
+        view_beam.rays.flags.writeable = False
+
+        self.assertIs(ShadowBeamAnalysis.get_analysis(view_beam), ShadowBeamAnalysis.get_analysis(beam))
+
+    def test_invalidated_rays(self):
+        beam = _create_beam()
+
+        analysis = ShadowBeamAnalysis.get_analysis(beam)
+        self.assertGreater(analysis.get_number_of_rays(nolost=1), 0)
+
+        ShadowBeamAnalysis.invalidate(beam.rays)
+        beam.rays[:, 9] = -1.0
+
+        self.assertIsNot(ShadowBeamAnalysis.get_analysis(beam), analysis)
+        self.assertEqual(ShadowBeamAnalysis.get_analysis(beam).get_number_of_rays(nolost=1), 0)
+
+class TestShadowHistogram(unittest.TestCase):
+
+    def setUp(self):
+        self.__chunk_size = ShadowHistogram.CHUNK_SIZE
+
+    def tearDown(self):
+        ShadowHistogram.CHUNK_SIZE = self.__chunk_size
+        ShadowHistogram.set_number_of_threads(None)
+
+    def test_histo1_as_shadow(self):
+        beam = _create_beam(200000)
+        beam.rays[::777, 0] = numpy.nan # ignored (Shadow raises without a range)
+
+        for arguments in [dict(col=2, nbins=101, nolost=1, ref=23),
+                          dict(col=4, nbins=500, nolost=0, ref=0),
+                          dict(col=3, nbins=64, nolost=2, ref=24, xrange=[-1.0, 1.0]),
+                          dict(col=11, nbins=50, nolost=1, ref=25),
+                          dict(col=5, nbins=7, nolost=1, ref=0),
+                          dict(col=1, nbins=40, nolost=1, ref=23, xrange=[-2.0, 2.0])]:
+            with self.subTest(**arguments):
+                expected = beam.histo1(**arguments)
+                ticket = ShadowBeamAnalysis(beam.rays).histo1(beam, **arguments)
+
+                _assert_same_ticket(self, expected, ticket, exact=False)
+
+    def test_histo2_as_shadow(self):
+        beam = _create_beam(200000)
+        beam.rays[::777, 0] = numpy.nan # ignored (Shadow raises without a range)
+
+        for arguments in [dict(col_h=2, col_v=3, nbins=101, nolost=1, ref=23),
+                          dict(col_h=4, col_v=6, nbins_h=500, nbins_v=300, nolost=0, ref=0),
+                          dict(col_h=1, col_v=3, nbins=64, nolost=2, ref=24, xrange=[-1.0, 1.0], yrange=[-0.5, 2.0]),
+                          dict(col_h=26, col_v=11, nbins=50, nolost=1, ref=25)]:
+            with self.subTest(**arguments):
+                expected = beam.histo2(**arguments)
+                ticket = ShadowBeamAnalysis(beam.rays).histo2(beam, **arguments)
+
+                _assert_same_ticket(self, expected, ticket)
+
+    def test_nan_ignored_in_the_range(self):
+        beam = _create_beam(50000)
+        not_nan_beam = _create_beam(50000)
+        not_nan_beam.rays = not_nan_beam.rays[numpy.arange(50000) % 777 != 0]
+        beam.rays[::777, 0] = numpy.nan
+
+        expected = not_nan_beam.histo2(1, 3, nbins=64, nolost=0, ref=23)
+        ticket = ShadowBeamAnalysis(beam.rays).histo2(beam, 1, 3, nbins=64, nolost=0, ref=23)
+
+        for key in ["xrange", "yrange", "bin_h_edges", "bin_v_edges", "histogram"]:
+            numpy.testing.assert_array_equal(ticket[key], expected[key], err_msg=key)
+
+        expected = not_nan_beam.histo1(1, nbins=64, nolost=0, ref=23)
+        ticket = ShadowBeamAnalysis(beam.rays).histo1(beam, 1, nbins=64, nolost=0, ref=23)
+
+        for key in ["xrange", "bins", "histogram"]:
+            numpy.testing.assert_allclose(ticket[key], expected[key], rtol=1e-12, atol=1e-12, err_msg=key)
+
+    def test_edges_as_numpy(self):
+        for value_range, nbins in [((-1.3, 2.7), 37), ((0.1, 0.7), 3), ((-5e-6, 5e-6), 101)]:
+            edges = ShadowHistogram.get_edges(value_range, nbins)
+
+            # on the edges, next to them and not finite
+            values = numpy.concatenate([edges, numpy.nextafter(edges, numpy.inf), numpy.nextafter(edges, -numpy.inf), [numpy.nan, numpy.inf, -numpy.inf]])
+            weights = numpy.arange(len(values), dtype=float)
+            finite = numpy.isfinite(values)
+
+            numpy.testing.assert_array_equal(ShadowHistogram.histogram1d(values, edges, weights=weights)[0],
+                                             numpy.histogram(values[finite], bins=edges, weights=weights[finite])[0])
+
+            finite &= finite[::-1]
+            numpy.testing.assert_array_equal(ShadowHistogram.histogram2d(values, values[::-1], edges, edges, weights=weights),
+                                             numpy.histogram2d(values[finite], values[::-1][finite], bins=[edges, edges], weights=weights[finite])[0])
+
+    def test_same_result_with_any_number_of_threads(self):
+        random_generator = numpy.random.default_rng(7654321)
+        values = random_generator.normal(size=300000)
+        weights = random_generator.random(300000)
+        mask = random_generator.random(300000) < 0.7
+        edges = ShadowHistogram.get_edges([-3.0, 3.0], 100)
+
+        ShadowHistogram.CHUNK_SIZE = 10000
+
+        results = []
+        for number_of_threads in [1, 2, 3, 8, 0]:
+            ShadowHistogram.set_number_of_threads(number_of_threads)
+
+            results.append((ShadowHistogram.histogram1d(values, edges, weights=weights, mask=mask),
+                            ShadowHistogram.histogram2d(values, weights, edges, edges, weights=weights, mask=mask)))
+
+        for (histogram, histogram_squared_weights), histogram_2d in results[1:]: # bitwise
+            numpy.testing.assert_array_equal(histogram, results[0][0][0])
+            numpy.testing.assert_array_equal(histogram_squared_weights, results[0][0][1])
+            numpy.testing.assert_array_equal(histogram_2d, results[0][1])
+
+if __name__ == "__main__":
+    unittest.main()
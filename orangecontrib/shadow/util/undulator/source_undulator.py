@@ -34,6 +34,7 @@ from syned.storage_ring.electron_beam import ElectronBeam
 from orangecontrib.shadow.util.undulator.source_undulator_factory import SourceUndulatorFactory
 from orangecontrib.shadow.util.undulator.source_undulator_factory_srw import SourceUndulatorFactorySrw
 from orangecontrib.shadow.util.undulator.source_undulator_factory_pysru import SourceUndulatorFactoryPysru
+from orangecontrib.shadow.util.undulator.source_undulator_cache import SourceUndulatorCache
 
 
 INTEGRATION_METHOD = 1 # 0=sum, 1=trapz
@@ -49,7 +50,9 @@ class SourceUndulator(object):
                  ng_t=31,                    # Number of points in angle theta
                  ng_p=21,                    # Number of points in angle phi
                  ng_j=20,                    # Number of points in electron trajectory (per period) for internal calculation only
-                 code_undul_phot="internal", # internal, pysru, srw
+                 code_undul_phot="internal", # internal, internal_vectorized, pysru, srw
+                 number_of_processes=1,      # Number of processes for calculating the photon energies in parallel
+                 cache=None,                 # SourceUndulatorCache instance to store/reuse the radiation (None=no cache)
                  flag_emittance=0,           # when sampling rays: Use emittance (0=No, 1=Yes)
                  flag_size=0,                # when sampling rays: 0=point,1=Gaussian,2=FT(Divergences)
                  ):
@@ -80,6 +83,8 @@ class SourceUndulator(object):
         # self.NRAYS           = NRAYS  # Number of rays
 
         self.code_undul_phot = code_undul_phot
+        self.number_of_processes = number_of_processes
+        self.cache = cache
 
         self._FLAG_EMITTANCE  =  flag_emittance # Yes  # Use emittance (0=No, 1=Yes)
         self._FLAG_SIZE  =  flag_size # 0=point,1=Gaussian,2=backpropagate Divergences
@@ -165,6 +170,7 @@ class SourceUndulator(object):
         txt += "-----------------------------------------------------\n"
 
         txt += "calculation code: %s\n"%self.code_undul_phot
+        txt += "calculation processes: %d\n"%self.number_of_processes
         if self._result_radiation is None:
             txt += "radiation: NOT YET CALCULATED\n"
         else:
@@ -235,10 +241,11 @@ class SourceUndulator(object):
         Calculates the radiation (emission) as a function of theta (elevation angle) and phi (azimuthal angle)
         This radiation will be sampled to create the source
 
-        It calls undul_phot* in SourceUndulatorFactory
+        It calls undul_phot* in SourceUndulatorFactory, distributing the photon energies over
+        number_of_processes processes (see SourceUndulatorFactory.undul_phot_parallel)
 
-        :param code_undul_phot: 'internal' (calls undul_phot), 'pysru' (calls undul_phot_pysru) or
-                'srw' (calls undul_phot_srw)
+        :param code_undul_phot: 'internal' (calls undul_phot), 'internal_vectorized' (calls undul_phot_vectorized),
+                'pysru' (calls undul_phot_pysru) or 'srw' (calls undul_phot_srw)
         :return: a dictionary (the output from undul_phot*)
         """
 
@@ -252,9 +259,35 @@ class SourceUndulator(object):
 
         self._result_radiation = None
 
+        if not self.cache is None:
+            cache_key = self.get_cache_key()
+            undul_phot_dict = self.cache.load_undul_phot(cache_key)
+
+            if not undul_phot_dict is None:
+                undul_phot_dict["info"] = self.info()
+                self._result_radiation = undul_phot_dict
+                return
+
         # undul_phot
         if self.code_undul_phot == 'internal':
-            undul_phot_dict = SourceUndulatorFactory.undul_phot(E_ENERGY  = self.syned_electron_beam.energy(),
+            undul_phot_dict = SourceUndulatorFactory.undul_phot_parallel(SourceUndulatorFactory.undul_phot,
+                                         number_of_processes = self.number_of_processes,
+                                         E_ENERGY  = self.syned_electron_beam.energy(),
+                                         INTENSITY = self.syned_electron_beam.current(),
+                                         LAMBDAU   = self.syned_undulator.period_length(),
+                                         NPERIODS  = self.syned_undulator.number_of_periods(),
+                                         K         = self.syned_undulator.K(),
+                                         EMIN      = self._EMIN,
+                                         EMAX      = self._EMAX,
+                                         NG_E      = self._NG_E,
+                                         MAXANGLE  = self._MAXANGLE,
+                                         NG_T      = self._NG_T,
+                                         NG_P      = self._NG_P,
+                                         number_of_trajectory_points = self._NG_J)
+        elif self.code_undul_phot == 'internal_vectorized':
+            undul_phot_dict = SourceUndulatorFactory.undul_phot_parallel(SourceUndulatorFactory.undul_phot_vectorized,
+                                         number_of_processes = self.number_of_processes,
+                                         E_ENERGY  = self.syned_electron_beam.energy(),
                                          INTENSITY = self.syned_electron_beam.current(),
                                          LAMBDAU   = self.syned_undulator.period_length(),
                                          NPERIODS  = self.syned_undulator.number_of_periods(),
@@ -266,9 +299,10 @@ class SourceUndulator(object):
                                          NG_T      = self._NG_T,
                                          NG_P      = self._NG_P,
                                          number_of_trajectory_points = self._NG_J)
-
         elif self.code_undul_phot == 'pysru' or  self.code_undul_phot == 'pySRU':
-            undul_phot_dict = SourceUndulatorFactoryPysru.undul_phot(E_ENERGY  = self.syned_electron_beam.energy(),
+            undul_phot_dict = SourceUndulatorFactory.undul_phot_parallel(SourceUndulatorFactoryPysru.undul_phot,
+                                         number_of_processes = self.number_of_processes,
+                                         E_ENERGY  = self.syned_electron_beam.energy(),
                                          INTENSITY = self.syned_electron_beam.current(),
                                          LAMBDAU   = self.syned_undulator.period_length(),
                                          NPERIODS  = self.syned_undulator.number_of_periods(),
@@ -278,9 +312,11 @@ class SourceUndulator(object):
                                          NG_E      = self._NG_E,
                                          MAXANGLE  = self._MAXANGLE,
                                          NG_T      = self._NG_T,
-                                         NG_P      = self._NG_P,)
+                                         NG_P      = self._NG_P)
         elif self.code_undul_phot == 'srw' or  self.code_undul_phot == 'SRW':
-            undul_phot_dict = SourceUndulatorFactorySrw.undul_phot(E_ENERGY  = self.syned_electron_beam.energy(),
+            undul_phot_dict = SourceUndulatorFactory.undul_phot_parallel(SourceUndulatorFactorySrw.undul_phot,
+                                         number_of_processes = self.number_of_processes,
+                                         E_ENERGY  = self.syned_electron_beam.energy(),
                                          INTENSITY = self.syned_electron_beam.current(),
                                          LAMBDAU   = self.syned_undulator.period_length(),
                                          NPERIODS  = self.syned_undulator.number_of_periods(),
@@ -290,7 +326,7 @@ class SourceUndulator(object):
                                          NG_E      = self._NG_E,
                                          MAXANGLE  = self._MAXANGLE,
                                          NG_T      = self._NG_T,
-                                         NG_P      = self._NG_P,)
+                                         NG_P      = self._NG_P)
         else:
             raise Exception("Not implemented undul_phot code: "+self.code_undul_phot)
 
@@ -298,8 +334,32 @@ class SourceUndulator(object):
         undul_phot_dict["code_undul_phot"] = self.code_undul_phot
         undul_phot_dict["info"] = self.info()
 
+        if not self.cache is None:
+            self.cache.store_undul_phot(cache_key, undul_phot_dict)
+
         self._result_radiation = undul_phot_dict
 
+    def get_cache_key(self):
+        """
+        Gets the key of the radiation calculation for SourceUndulatorCache: it depends on the electron beam,
+        the undulator, the photon energy and angular grids and the calculation code (but not on the sampling)
+
+        :return: a hexadecimal string
+        """
+        return SourceUndulatorCache.get_key(E_ENERGY  = self.syned_electron_beam.energy(),
+                                            INTENSITY = self.syned_electron_beam.current(),
+                                            LAMBDAU   = self.syned_undulator.period_length(),
+                                            NPERIODS  = self.syned_undulator.number_of_periods(),
+                                            K         = self.syned_undulator.K(),
+                                            EMIN      = self._EMIN,
+                                            EMAX      = self._EMAX,
+                                            NG_E      = self._NG_E,
+                                            MAXANGLE  = self._MAXANGLE,
+                                            NG_T      = self._NG_T,
+                                            NG_P      = self._NG_P,
+                                            NG_J      = self._NG_J,
+                                            code_undul_phot = self.code_undul_phot.lower())
+
     #
     # get from results
     #
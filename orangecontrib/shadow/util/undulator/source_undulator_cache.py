@@ -0,0 +1,143 @@
+#
+# persistent on-disk cache for the undul_phot results (the radiation)
+#
+# The files (uphot.h5 format, see SourceUndulatorInputOutput) are named by a hash of the
+# parameters of the calculation (electron beam, magnetic structure, energy and angular grids, code),
+# so a calculation with the same parameters is loaded from disk instead of being recomputed.
+#
+# The total size of the cache directory is bounded: when exceeded, the least recently used files
+# are removed (the access time is stored in the file modification time).
+#
+
+
+import os
+import json
+import numbers
+import hashlib
+import tempfile
+
+from orangecontrib.shadow.util.undulator.source_undulator_input_output import SourceUndulatorInputOutput
+
+class SourceUndulatorCache(object):
+
+    DEFAULT_DIRECTORY = os.path.join(os.path.expanduser("~"), ".shadowoui", "undulator_cache")
+    DEFAULT_MAX_SIZE = 1024**3 # 1 GB
+
+    def __init__(self, directory=DEFAULT_DIRECTORY, max_size=DEFAULT_MAX_SIZE):
+        """
+        :param directory: the directory where the files are stored (created if needed)
+        :param max_size: maximum total size of the cache files in bytes
+        """
+        self.directory = directory
+        self.max_size = max_size
+
+    @classmethod
+    def get_key(cls, **parameters):
+        """
+        Returns the content-address of a calculation
+
+        :param parameters: the parameters defining the calculation (numbers and strings)
+        :return: a hexadecimal string
+        """
+        text = json.dumps({key: cls.__normalize(value) for key, value in parameters.items()}, sort_keys=True)
+
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def load_undul_phot(self, key):
+        """
+        :param key: the key (from get_key())
+        :return: the undul_phot dictionary, or None if not in cache
+        """
+        return self.__load(key, "uphot", SourceUndulatorInputOutput.load_file_undul_phot_h5)
+
+    def store_undul_phot(self, key, undul_phot_dict):
+        """
+        :param key: the key (from get_key())
+        :param undul_phot_dict: the undul_phot dictionary (with 'code_undul_phot' and 'info' entries)
+        """
+        self.__store(key, "uphot", lambda file_out: SourceUndulatorInputOutput.write_file_undul_phot_h5(undul_phot_dict, file_out=file_out))
+
+    def clear(self):
+        for file_name, _, _ in self.__list_files():
+            self.__remove(file_name)
+
+    def get_size(self):
+        return sum([size for _, size, _ in self.__list_files()])
+
+    #########################################################################################
+
+    def __get_file_name(self, key, kind):
+        return os.path.join(self.directory, "%s_%s.h5" % (kind, key))
+
+    def __load(self, key, kind, load_method):
+        file_name = self.__get_file_name(key, kind)
+
+        if not os.path.exists(file_name): return None
+
+        try:
+            out = load_method(file_in=file_name)
+        except Exception as exception:
+            print("Undulator cache: removing unreadable file %s (%s)" % (file_name, str(exception)))
+            self.__remove(file_name)
+            return None
+
+        os.utime(file_name) # most recently used
+        print("Undulator cache: loaded %s" % file_name)
+
+        return out
+
+    def __store(self, key, kind, write_method):
+        os.makedirs(self.directory, exist_ok=True)
+
+        file_name = self.__get_file_name(key, kind)
+
+        # write in a temporary file then rename, so an interrupted write never leaves a corrupted entry
+        file_descriptor, temporary_file_name = tempfile.mkstemp(suffix=".h5.tmp", dir=self.directory)
+        os.close(file_descriptor)
+        try:
+            write_method(temporary_file_name)
+            os.replace(temporary_file_name, file_name)
+        except:
+            self.__remove(temporary_file_name)
+            raise
+
+        self.__evict()
+
+    def __list_files(self):
+        if not os.path.isdir(self.directory): return []
+
+        files = []
+        for file_name in os.listdir(self.directory):
+            if file_name.startswith("uphot_") and file_name.endswith(".h5"):
+                file_name = os.path.join(self.directory, file_name)
+                try:
+                    stat = os.stat(file_name)
+                    files.append((file_name, stat.st_size, stat.st_mtime))
+                except OSError:
+                    pass
+
+        return files
+
+    def __evict(self):
+        files = sorted(self.__list_files(), key=lambda item: item[2]) # least recently used first
+        total_size = sum([size for _, size, _ in files])
+
+        # the most recent file is always kept
+        for file_name, size, _ in files[:-1]:
+            if total_size <= self.max_size: break
+            self.__remove(file_name)
+            total_size -= size
+
+    @classmethod
+    def __normalize(cls, value):
+        # numpy scalars and python numbers with the same value give the same key; repr() keeps all the digits
+        if isinstance(value, numbers.Integral): return repr(int(value))
+        elif isinstance(value, numbers.Real): return repr(float(value))
+        else: return str(value)
+
+    @classmethod
+    def __remove(cls, file_name):
+        try:
+            os.remove(file_name)
+        except OSError:
+            pass
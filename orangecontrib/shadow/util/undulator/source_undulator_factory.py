@@ -16,6 +16,8 @@ __date__ = "12/01/2017"
 # Available public methods:
 #
 #     undul_phot()       : like undul_phot of SHADOW but written in python with internal code hacked from pySRU
+#     undul_phot_vectorized() : same as undul_phot() but evaluating the far field on whole (theta,phi) grids at once
+#     undul_phot_parallel()   : runs any undul_phot (internal, pySRU, SRW) distributing the photon energies on a process pool
 #     undul_cdf          : like undul_cdf in SHADOW written internally in python
 #
 #
@@ -24,10 +26,18 @@ __date__ = "12/01/2017"
 
 import numpy
 import numpy as np
+import io
+import contextlib
+from concurrent.futures import ProcessPoolExecutor
 
 # scipy
 import scipy.constants as codata
-import scipy.integrate
+
+# worker for undul_phot_parallel(): calculates a single photon energy. The standard output of the
+# undul_phot is captured, so that the progress is only reported (in order) by the parent process
+def _undul_phot_energy_slice(undul_phot, photon_energy, undul_phot_kwargs):
+    with contextlib.redirect_stdout(io.StringIO()):
+        return undul_phot(EMIN=photon_energy, EMAX=photon_energy, NG_E=1, **undul_phot_kwargs)
 
 class SourceUndulatorFactory(object):
 
@@ -130,6 +140,69 @@ class SourceUndulatorFactory(object):
         return E
 
 
+    # batched version of _pysru_energy_radiated_approximation_and_farfield(): x and y are arrays of M points in the
+    # screen at distance D. The angular part of the integrand (independent of omega) is precomputed once by
+    # _pysru_farfield_integrand_batch(), then the integral is evaluated as a weighted sum (trapezoidal weights).
+    # returns E with shape (3,M)
+    @staticmethod
+    def _pysru_farfield_integrand_batch(trajectory=np.zeros((11,10)), x=np.zeros(1), y=np.zeros(1), D=100.0):
+
+        X = np.sqrt(x ** 2 + y ** 2 + D ** 2)
+        n_chap = np.array([x, y, np.full_like(x, D)]) / X # (3,M)
+
+        trajectory_t   = trajectory[0]
+        trajectory_x   = trajectory[1]
+        trajectory_y   = trajectory[2]
+        trajectory_z   = trajectory[3]
+        trajectory_v_x = trajectory[4]
+        trajectory_v_y = trajectory[5]
+        trajectory_v_z = trajectory[6]
+
+        n0 = n_chap[0][:, np.newaxis]
+        n1 = n_chap[1][:, np.newaxis]
+        n2 = n_chap[2][:, np.newaxis]
+
+        A1 = (n1 * trajectory_v_z - n2 * trajectory_v_y) # (M,N)
+        A2 = (-n0 * trajectory_v_z + n2 * trajectory_v_x)
+        A3 = (n0 * trajectory_v_y - n1 * trajectory_v_x)
+
+        phase = trajectory_t + X[:, np.newaxis] / codata.c - n0 * trajectory_x - n1 * trajectory_y - n2 * trajectory_z
+
+        # trapezoidal weights along the trajectory
+        weights = np.zeros_like(trajectory_t)
+        dt = np.diff(trajectory_t)
+        weights[:-1] += 0.5 * dt
+        weights[1:]  += 0.5 * dt
+
+        integrand = np.array([( n1*A3 - n2*A2),
+                              (-n0*A3 + n2*A1),
+                              ( n0*A2 - n1*A1)]) # (3,M,N)
+
+        Alpha_1 = (1.0 / (1.0 - n_chap[0] * trajectory_v_x[-1] - n_chap[1] * trajectory_v_y[-1] - n_chap[2] * trajectory_v_z[-1]))
+        Alpha_0 = (1.0 / (1.0 - n_chap[0] * trajectory_v_x[0]  - n_chap[1] * trajectory_v_y[0]  - n_chap[2] * trajectory_v_z[0]))
+
+        return {"integrand":integrand * weights, # (3,M,N) real, weighted
+                "phase":phase,                   # (M,N)
+                "border_1":integrand[0, :, -1] * Alpha_1,
+                "border_0":integrand[0, :, 0] * Alpha_0}
+
+    @staticmethod
+    def _pysru_energy_radiated_approximation_and_farfield_batch(omega=2.53465927101*10**17,electron_current=1.0,integrand_batch=None,D=100.0):
+
+        c6 = codata.e * electron_current * 1e-9 / (8.0 * np.pi ** 2 * codata.epsilon_0 * codata.c * codata.h)
+        c6 /= D**2
+
+        Alpha2 = np.exp(1j * omega * integrand_batch["phase"]) # (M,N)
+
+        E = -(integrand_batch["integrand"] * Alpha2).sum(axis=2) # (3,M)
+        E *= omega * 1j
+
+        # same as in pySRU: the border term of the first component is added to all the components
+        E += integrand_batch["border_1"] * Alpha2[:, -1] - integrand_batch["border_0"] * Alpha2[:, 0]
+        E *= c6**0.5
+
+        return E
+
     #
     # now, the different versions of undul_phot
     #
@@ -187,13 +260,141 @@ class SourceUndulatorFactory(object):
 
         return {'radiation':Z2,'polarization':POL_DEG,'photon_energy':E,'theta':theta,'phi':phi,'trajectory':T}
 
+    @staticmethod
+    def undul_phot_vectorized(E_ENERGY,INTENSITY,LAMBDAU,NPERIODS,K,EMIN,EMAX,NG_E,MAXANGLE,NG_T,NG_P,
+                              number_of_trajectory_points=20, max_elements_per_chunk=2**21):
+        #
+        # same as undul_phot, but the far field integral is calculated for (theta,phi) points in chunks of
+        # max_elements_per_chunk/(number of trajectory points) points, using numpy broadcasting
+        #
+
+        #
+        # calculate trajectory
+        #
+        angstroms_to_eV = codata.h*codata.c/codata.e*1e10
+        gamma = E_ENERGY * 1e9 / 0.511e6
+        Beta = np.sqrt(1.0 - (1.0 / gamma ** 2))
+        Beta_et = Beta * (1.0 - (K / (2.0 * gamma)) ** 2)
+
+
+        E = np.linspace(EMIN,EMAX,NG_E,dtype=float)
+        wavelength_array_in_A = angstroms_to_eV / E
+        omega_array = 2*np.pi * codata.c / (wavelength_array_in_A * 1e-10)
+
+        T = SourceUndulatorFactory._pysru_analytical_trajectory_plane_undulator(K=K, gamma=gamma, lambda_u=LAMBDAU, Nb_period=NPERIODS,
+                                            Nb_point=number_of_trajectory_points,Beta_et=Beta_et)
+
+        #
+        # polar grid
+        #
+        D = 100.0 # placed far away (100 m)
+        theta = np.linspace(0,MAXANGLE,NG_T,dtype=float)
+        phi = np.linspace(0,np.pi/2,NG_P,dtype=float)
+
+        THETA = np.outer(theta,np.ones_like(phi)).flatten()
+        PHI = np.outer(np.ones_like(theta),phi).flatten()
+
+        R = D / np.cos(THETA)
+        r = R * np.sin(THETA)
+        X = r * np.cos(PHI)
+        Y = r * np.sin(PHI)
+
+        Z2 = np.zeros((omega_array.size,THETA.size))
+        POL_DEG = np.zeros_like(Z2)
+
+        chunk_size = max(1, int(max_elements_per_chunk // T.shape[1]))
+        n_chunks = int(np.ceil(THETA.size / chunk_size))
+
+        for c in range(n_chunks):
+            print("Calculating angular points %d to %d of %d (batch %d of %d)"%(c*chunk_size+1,min((c+1)*chunk_size,THETA.size),THETA.size,c+1,n_chunks))
+
+            points = slice(c*chunk_size,(c+1)*chunk_size)
+
+            integrand_batch = SourceUndulatorFactory._pysru_farfield_integrand_batch(trajectory=T, x=X[points], y=Y[points], D=D)
+
+            for o in range(omega_array.size):
+                ElecField = SourceUndulatorFactory._pysru_energy_radiated_approximation_and_farfield_batch(omega=omega_array[o],electron_current=INTENSITY,
+                                                                                                        integrand_batch=integrand_batch, D=D)
+
+                abs_E = np.abs(ElecField)
+
+                #  Conversion from pySRU units (photons/mm^2/0.1%bw) to SHADOW units (photons/rad^2/eV)
+                Z2[o,points]      = (abs_E ** 2).sum(axis=0) * (D*1e3)**2 / (1e-3 * E[o])
+                POL_DEG[o,points] = abs_E[0] / (abs_E[0] + abs_E[1]) # SHADOW definition
+
+        Z2.shape = (omega_array.size,theta.size,phi.size)
+        POL_DEG.shape = (omega_array.size,theta.size,phi.size)
+
+        return {'radiation':Z2,'polarization':POL_DEG,'photon_energy':E,'theta':theta,'phi':phi,'trajectory':T}
+
+    @staticmethod
+    def undul_phot_parallel(undul_phot, EMIN, EMAX, NG_E, number_of_processes=1, **undul_phot_kwargs):
+        #
+        # calls undul_phot (e.g. SourceUndulatorFactory.undul_phot, SourceUndulatorFactoryPysru.undul_phot,
+        # SourceUndulatorFactorySrw.undul_phot) for each photon energy in a pool of number_of_processes processes,
+        # and gathers the slices in the radiation and polarization arrays
+        #
+        if number_of_processes <= 1 or NG_E <= 1:
+            return undul_phot(EMIN=EMIN, EMAX=EMAX, NG_E=NG_E, **undul_phot_kwargs)
+
+        photon_energy = np.linspace(EMIN,EMAX,NG_E,dtype=float)
+
+        slices = []
+        with ProcessPoolExecutor(max_workers=min(number_of_processes, NG_E)) as executor:
+            # map returns the results in the order of the energies: the progress is deterministic
+            for ie, undul_phot_dict in enumerate(executor.map(_undul_phot_energy_slice,
+                                                               [undul_phot] * NG_E,
+                                                               photon_energy,
+                                                               [undul_phot_kwargs] * NG_E)):
+                print("Calculated energy %8.3f eV (%d of %d)"%(photon_energy[ie],ie+1,NG_E))
+                slices.append(undul_phot_dict)
+
+        out = dict(slices[0])
+        out["radiation"]     = np.concatenate([energy_slice["radiation"] for energy_slice in slices], axis=0)
+        out["polarization"]  = np.concatenate([energy_slice["polarization"] for energy_slice in slices], axis=0)
+        out["photon_energy"] = np.concatenate([energy_slice["photon_energy"] for energy_slice in slices], axis=0)
+
+        return out
+
     #
     # undul_cdf
     #
+    #
+    # integration helpers for undul_cdf (replace numpy.trapz and scipy.integrate.cumtrapz, that are deprecated):
+    # the cumulative integrals are calculated in double precision in a single output array, then
+    # converted to dtype
+    #
+    @staticmethod
+    def _trapezoid(y,axis=-1):
+        y = numpy.moveaxis(y,axis,-1)
+        return y.sum(axis=-1) - 0.5 * (y[...,0] + y[...,-1])
+
+    @staticmethod
+    def _cumulative_trapezoid(y,axis=-1,dx=1.0,dtype=numpy.float64):
+        out = numpy.empty(y.shape,dtype=numpy.float64)
+
+        yy = numpy.moveaxis(y,axis,-1)
+        oo = numpy.moveaxis(out,axis,-1)
+
+        oo[...,0] = 0.0
+        numpy.add(yy[...,1:],yy[...,:-1],out=oo[...,1:])
+        oo[...,1:] *= 0.5 * dx
+        numpy.cumsum(oo[...,1:],axis=-1,out=oo[...,1:])
+
+        return out.astype(dtype,copy=False)
+
+    @staticmethod
+    def _cumulative_sum(y,axis=-1,dx=1.0,dtype=numpy.float64):
+        out = numpy.cumsum(y,axis=axis,dtype=numpy.float64)
+        out *= dx
+
+        return out.astype(dtype,copy=False)
+
     @staticmethod
-    def undul_cdf(undul_phot_dict,method='trapz'):
+    def undul_cdf(undul_phot_dict,method='trapz',cdf_dtype=numpy.float64):
         #
         # takes the output of undul_phot and calculate cumulative distribution functions
+        # (use cdf_dtype=numpy.float32 to get single precision CDFs; the integrals are always done in double precision)
         #
 
         RN0     = undul_phot_dict['radiation']
@@ -206,32 +407,30 @@ class SourceUndulatorFactory(object):
         print("undul_cdf: _NG_E,_NG_T,_NG_P, %d  %d %d \n"%(NG_E,NG_T,NG_P))
 
         # coordinates are polar: multiply by sin(theta) to allow dS= r^2 sin(Theta) dTheta dPhi
-        YRN0 = numpy.zeros_like(RN0)
-        for e in numpy.arange(NG_E):
-            for t in numpy.arange(NG_T):
-                for p in numpy.arange(NG_P):
-                    YRN0[e,t,p] = RN0[e,t,p] * numpy.sin(T[t])
+        YRN0 = RN0 * numpy.sin(T)[numpy.newaxis,:,numpy.newaxis]
 
 
         if method == "sum":
             RN1 = YRN0.sum(axis=2) * (P[1] - P[0])             # RN1(e,t)
             RN2 = RN1.sum(axis=1)  * (T[1] - T[0])             # RN2(e)
-            ZERO  = numpy.cumsum(RN0,axis=2)   * (P[1] - P[0]) # CDF(e,t,p)
-            ONE   = numpy.cumsum(RN1,axis=1)   * (T[1] - T[0]) # CDF(e,t)
+            del YRN0
+            ZERO  = SourceUndulatorFactory._cumulative_sum(RN0,axis=2,dx=P[1] - P[0],dtype=cdf_dtype) # CDF(e,t,p)
+            ONE   = SourceUndulatorFactory._cumulative_sum(RN1,axis=1,dx=T[1] - T[0],dtype=cdf_dtype) # CDF(e,t)
             if NG_E > 1:
-                TWO   = numpy.cumsum(RN2)          * (E[1] - E[0]) # CDF(e)
+                TWO   = SourceUndulatorFactory._cumulative_sum(RN2,axis=0,dx=E[1] - E[0],dtype=cdf_dtype) # CDF(e)
             else:
-                TWO = numpy.array([0.0])
+                TWO = numpy.array([0.0],dtype=cdf_dtype)
 
         else:
-            RN1 = numpy.trapz(YRN0,axis=2) * (P[1]-P[0])                            # RN1(e,t)
-            RN2 = numpy.trapz(RN1,axis=1)  * (T[1]-T[0])                            # RN2(e)
-            ZERO  = scipy.integrate.cumtrapz(RN0,initial=0,axis=2)  * (P[1] - P[0]) # CDF(e,t,p)
-            ONE   = scipy.integrate.cumtrapz(RN1,initial=0,axis=1)  * (T[1] - T[0]) # CDF(e,t)
+            RN1 = SourceUndulatorFactory._trapezoid(YRN0,axis=2) * (P[1]-P[0])      # RN1(e,t)
+            RN2 = SourceUndulatorFactory._trapezoid(RN1,axis=1)  * (T[1]-T[0])      # RN2(e)
+            del YRN0
+            ZERO  = SourceUndulatorFactory._cumulative_trapezoid(RN0,axis=2,dx=P[1] - P[0],dtype=cdf_dtype) # CDF(e,t,p)
+            ONE   = SourceUndulatorFactory._cumulative_trapezoid(RN1,axis=1,dx=T[1] - T[0],dtype=cdf_dtype) # CDF(e,t)
             if NG_E > 1:
-                TWO   = scipy.integrate.cumtrapz(RN2,initial=0)         * (E[1] - E[0]) # CDF(e)
+                TWO   = SourceUndulatorFactory._cumulative_trapezoid(RN2,axis=0,dx=E[1] - E[0],dtype=cdf_dtype) # CDF(e)
             else:
-                TWO = numpy.array([0.0])
+                TWO = numpy.array([0.0],dtype=cdf_dtype)
 
         print("undul_cdf: Shadow ZERO,ONE,TWO: ",ZERO.shape,ONE.shape,TWO.shape)
 
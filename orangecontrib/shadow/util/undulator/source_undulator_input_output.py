@@ -161,11 +161,41 @@ class SourceUndulatorInputOutput(object):
         f1["polarization"] = POL_DEG
         f1["code_undul_phot"] = undul_phot_dict["code_undul_phot"]
         f1["info"] = undul_phot_dict["info"]
+        if "trajectory" in undul_phot_dict:
+            f1["trajectory"] = undul_phot_dict["trajectory"]
 
 
         f.close()
         print("File written to disk: %s"%file_out)
 
+    @staticmethod
+    def load_file_undul_phot_h5(file_in="uphot.h5",entry_name="radiation"):
+        """
+        read a uphot.h5 file (as written by write_file_undul_phot_h5)
+
+        :param file_in: name of the file to be read
+        :param entry_name: name of the group with the data (Default: radiation)
+        :return: a dictionary {'radiation':RN0, 'polarization':POL_DEG, 'photon_energy':E, 'theta':TT, 'phi':PP,
+                'code_undul_phot':code, 'info':info} (and 'trajectory' if stored)
+        """
+
+        f = h5py.File(file_in,'r')
+
+        f1 = f[entry_name]
+
+        out = {}
+        for key in ["radiation","polarization","photon_energy","theta","phi","trajectory"]:
+            if key in f1:
+                out[key] = f1[key][()]
+
+        for key in ["code_undul_phot","info"]:
+            value = f1[key][()]
+            out[key] = value.decode() if isinstance(value,bytes) else value
+
+        f.close()
+
+        return out
+
     @staticmethod
     def load_file_undul_cdf(file_in="xshundul.sha"):
         """
@@ -356,6 +386,29 @@ class SourceUndulatorInputOutput(object):
         f.close()
         print("File written to disk: %s"%file_out)
 
+    @staticmethod
+    def load_file_undul_cdf_h5(file_in="cdf.h5",entry_name="cdf"):
+        """
+        read a cdf.h5 file (as written by write_file_undul_cdf_h5)
+
+        :param file_in: name of the file to be read
+        :param entry_name: name of the group with the data (Default: cdf)
+        :return: a dictionary {'cdf_EnergyThetaPhi':TWO,'cdf_EnergyTheta':ONE,'cdf_Energy':ZERO,
+                'energy':E,'theta':T,'phi':P,'polarization':POL_DEGREE}
+        """
+
+        f = h5py.File(file_in,'r')
+
+        f1 = f[entry_name]
+
+        out = {}
+        for key in ["cdf_EnergyThetaPhi","cdf_EnergyTheta","cdf_Energy","energy","theta","phi","polarization"]:
+            out[key] = f1[key][()]
+
+        f.close()
+
+        return out
+
 
 
     @staticmethod
@@ -222,3 +222,49 @@ class TestSourceUndulator(unittest.TestCase):
 
 
 
+
+    def test_radiation_cache(self):
+        import tempfile
+        from syned.storage_ring.electron_beam import ElectronBeam
+        from syned.storage_ring.magnetic_structures.undulator import Undulator
+        from orangecontrib.shadow.util.undulator.source_undulator_cache import SourceUndulatorCache
+
+        su = Undulator.initialize_as_vertical_undulator(K=0.25,period_length=0.032,periods_number=50)
+        ebeam = ElectronBeam(energy_in_GeV=6.04,current=0.2)
+
+        cache = SourceUndulatorCache(directory=tempfile.mkdtemp())
+
+        def source_undulator(emin):
+            return SourceUndulator(name="test",syned_electron_beam=ebeam,syned_undulator=su,
+                                   emin=emin,emax=emin,ng_e=1,maxangle=15e-6,ng_t=21,ng_p=11,
+                                   code_undul_phot="internal",cache=cache)
+
+        u1 = source_undulator(10500.0)
+        u1.calculate_radiation()
+        self.assertEqual(len(os.listdir(cache.directory)),1)
+
+        # same parameters (sampling does not matter): read from the cache
+        u2 = source_undulator(10500.0)
+        self.assertEqual(u1.get_cache_key(),u2.get_cache_key())
+        self.assertIsNotNone(cache.load_undul_phot(u2.get_cache_key()))
+        u2.calculate_radiation()
+        assert_almost_equal(u1.get_result_radiation(),u2.get_result_radiation())
+        assert_almost_equal(u1.get_result_polarization(),u2.get_result_polarization())
+        assert_almost_equal(u1.get_result_photon_energy(),u2.get_result_photon_energy())
+
+        # different energy: new entry
+        u3 = source_undulator(10600.0)
+        self.assertNotEqual(u1.get_cache_key(),u3.get_cache_key())
+        self.assertIsNone(cache.load_undul_phot(u3.get_cache_key()))
+        u3.calculate_radiation()
+        self.assertEqual(len(os.listdir(cache.directory)),2)
+
+        # size bound: the least recently used entry is removed
+        cache.max_size = cache.get_size() - 1
+        u4 = source_undulator(10700.0)
+        u4.calculate_radiation()
+        self.assertIsNone(cache.load_undul_phot(u1.get_cache_key()))
+        self.assertIsNotNone(cache.load_undul_phot(u4.get_cache_key()))
+
+        cache.clear()
+        self.assertEqual(cache.get_size(),0)
@@ -224,6 +224,58 @@ class TestSourceUndulatorFactory(unittest.TestCase):
         self.assertAlmostEqual(diff3,0.00,delta=5e-3)
         self.assertAlmostEqual(diff4,0.00,delta=5e-3)
 
+    def test_undul_phot_vectorized(self):
+
+        print("\n#                                                            ")
+        print("# test_undul_phot_vectorized  ")
+        print("#                                                              ")
+
+        h = {}
+        h["E_ENERGY"] = 6.04
+        h["INTENSITY"] = 0.2
+        h["LAMBDAU"] = 0.032
+        h["NPERIODS"] = 50
+        h["K"] = 0.25
+        h["_EMIN"] = 10200.0
+        h["_EMAX"] = 10650.0
+        h["_NG_E"] = 11
+        h["_MAXANGLE"] = 15e-6
+        h["_NG_T"] = 51
+        h["_NG_P"] = 11
+
+        # internal code, small chunks to test the batching
+        udict = SourceUndulatorFactory.undul_phot_vectorized(E_ENERGY = h["E_ENERGY"],INTENSITY = h["INTENSITY"],
+                                        LAMBDAU = h["LAMBDAU"],NPERIODS = h["NPERIODS"],K = h["K"],
+                                        EMIN = h["_EMIN"],EMAX = h["_EMAX"],NG_E = h["_NG_E"],
+                                        MAXANGLE = h["_MAXANGLE"],NG_T = h["_NG_T"],
+                                        NG_P = h["_NG_P"],max_elements_per_chunk=100000)
+
+        udict_loop = SourceUndulatorFactory.undul_phot(E_ENERGY = h["E_ENERGY"],INTENSITY = h["INTENSITY"],
+                                        LAMBDAU = h["LAMBDAU"],NPERIODS = h["NPERIODS"],K = h["K"],
+                                        EMIN = h["_EMIN"],EMAX = h["_EMAX"],NG_E = h["_NG_E"],
+                                        MAXANGLE = h["_MAXANGLE"],NG_T = h["_NG_T"],
+                                        NG_P = h["_NG_P"])
+
+        numpy.testing.assert_almost_equal(udict["photon_energy"],udict_loop["photon_energy"])
+        numpy.testing.assert_almost_equal(udict["theta"],udict_loop["theta"])
+        numpy.testing.assert_almost_equal(udict["phi"],udict_loop["phi"])
+
+        rad = udict["radiation"]
+        pol = udict["polarization"]
+
+        self.assertEqual(rad.shape,udict_loop["radiation"].shape)
+        numpy.testing.assert_allclose(rad,udict_loop["radiation"],rtol=1e-8)
+        numpy.testing.assert_allclose(pol,udict_loop["polarization"],rtol=1e-8)
+
+        diff1 = (rad[1,1,2] - 4.42001096822e+20) / 4.42001096822e+20
+        diff2 = (rad[1,5,7] - 3.99227535348e+20) / 3.99227535348e+20
+
+        print("Relative difference    radiation[1,1,2]", diff1)
+        print("Relative difference    radiation[1,5,7]", diff2)
+
+        self.assertAlmostEqual(diff1,0.00,delta=1e-4)
+        self.assertAlmostEqual(diff2,0.00,delta=1e-4)
+
 
 
     def test_undul_phot_pysru(self):
@@ -779,3 +831,33 @@ class TestSourceUndulatorFactory(unittest.TestCase):
             plot_image(cdf3['cdf_EnergyTheta'],1e6*radiation['theta'],radiation['phi'],title="internal-trapezoidal cdf_EnergyTheta",
                        xtitle="Theta [urad]",ytitle="Phi",aspect='auto',show=False)
             plot_show()
+
+    def test_undul_cdf_dtype(self):
+
+        print("\n#                                                            ")
+        print("# test_undul_cdf_dtype  ")
+        print("#                                                              ")
+
+        E = numpy.linspace(10200.0,10650.0,11)
+        T = numpy.linspace(0,15e-6,51)
+        P = numpy.linspace(0,numpy.pi/2,11)
+
+        radiation = {'radiation':numpy.random.RandomState(0).random_sample((E.size,T.size,P.size)) * 1e20,
+                     'polarization':numpy.ones((E.size,T.size,P.size)),
+                     'photon_energy':E,'theta':T,'phi':P}
+
+        for method in ['sum','trapz']:
+            cdf64 = SourceUndulatorFactory.undul_cdf(radiation,method=method)
+            cdf32 = SourceUndulatorFactory.undul_cdf(radiation,method=method,cdf_dtype=numpy.float32)
+
+            for key in ['cdf_EnergyThetaPhi','cdf_EnergyTheta','cdf_Energy']:
+                self.assertEqual(cdf64[key].dtype,numpy.float64)
+                self.assertEqual(cdf32[key].dtype,numpy.float32)
+                numpy.testing.assert_allclose(cdf32[key],cdf64[key],rtol=1e-6)
+
+        # reference: explicit trapezoidal rule
+        YRN0 = radiation['radiation'] * numpy.sin(T)[numpy.newaxis,:,numpy.newaxis]
+        RN1 = 0.5 * (YRN0[:,:,1:] + YRN0[:,:,:-1]).sum(axis=2) * (P[1] - P[0])
+        ONE = numpy.zeros_like(RN1)
+        ONE[:,1:] = numpy.cumsum(0.5 * (RN1[:,1:] + RN1[:,:-1]),axis=1) * (T[1] - T[0])
+        numpy.testing.assert_allclose(cdf64['cdf_EnergyTheta'],ONE,rtol=1e-10)
@@ -5,6 +5,8 @@ import shutil
 import sys
 import time
 
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+
 import numpy
 import orangecanvas.resources as resources
 import scipy
@@ -23,9 +25,8 @@ from oasys.widgets import congruence
 from oasys.widgets.gui import ConfirmDialog
 from oasys.util.oasys_util import EmittingStream, TTYGrabber, TriggerIn
 
-from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowOpticalElement, ShadowPreProcessorData
-from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowMath, ShadowPhysics, MathTextLabel
-from orangecontrib.shadow.widgets.experimental_elements.random_generator import AbsorptionRandom, LorentzianRandom
+from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowBeamAccumulator, ShadowOpticalElement, ShadowPreProcessorData
+from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowMath, ShadowPhysics, ShadowMaterialTables, MathTextLabel
 from orangecontrib.shadow.widgets.gui import ow_automatic_element
 
 
@@ -109,6 +110,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
     area_detector_height = Setting(24.5)
     area_detector_width = Setting(28.9)
     area_detector_pixel_size = Setting(100.0)
+    keep_area_detector_rays = Setting(0)
 
     start_angle_na = Setting(10.0)
     stop_angle_na = Setting(120.0)
@@ -126,6 +128,8 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
     keep_result = Setting(0)
     number_of_origin_points = Setting(1)
     number_of_rotated_rays = Setting(5)
+    random_seed = Setting(0)
+    number_of_processes = Setting(1)
     normalize = Setting(1)
     degrees_around_peak = Setting(0.01)
 
@@ -213,12 +217,18 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
     random_generator_flat = random.Random()
 
-    area_detector_beam = None
+    area_detector_accumulator = None
+    area_detector_image = None
+    area_detector_binning = None
+    area_detector_twotheta_histogram = None
+    area_detector_maximum_intensity = 0.0
     area_detector_pattern = None
 
     def __init__(self):
         super().__init__()
 
+        self.area_detector_accumulator = ShadowBeamAccumulator(which_flux=1, merge_history=0)
+
         self.runaction = widget.OWAction("Run Simulation", self)
         self.runaction.triggered.connect(self.simulate)
         self.addAction(self.runaction)
@@ -291,6 +301,8 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
         oasysgui.lineEdit(box_rays, self, "number_of_origin_points", "Number of Origin Points into the Capillary", labelWidth=320, valueType=int, orientation="horizontal")
         oasysgui.lineEdit(box_rays, self, "number_of_rotated_rays", "Number of Generated Rays in the XRPD Arc", labelWidth=320, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_rays, self, "random_seed", "Random Seed (0 = random)", labelWidth=320, valueType=int, orientation="horizontal")
+        oasysgui.lineEdit(box_rays, self, "number_of_processes", "Number of Parallel Processes", labelWidth=320, valueType=int, orientation="horizontal")
 
         gui.comboBox(box_rays, self, "normalize", label="Normalize", labelWidth=320, items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal")
 
@@ -436,6 +448,8 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
                            tooltip="Detector Width [cm]", valueType=float, orientation="horizontal")
         oasysgui.lineEdit(self.box_2theta_arm_3, self, "area_detector_pixel_size", "Pixel Size [" + u"\u03BC" + "m]", labelWidth=270,
                            tooltip="Pixel Size [" + u"\u03BC" + "m]", valueType=float, orientation="horizontal")
+        gui.comboBox(self.box_2theta_arm_3, self, "keep_area_detector_rays", label="Keep all the Rays on the Detector", labelWidth=270,
+                     items=["No", "Yes"], sendSelectedValue=False, orientation="horizontal")
 
         box_scan = oasysgui.widgetBox(tab_exp_2, "Scan Parameters", addSpace=False, orientation="vertical")
 
@@ -992,18 +1006,13 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
         self.box_expdecay_2.setEnabled(self.add_expdecay == 1)
 
     def plot2DResults(self):
-        if not self.area_detector_beam is None:
-            nbins_h = int(numpy.floor(self.area_detector_width / (self.area_detector_pixel_size * self.micron_to_user_units)))
-            nbins_v = int(numpy.floor(self.area_detector_height / (self.area_detector_pixel_size * self.micron_to_user_units)))
-
-            x_range = [-self.area_detector_width/2, self.area_detector_width/2]
-            y_range = [-self.area_detector_height/2, self.area_detector_height/2]
+        if not self.area_detector_image is None:
+            nbins_h, nbins_v, _, _ = self.area_detector_binning
 
             origin = (-self.area_detector_width/2, -self.area_detector_height/2)
             scale = ((self.area_detector_pixel_size * self.micron_to_user_units), (self.area_detector_pixel_size * self.micron_to_user_units))
 
-            ticket = self.area_detector_beam._beam.histo2(1, 3, xrange=x_range, yrange=y_range, nbins_h=nbins_h, nbins_v=nbins_v, ref=23)
-            normalized_data = (ticket['histogram'] / ticket['histogram'].max()) * 100000  # just for the quality of the plot
+            normalized_data = (self.area_detector_image / self.area_detector_image.max()) * 100000  # just for the quality of the plot
 
             # inversion of axis for pyMCA
             data_to_plot = []
@@ -1028,6 +1037,69 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
             #time.sleep(0.1)
 
+    def getAreaDetectorBinning(self):
+        nbins_h = int(numpy.floor(self.area_detector_width / (self.area_detector_pixel_size * self.micron_to_user_units)))
+        nbins_v = int(numpy.floor(self.area_detector_height / (self.area_detector_pixel_size * self.micron_to_user_units)))
+
+        x_range = (-self.area_detector_width/2, self.area_detector_width/2)
+        y_range = (-self.area_detector_height/2, self.area_detector_height/2)
+
+        return nbins_h, nbins_v, x_range, y_range
+
+    # the accumulated histograms can be recalculated with a new binning only from the kept rays
+    def checkAreaDetectorBinning(self):
+        if not self.area_detector_image is None and \
+                self.area_detector_binning != self.getAreaDetectorBinning() and \
+                self.area_detector_accumulator.is_empty():
+            raise Exception("Area detector size or pixel changed, but the rays on the detector were not kept:\n" +
+                            "reset the accumulated results (or set Keep all the Rays on the Detector before accumulating)")
+
+    # running 1D (twotheta) and 2D (detector image) histograms, updated with the new rays only:
+    # same result of histogramming the whole accumulated beam (as histo2(1, 3, ref=23) for the image)
+    def accumulateAreaDetectorBeam(self, diffracted_beam):
+        self.checkAreaDetectorBinning()
+
+        area_detector_binning = self.getAreaDetectorBinning()
+
+        if self.area_detector_image is None or self.area_detector_binning != area_detector_binning:
+            nbins_h, nbins_v, _, _ = area_detector_binning
+
+            self.area_detector_binning = area_detector_binning
+            self.area_detector_image = numpy.zeros((nbins_h, nbins_v))
+            self.area_detector_twotheta_histogram = numpy.zeros(len(self.twotheta_angles))
+            self.area_detector_maximum_intensity = 0.0
+
+            if not self.area_detector_accumulator.is_empty(): # detector changed: recalculated on the kept rays
+                self.updateAreaDetectorHistograms(self.area_detector_accumulator.get_accumulated_beam()._beam.rays)
+
+        self.updateAreaDetectorHistograms(diffracted_beam._beam.rays)
+
+        if self.keep_area_detector_rays == 1: self.area_detector_accumulator.append(diffracted_beam)
+
+    def updateAreaDetectorHistograms(self, rays):
+        nbins_h, nbins_v, x_range, y_range = self.area_detector_binning
+
+        x_coord = rays[:, 0]
+        z_coord = rays[:, 2]
+
+        r_coord = numpy.sqrt(x_coord ** 2 + z_coord ** 2)
+
+        twotheta_angles = numpy.degrees(numpy.arctan(r_coord / self.area_detector_distance))
+
+        intensity = rays[:, 6] ** 2 + rays[:, 7] ** 2 + rays[:, 8] ** 2 + \
+                    rays[:, 15] ** 2 + rays[:, 16] ** 2 + rays[:, 17] ** 2
+
+        histogram, _ = numpy.histogram(a=twotheta_angles, bins=numpy.append(self.twotheta_angles, max(self.twotheta_angles) + self.step), weights=intensity)
+        image, _, _ = numpy.histogram2d(x_coord, z_coord, bins=[nbins_h, nbins_v], range=[x_range, y_range], weights=intensity)
+
+        self.area_detector_twotheta_histogram += histogram
+        self.area_detector_image += image
+        self.area_detector_maximum_intensity = max(self.area_detector_maximum_intensity, numpy.max(intensity))
+
+    # the rays collected by the area detector in all the executions (if kept)
+    def getAreaDetectorBeam(self):
+        return self.area_detector_accumulator.get_accumulated_beam()
+
     def plotResult(self, clear_caglioti=True, reflections=None):
         if not len(self.twotheta_angles)==0:
             data = numpy.add(self.counts, self.noise)
@@ -1161,6 +1233,8 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
     def checkFields(self):
         self.number_of_origin_points = congruence.checkStrictlyPositiveNumber(self.number_of_origin_points, "Number of Origin Points into the Capillary")
         self.number_of_rotated_rays = congruence.checkStrictlyPositiveNumber(self.number_of_rotated_rays, "Number of Generated Rays in the Powder Diffraction Arc")
+        self.random_seed = congruence.checkPositiveNumber(self.random_seed, "Random Seed")
+        self.number_of_processes = congruence.checkStrictlyPositiveNumber(self.number_of_processes, "Number of Parallel Processes")
 
         if self.incremental == 1:
             self.number_of_executions = congruence.checkStrictlyPositiveNumber(self.number_of_executions, "Number of Executions")
@@ -1258,21 +1332,24 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
             #self.error(self.error_id)
 
-            go = numpy.where(self.input_beam._beam.rays[:,9] == 1)
-
             go_input_beam = ShadowBeam()
-            go_input_beam._beam.rays = copy.deepcopy(self.input_beam._beam.rays[go])
+            go_input_beam._beam.rays = self.input_beam.select_rays(self.input_beam.get_column(10) == 1)
 
             number_of_input_rays = len(go_input_beam._beam.rays)
 
             if number_of_input_rays == 0: raise Exception("No good rays, modify the optical simulation")
 
-            self.random_generator_flat.seed()
-
             input_rays = range(0, number_of_input_rays)
 
             self.checkFields()
 
+            if self.random_seed == 0:
+                self.random_generator_flat.seed()
+                seed_sequence = numpy.random.SeedSequence()
+            else:
+                self.random_generator_flat.seed(self.random_seed)
+                seed_sequence = numpy.random.SeedSequence(self.random_seed)
+
             self.backupOutFile()
 
             self.run_simulation = True
@@ -1283,11 +1360,15 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
             if (self.incremental==1):
                 executions = range(0, self.number_of_executions)
 
+            seed_sequences = seed_sequence.spawn(len(executions)) # independent random streams for each execution
+
             ################################
             # ARRAYS FOR OUTPUT AND PLOTS
 
             steps = self.initialize()
 
+            if self.diffracted_arm_type == 2: self.checkAreaDetectorBinning()
+
             ################################
             # PARAMETERS CALCULATED ONCE
 
@@ -1359,7 +1440,8 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
                                                                          go_input_beam,
                                                                          input_rays,
                                                                          (50/number_of_input_rays),
-                                                                         reflections)
+                                                                         reflections,
+                                                                         seed_sequence=seed_sequences[execution])
 
                 self.average_absorption_coefficient = round(numpy.array(self.absorption_coefficients).mean(), 2) # cm-1
                 self.muR = round(self.average_absorption_coefficient*self.capillary_diameter*0.5*self.mm_to_cm, 2) # distance in cm
@@ -1428,238 +1510,108 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
     # SIMULATION ALGORITHM METHODS
     ############################################################
 
-    def generateDiffractedRays(self, bar_value, capillary_radius, displacement_h, displacement_v, go_input_beam, input_rays, percentage_fraction, reflections):
+    def generateDiffractedRays(self, bar_value, capillary_radius, displacement_h, displacement_v, go_input_beam, input_rays, percentage_fraction, reflections,
+                               seed_sequence=None, max_elements_per_chunk=2**20):
+        if seed_sequence is None: seed_sequence = numpy.random.SeedSequence()
 
-        diffracted_rays = []
+        rays = go_input_beam._beam.rays[numpy.asarray(input_rays, dtype=int)]
 
-        no_prog = False
+        generator = self.createDiffractedRaysGenerator(rays, capillary_radius, displacement_h, displacement_v, reflections)
 
-        for ray_index in input_rays:
-            if not self.run_simulation: break
-            # costruzione intersezione con capillare (interno ed esterno x assorbimento) + displacement del capillare
-
-            Es_x = go_input_beam._beam.rays[ray_index, 6]
-            Es_y = go_input_beam._beam.rays[ray_index, 7]
-            Es_z = go_input_beam._beam.rays[ray_index, 8]
-            k_mod = go_input_beam._beam.rays[ray_index, 10]
-            Es_phi = go_input_beam._beam.rays[ray_index, 13]
-            Ep_phi = go_input_beam._beam.rays[ray_index, 14]
-            Ep_x = go_input_beam._beam.rays[ray_index, 15]
-            Ep_y = go_input_beam._beam.rays[ray_index, 16]
-            Ep_z = go_input_beam._beam.rays[ray_index, 17]
-
-            wrong_numbers = numpy.isnan(Es_x) or numpy.isnan(Es_y) or numpy.isnan(Es_z) or \
-                            numpy.isnan(Ep_x) or numpy.isnan(Ep_y) or numpy.isnan(Ep_z) or \
-                            numpy.isnan(Es_phi) or numpy.isnan(Ep_phi) or numpy.isnan(k_mod)
-
-            if not wrong_numbers:
-                x_0 = go_input_beam._beam.rays[ray_index, 0]
-                y_0 = go_input_beam._beam.rays[ray_index, 1]
-                z_0 = go_input_beam._beam.rays[ray_index, 2]
-
-                if (y_0 ** 2 + z_0 ** 2 < capillary_radius ** 2):
-                    v_0_x = go_input_beam._beam.rays[ray_index, 3]
-                    v_0_y = go_input_beam._beam.rays[ray_index, 4]
-                    v_0_z = go_input_beam._beam.rays[ray_index, 5]
-
-                    k_1 = v_0_y / v_0_x
-                    k_2 = v_0_z / v_0_x
-
-                    a = (k_1 ** 2 + k_2 ** 2)
-                    b = 2 * (k_1 * (y_0 + displacement_h) + k_2 * (z_0 + displacement_v))
-                    c = (y_0 ** 2 + z_0 ** 2 + 2 * displacement_h * y_0 + 2 * displacement_v * z_0) - \
-                        capillary_radius ** 2 + (displacement_h ** 2 + displacement_v ** 2)
-
-                    if (self.calculate_absorption == 1): c_2 = (
-                                                               y_0 ** 2 + z_0 ** 2 + 2 * displacement_h * y_0 + 2 * displacement_v * z_0) - \
-                                                               (capillary_radius + (
-                                                               self.capillary_thickness * self.micron_to_user_units)) ** 2 + (
-                                                               displacement_h ** 2 + displacement_v ** 2)
-
-                    discriminant = b ** 2 - 4 * a * c
-                    if (self.calculate_absorption == 1): discriminant_2 = b ** 2 - 4 * a * c_2
-
-                    if discriminant > 0.0:
-                        x_sol_1 = (-b - numpy.sqrt(discriminant)) / (2 * a)
-                        x_1 = x_0 + x_sol_1
-                        y_1 = y_0 + k_1 * x_sol_1
-                        z_1 = z_0 + k_2 * x_sol_1
-
-                        x_sol_2 = (-b + numpy.sqrt(discriminant)) / (2 * a)
-                        x_2 = x_0 + x_sol_2
-                        y_2 = y_0 + k_1 * x_sol_2
-                        z_2 = z_0 + k_2 * x_sol_2
-
-                        if (self.calculate_absorption == 1):
-                            x_sol_1_out = (-b - numpy.sqrt(discriminant_2)) / (2 * a)
-                            x_1_out = x_0 + x_sol_1_out
-                            y_1_out = y_0 + k_1 * x_sol_1_out
-                            z_1_out = z_0 + k_2 * x_sol_1_out
-
-                            x_sol_2_out = (-b + numpy.sqrt(discriminant_2)) / (2 * a)
-                            x_2_out = x_0 + x_sol_2_out
-                            y_2_out = y_0 + k_1 * x_sol_2
-                            z_2_out = z_0 + k_2 * x_sol_2
-
-                        if (y_1 < y_2):
-                            entry_point = [x_1, y_1, z_1]
-                            if (self.calculate_absorption == 1): entry_point_out = [x_1_out, y_1_out, z_1_out]
-                            exit_point = [x_2, y_2, z_2]
-                        else:
-                            entry_point = [x_2, y_2, z_2]
-                            if (self.calculate_absorption == 1): entry_point_out = [x_2_out, y_2_out, z_2_out]
-                            exit_point = [x_1, y_1, z_1]
-
-                        path = ShadowMath.vector_modulus(ShadowMath.vector_difference(exit_point, entry_point))
-
-                        x_axis = [1, 0, 0]
-                        v_in = [v_0_x, v_0_y, v_0_z]
-
-                        z_axis_ray = ShadowMath.vectorial_product(x_axis, v_in)
-                        rotation_axis_diffraction = ShadowMath.vectorial_product(v_in, z_axis_ray)
-                        rotation_axis_debye_circle = v_in
-
-                        wavelength = ShadowPhysics.getWavelengthFromShadowK(k_mod) # in Angstrom
-
-                        if self.calculate_absorption == 1:
-                            mu = self.getLinearAbsorptionCoefficient(wavelength) # in cm-1
-                            self.absorption_coefficients.append(mu)
-                            random_generator_absorption = AbsorptionRandom(mu, path)
-
-                        for origin_point_index in range(0, int(self.number_of_origin_points)):
-
-                            if self.calculate_absorption == 1:
-                                random_path = random_generator_absorption.random()
-                            else:
-                                random_path = path * self.random_generator_flat.random()
+        chunk_size = generator.getChunkSize(max_elements_per_chunk)
+        chunks = [rays[start:start + chunk_size] for start in range(0, len(rays), chunk_size)]
 
-                            # calcolo di un punto casuale sul segmento congiungente.
+        # one independent random stream per chunk: the result does not depend on the number of processes
+        seeds = seed_sequence.spawn(len(chunks))
 
-                            x_point = entry_point[0] + random_path * v_in[0]
-                            y_point = entry_point[1] + random_path * v_in[1]
-                            z_point = entry_point[2] + random_path * v_in[2]
+        results = [None]*len(chunks)
 
-                            origin_point = [x_point, y_point, z_point]
+        if self.number_of_processes <= 1 or len(chunks) <= 1:
+            for index, chunk in enumerate(chunks):
+                if not self.run_simulation: break
 
-                            for reflection in reflections:
-                                if not self.run_simulation: break
-
-                                ray_bragg_angle = self.calculateBraggAngle(reflection, wavelength)
-
-                                delta_theta_darwin = (numpy.random.random() - 0.5) * self.calculateDarwinWidth(reflection, wavelength, ray_bragg_angle)  # darwin width fluctuations
-
-                                if self.residual_average_size > 0:
-                                    random_generator_size = LorentzianRandom(self.calculateBetaSize(wavelength, ray_bragg_angle))
-                                    delta_theta_size = random_generator_size.random() # residual size effects
-                                else:
-                                    delta_theta_size = 0.0
+                results[index] = generator.generate(chunk, seeds[index])
 
-                                twotheta_reflection = 2 * (ray_bragg_angle + delta_theta_darwin + delta_theta_size)
-
-                                # rotazione del vettore d'onda pari all'angolo di bragg
-                                #
-                                # calcolo del vettore ruotato di 2theta bragg, con la formula di Rodrigues:
-                                #
-                                # k_diffracted = k * cos(2th) + (asse_rot x k) * sin(2th) + asse_rot*(asse_rot . k)(1 - cos(2th))
-                                #
-
-                                v_out_temp = ShadowMath.vector_rotate(rotation_axis_diffraction, twotheta_reflection, v_in)
-
-                                # intersezione raggi con sfera di raggio distanza con il detector. le intersezioni con Z < 0 vengono rigettate
-                                #
-                                # retta P = origin_point + v t
-                                #
-                                # punto P0 minima distanza con il centro della sfera in 0,0,0
-                                #
-                                # (P0 - O) * v = 0 => P0 * v = 0 => (origin_point + v t0) * v = 0
-                                #
-                                # => t0 = - origin_point * v
-
-                                t_0 = -1 * ShadowMath.scalar_product(origin_point, v_out_temp)
-                                P_0 = ShadowMath.vector_sum(origin_point, ShadowMath.vector_multiply(v_out_temp, t_0))
-
-                                b = ShadowMath.vector_modulus(P_0)
-                                if self.diffracted_arm_type == 0:   distance = self.detector_distance
-                                elif self.diffracted_arm_type == 1: distance = self.analyzer_distance
-                                elif self.diffracted_arm_type == 2: distance = self.area_detector_distance
-
-                                a = numpy.sqrt(distance** 2 - b** 2)
-
-                                # N.B. punti di uscita hanno solo direzione in avanti.
-                                P_2 = ShadowMath.vector_sum(origin_point,
-                                                            ShadowMath.vector_multiply(v_out_temp, t_0 + a))
-
-                                # ok se P2 con z > 0
-                                if (P_2[2] >= 0):
-
-                                    #
-                                    # genesi del nuovo raggio diffratto attenuato dell'intensità relativa e dell'assorbimento
-                                    #
-
-                                    delta_angles = self.calculateDeltaAngles()
-
-                                    for delta_index in range(0, len(delta_angles)):
-
-                                        delta_angle = delta_angles[delta_index]
-
-                                        #
-                                        # calcolo del vettore ruotato di delta, con la formula di Rodrigues:
-                                        #
-                                        # v_out_new = v_out * cos(delta) + (asse_rot x v_out ) * sin(delta) + asse_rot*(asse_rot . v_out )(1 - cos(delta))
-                                        #
-                                        # asse rot = v_in
-                                        #
-
-                                        v_out = ShadowMath.vector_rotate(rotation_axis_debye_circle, delta_angle, v_out_temp)
-
-                                        reduction_factor = reflection.relative_intensity
-
-                                        if (self.calculate_absorption == 1):
-                                            reduction_factor = reduction_factor * self.calculateAbsorption(wavelength,
-                                                                                                           entry_point,
-                                                                                                           entry_point_out,
-                                                                                                           origin_point,
-                                                                                                           v_out,
-                                                                                                           capillary_radius,
-                                                                                                           displacement_h,
-                                                                                                           displacement_v)
-
-                                        reduction_factor = numpy.sqrt(reduction_factor)
-
-                                        diffracted_ray_circle = numpy.zeros(18)
-
-                                        diffracted_ray_circle[0] = origin_point[0]  # X
-                                        diffracted_ray_circle[1] = origin_point[1]  # Y
-                                        diffracted_ray_circle[2] = origin_point[2]  # Z
-                                        diffracted_ray_circle[3] = v_out[0]  # director cos x
-                                        diffracted_ray_circle[4] = v_out[1]  # director cos y
-                                        diffracted_ray_circle[5] = v_out[2]  # director cos z
-                                        diffracted_ray_circle[6] = Es_x * reduction_factor
-                                        diffracted_ray_circle[7] = Es_y * reduction_factor
-                                        diffracted_ray_circle[8] = Es_z * reduction_factor
-                                        diffracted_ray_circle[9] = go_input_beam._beam.rays[ray_index, 9]  # good/lost
-                                        diffracted_ray_circle[10] = k_mod  # |k|
-                                        diffracted_ray_circle[11] = go_input_beam._beam.rays[ray_index, 11]  # ray index
-                                        diffracted_ray_circle[12] = go_input_beam._beam.rays[ray_index, 12]  # optical path
-                                        diffracted_ray_circle[13] = Es_phi
-                                        diffracted_ray_circle[14] = Ep_phi
-                                        diffracted_ray_circle[15] = Ep_x * reduction_factor
-                                        diffracted_ray_circle[16] = Ep_y * reduction_factor
-                                        diffracted_ray_circle[17] = Ep_z * reduction_factor
-
-                                        diffracted_rays.append(diffracted_ray_circle)
-
-                bar_value = bar_value + percentage_fraction
-
-                if int(bar_value) % 5 == 0:
-                    if not no_prog:
-                        self.progressBarSet(bar_value)
-                        no_prog = True
-                else:
-                    no_prog = False
+                bar_value = bar_value + percentage_fraction*len(chunk)
+                self.progressBarSet(bar_value)
+        else:
+            executor = ProcessPoolExecutor(max_workers=int(self.number_of_processes))
+
+            try:
+                futures = {executor.submit(generator.generate, chunk, seeds[index]): index for index, chunk in enumerate(chunks)}
+                pending = set(futures.keys())
+
+                while len(pending) > 0:
+                    done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        results[futures[future]] = future.result()
+                        bar_value = bar_value + percentage_fraction*len(chunks[futures[future]])
+
+                    self.progressBarSet(bar_value)
+                    QApplication.processEvents() # Stop button
+
+                    if not self.run_simulation: break
+            finally:
+                for future in futures: future.cancel() # not yet started (shutdown(cancel_futures=True) needs python >= 3.9)
+                executor.shutdown(wait=False)
+
+        results = [result for result in results if not result is None]
+
+        diffracted_rays = numpy.empty((sum([len(diffracted_rays_chunk) for diffracted_rays_chunk, _ in results]), 18))
+
+        start = 0
+        for diffracted_rays_chunk, absorption_coefficients in results:
+            diffracted_rays[start:start + len(diffracted_rays_chunk)] = diffracted_rays_chunk
+            start += len(diffracted_rays_chunk)
+
+            self.absorption_coefficients.extend(absorption_coefficients.tolist())
 
         return bar_value, diffracted_rays
 
+    def createDiffractedRaysGenerator(self, rays, capillary_radius, displacement_h, displacement_v, reflections):
+        # xraylib is called here, once per distinct wavelength of the beam
+        wavelengths = numpy.unique(ShadowPhysics.getWavelengthFromShadowK(rays[:, 10])) # in Angstrom
+        wavelengths = wavelengths[numpy.logical_not(numpy.isnan(wavelengths))]
+
+        bragg_angles = numpy.array([[self.calculateBraggAngle(reflection, wavelength) for reflection in reflections] for wavelength in wavelengths]).reshape((len(wavelengths), len(reflections)))
+        darwin_widths = numpy.array([[self.calculateDarwinWidth(reflection, wavelength, bragg_angles[wavelength_index, reflection_index]) for reflection_index, reflection in enumerate(reflections)]
+                                     for wavelength_index, wavelength in enumerate(wavelengths)]).reshape((len(wavelengths), len(reflections)))
+
+        if self.residual_average_size > 0:
+            beta_sizes = numpy.array([self.calculateBetaSize(wavelength, bragg_angles[wavelength_index]) for wavelength_index, wavelength in enumerate(wavelengths)]).reshape((len(wavelengths), len(reflections)))
+        else:
+            beta_sizes = None
+
+        if self.calculate_absorption == 1:
+            mu = self.getLinearAbsorptionCoefficient(wavelengths)
+            mu_capillary = self.getCapillaryLinearAbsorptionCoefficient(wavelengths)
+        else:
+            mu = None
+            mu_capillary = None
+
+        if self.diffracted_arm_type == 0:   distance = self.detector_distance
+        elif self.diffracted_arm_type == 1: distance = self.analyzer_distance
+        elif self.diffracted_arm_type == 2: distance = self.area_detector_distance
+
+        return DiffractedRaysGenerator(capillary_radius=capillary_radius,
+                                       capillary_outer_radius=capillary_radius + (self.capillary_thickness * self.micron_to_user_units),
+                                       displacement_h=displacement_h,
+                                       displacement_v=displacement_v,
+                                       distance=distance,
+                                       number_of_origin_points=self.number_of_origin_points,
+                                       number_of_rotated_rays=self.number_of_rotated_rays,
+                                       delta_angle_limit=self.calculateDeltaAngleLimit(),
+                                       relative_intensities=[reflection.relative_intensity for reflection in reflections],
+                                       wavelengths=wavelengths,
+                                       bragg_angles=bragg_angles,
+                                       darwin_widths=darwin_widths,
+                                       beta_sizes=beta_sizes,
+                                       mu=mu,
+                                       mu_capillary=mu_capillary,
+                                       absorption_normalization_factor=self.absorption_normalization_factor,
+                                       workspace_units_to_cm=self.workspace_units_to_cm)
+
     def calculateBraggAngle(self, reflection, wavelength):
         crystal = self.getMaterialXraylibCrystal(self.sample_material)
         energy = ShadowPhysics.getEnergyFromWavelength(wavelength)/1000
@@ -1695,7 +1647,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
         diffracted_beam = ShadowBeam()
 
         if (number_of_diffracted_rays > 0 and self.run_simulation):
-            diffracted_beam._beam.rays = numpy.array(diffracted_rays)
+            diffracted_beam._beam.rays = diffracted_rays
 
             percentage_fraction = 50 / len(reflections)
 
@@ -1729,31 +1681,10 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
                                                          normalization, debye_waller_B, statistic_factor)
                 if not diffracted_beam is None:
                     if ShadowCongruence.checkGoodBeam(diffracted_beam):
-                        if self.area_detector_beam is None:
-                            self.area_detector_beam = diffracted_beam
-                        else:
-                            self.area_detector_beam = ShadowBeam.mergeBeams(self.area_detector_beam, diffracted_beam, which_flux=1, merge_history=0)
-
-                        # Creation of 1D pattern: weighted (with intensity) histogram of twotheta angles
-                        x_coord = self.area_detector_beam._beam.rays[:, 0]
-                        z_coord = self.area_detector_beam._beam.rays[:, 2]
-
-                        r_coord = numpy.sqrt(x_coord ** 2 + z_coord ** 2)
-
-                        twotheta_angles = numpy.degrees(numpy.arctan(r_coord / self.area_detector_distance))
-
-                        intensity = self.area_detector_beam._beam.rays[:, 6] ** 2 + self.area_detector_beam._beam.rays[:, 7] ** 2 + self.area_detector_beam._beam.rays[:, 8] ** 2 + \
-                                    self.area_detector_beam._beam.rays[:, 15] ** 2 + self.area_detector_beam._beam.rays[:, 16] ** 2 + self.area_detector_beam._beam.rays[:, 17] ** 2
+                        self.accumulateAreaDetectorBeam(diffracted_beam)
 
-                        maximum = numpy.max(intensity)
-
-                        weights = (intensity / maximum)
-
-                        histogram, edges = numpy.histogram(a=twotheta_angles, bins=numpy.append(self.twotheta_angles,
-                                                                                                max(self.twotheta_angles) + self.step),
-                                                           weights=weights)
-
-                        self.counts = histogram
+                        # 1D pattern: weighted (with intensity normalized to the maximum) histogram of twotheta angles
+                        self.counts = self.area_detector_twotheta_histogram / self.area_detector_maximum_intensity
 
                 self.plot2DResults()
                 self.plotResult(reflections=reflections)
@@ -1840,7 +1771,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
     ############################################################
 
-    def calculateDeltaAngles(self):
+    def calculateDeltaAngleLimit(self):
 
         if self.diffracted_arm_type == 0:
             width = self.slit_1_horizontal_aperture*self.micron_to_user_units*0.5
@@ -1856,15 +1787,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
         else:
             delta=numpy.pi
 
-        delta_angles = []
-
-        for index in range(0, int(self.number_of_rotated_rays)):
-            delta_random = self.random_generator_flat.random()*delta
-            discriminant = self.random_generator_flat.random()
-
-            delta_angles.append(delta_random if discriminant < 0.5 else -delta_random)
-
-        return delta_angles
+        return delta
 
     ############################################################
         
@@ -1991,119 +1914,17 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
     # PHYSICAL CALCULATIONS
     ############################################################
 
-    def calculateAbsorption(self, wavelength, entry_point, entry_point_out, origin_point, direction_versor, capillary_radius, displacement_h, displacement_v):
-
-        absorption = 0
-
-        #
-        # calcolo intersezione del raggio con superficie interna ed esterna del capillare:
-        #
-        # x = xo + x' t
-        # y = yo + y' t
-        # z = zo + z' t
-        #
-        # (y-dh)^2 + (z-dv)^2 = (Dc/2)^2
-        # (y-dh)^2 + (z-dv)^2 = ((Dc+thickness)/2)^2
-
-        x_0 = origin_point[0]
-        y_0 = origin_point[1]
-        z_0 = origin_point[2]
-
-        k_1 = direction_versor[1]/direction_versor[0]
-        k_2 = direction_versor[2]/direction_versor[0]
-
-        #
-        # parametri a b c per l'equazione a(x-x0)^2 + b(x-x0) + c = 0
-        #
-
-        a = (k_1**2 + k_2**2)
-        b = 2*(k_1*(y_0+displacement_h) + k_2*(z_0+displacement_v))
-        c = (y_0**2 + z_0**2 + 2*displacement_h*y_0 + 2*displacement_v*z_0) - capillary_radius**2 + (displacement_h**2 + displacement_v**2)
-        c_2 = (y_0**2 + z_0**2 + 2*displacement_h*y_0 + 2*displacement_v*z_0) - (capillary_radius+(self.capillary_thickness*self.micron_to_user_units))**2 + (displacement_h**2 + displacement_v**2)
-
-        discriminant = b**2 - 4*a*c
-        discriminant_2 = b**2 - 4*a*c_2
-
-        if (discriminant > 0):
-
-            # equazioni risolte per x-x0
-            x_1 = (-b + numpy.sqrt(discriminant))/(2*a) # (x-x0)_1
-            x_2 = (-b - numpy.sqrt(discriminant))/(2*a) # (x-x0)_2
-
-            x_1_out = (-b + numpy.sqrt(discriminant_2))/(2*a) # (x-x0)_1
-            x_2_out = (-b - numpy.sqrt(discriminant_2))/(2*a) # (x-x0)_2
-
-            x_sol = 0
-            y_sol = 0
-            z_sol = 0
-
-            x_sol_out = 0
-            y_sol_out = 0
-            z_sol_out = 0
-
-            # solutions only with z > 0 and
-            # se y-y0 > 0 allora il versore deve avere y' > 0
-            # se y-y0 < 0 allora il versore deve avere y' < 0
-
-            z_1 = z_0 + k_2*x_1
-
-            find_solution = False
-
-            if (z_1 >= 0 or (z_1 < 0 and direction_versor[1] > 0)):
-                if (numpy.sign((k_1*x_1))==numpy.sign(direction_versor[1])):
-                    x_sol = x_1 + x_0
-                    y_sol = y_0 + k_1*x_1
-                    z_sol = z_1
-
-                    x_sol_out = x_1_out + x_0
-                    y_sol_out = y_0 + k_1*x_1_out
-                    z_sol_out = z_0 + k_2*x_1_out
-
-                    find_solution = True
-
-            if not find_solution:
-                z_2 = z_0 + k_2*x_2
-
-                if (z_2 >= 0 or (z_1 < 0 and direction_versor[1] > 0)):
-                    if (numpy.sign((k_1*x_2))==numpy.sign(direction_versor[1])):
-                        x_sol = x_2 + x_0
-                        y_sol = y_0 + k_1*x_2
-                        z_sol = z_2
-
-                        x_sol_out = x_2_out + x_0
-                        y_sol_out = y_0 + k_1*x_2_out
-                        z_sol_out = z_0 + k_2*x_2_out
-
-                        find_solution = True
-
-            if find_solution:
-                exit_point = [x_sol, y_sol, z_sol]
-                exit_point_out = [x_sol_out, y_sol_out, z_sol_out]
-
-                distance = ShadowMath.point_distance(entry_point, origin_point) + ShadowMath.point_distance(origin_point, exit_point)
-                distance *= self.workspace_units_to_cm
-                distance_out = ShadowMath.point_distance(entry_point_out, entry_point) + ShadowMath.point_distance(exit_point, exit_point_out)
-                distance_out *= self.workspace_units_to_cm
-
-                absorption = self.getCapillaryTransmittance(distance_out, wavelength)*self.getTransmittance(distance, wavelength)*self.absorption_normalization_factor
-            else:
-                absorption = 0 # kill the ray
-
-        return absorption
-
     ############################################################
 
-    def getLinearAbsorptionCoefficient(self, wavelength):
-        mu = xraylib.CS_Total_CP(self.getChemicalFormula(self.sample_material), ShadowPhysics.getEnergyFromWavelength(wavelength)/1000) # energy in KeV
-        rho = self.getDensity(self.sample_material)*self.packing_factor
-
-        return mu*rho
+    def getLinearAbsorptionCoefficient(self, wavelength): # wavelength: scalar or array
+        return ShadowMaterialTables.get_linear_absorption_coefficient(self.getChemicalFormula(self.sample_material),
+                                                                      self.getDensity(self.sample_material)*self.packing_factor,
+                                                                      ShadowPhysics.getEnergyFromWavelength(wavelength))
 
     def getCapillaryLinearAbsorptionCoefficient(self, wavelength): #in cm-1
-        mu = xraylib.CS_Total_CP(self.getCapillaryChemicalFormula(self.capillary_material), ShadowPhysics.getEnergyFromWavelength(wavelength)/1000) # energy in KeV
-        rho = self.getCapillaryDensity(self.capillary_material)
-
-        return mu*rho
+        return ShadowMaterialTables.get_linear_absorption_coefficient(self.getCapillaryChemicalFormula(self.capillary_material),
+                                                                      self.getCapillaryDensity(self.capillary_material),
+                                                                      ShadowPhysics.getEnergyFromWavelength(wavelength))
 
     def getTransmittance(self, path_in_cm, wavelength):
         return numpy.exp(-self.getLinearAbsorptionCoefficient(wavelength) * path_in_cm)
@@ -2414,7 +2235,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 
         out_beam = ShadowBeam.traceFromOE(input_beam, empty_element, history=False)
 
-        go_rays = copy.deepcopy(out_beam._beam.rays[numpy.where(out_beam._beam.rays[:, 9] == 1)])
+        go_rays = out_beam.select_rays(out_beam.get_column(10) == 1)
 
         percentage_fraction = 50 / len(go_rays)
         no_prog = False
@@ -2478,7 +2299,7 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
             else:
                 no_prog = False
 
-        out_beam._beam.rays = copy.deepcopy(go_rays[numpy.where(go_rays[:, 9] == 1)])
+        out_beam._beam.rays = go_rays[go_rays[:, 9] == 1]
 
         return out_beam
 
@@ -2492,7 +2313,11 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
         self.stop_angle = self.stop_angle_na #+ self.shift_2theta
 
         if self.keep_result == 0 or len(self.twotheta_angles) == 0 or self.reset_button_pressed:
-            self.area_detector_beam = None
+            self.area_detector_accumulator.reset()
+            self.area_detector_image = None
+            self.area_detector_binning = None
+            self.area_detector_twotheta_histogram = None
+            self.area_detector_maximum_intensity = 0.0
             self.area_detector_pattern = None
             self.twotheta_angles = []
             self.counts = []
@@ -2841,6 +2666,335 @@ class XRDCapillary(ow_automatic_element.AutomaticElement):
 ############################################################
 ############################################################
 
+class DiffractedRaysGenerator:
+    # the numeric part of the XRD capillary simulation (see XRDCapillary.generateDiffractedRays): it contains only numbers
+    # and arrays, xraylib quantities are tabulated in advance on the wavelengths of the beam, so it can be sent to
+    # other processes
+
+    RANDOM_GENERATOR_BINS = 1000 # as in random_generator.py
+
+    def __init__(self,
+                 capillary_radius,
+                 capillary_outer_radius,
+                 displacement_h,
+                 displacement_v,
+                 distance,
+                 number_of_origin_points,
+                 number_of_rotated_rays,
+                 delta_angle_limit,
+                 relative_intensities,
+                 wavelengths,
+                 bragg_angles,
+                 darwin_widths,
+                 beta_sizes=None,
+                 mu=None,
+                 mu_capillary=None,
+                 absorption_normalization_factor=1.0,
+                 workspace_units_to_cm=1.0):
+        self.capillary_radius = capillary_radius
+        self.capillary_outer_radius = capillary_outer_radius
+        self.displacement_h = displacement_h
+        self.displacement_v = displacement_v
+        self.distance = distance
+        self.number_of_origin_points = int(number_of_origin_points)
+        self.number_of_rotated_rays = int(number_of_rotated_rays)
+        self.delta_angle_limit = delta_angle_limit
+        self.relative_intensities = numpy.asarray(relative_intensities) # per reflection
+        self.wavelengths = wavelengths     # sorted, in Angstrom
+        self.bragg_angles = bragg_angles   # wavelengths x reflections
+        self.darwin_widths = darwin_widths # wavelengths x reflections
+        self.beta_sizes = beta_sizes       # wavelengths x reflections, None: no residual size effects
+        self.mu = mu                       # per wavelength, in cm-1, None: no absorption
+        self.mu_capillary = mu_capillary   # per wavelength, in cm-1
+        self.absorption_normalization_factor = absorption_normalization_factor
+        self.workspace_units_to_cm = workspace_units_to_cm
+
+    def getChunkSize(self, max_elements_per_chunk=2**20):
+        elements_per_ray = max(self.number_of_origin_points*len(self.relative_intensities)*self.number_of_rotated_rays, self.RANDOM_GENERATOR_BINS + 1)
+
+        return max(1, max_elements_per_chunk // elements_per_ray)
+
+    def generate(self, rays, seed=None):
+        """
+        :param rays: the input rays (N x 18)
+        :param seed: seed of the random stream (int, numpy.random.SeedSequence or numpy.random.Generator)
+        :return: the diffracted rays, the sample linear absorption coefficients of the rays hitting the capillary
+        """
+        random_generator = numpy.random.default_rng(seed)
+
+        calculate_absorption = not self.mu is None
+
+        capillary_radius = self.capillary_radius
+        displacement_h = self.displacement_h
+        displacement_v = self.displacement_v
+
+        rays = rays[numpy.logical_not(numpy.any(numpy.isnan(rays[:, [6, 7, 8, 10, 13, 14, 15, 16, 17]]), axis=1))]
+        rays = rays[rays[:, 1] ** 2 + rays[:, 2] ** 2 < capillary_radius ** 2]
+
+        # costruzione intersezione con capillare (interno ed esterno x assorbimento) + displacement del capillare
+
+        x_0 = rays[:, 0]
+        y_0 = rays[:, 1]
+        z_0 = rays[:, 2]
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            k_1 = rays[:, 4] / rays[:, 3]
+            k_2 = rays[:, 5] / rays[:, 3]
+
+            a = (k_1 ** 2 + k_2 ** 2)
+            b = 2 * (k_1 * (y_0 + displacement_h) + k_2 * (z_0 + displacement_v))
+            c = (y_0 ** 2 + z_0 ** 2 + 2 * displacement_h * y_0 + 2 * displacement_v * z_0) - \
+                capillary_radius ** 2 + (displacement_h ** 2 + displacement_v ** 2)
+
+            discriminant = b ** 2 - 4 * a * c
+
+            intersecting = discriminant > 0.0
+
+        rays         = rays[intersecting]
+        x_0, y_0, z_0, k_1, k_2, a, b, discriminant = [array[intersecting] for array in [x_0, y_0, z_0, k_1, k_2, a, b, discriminant]]
+
+        number_of_rays = len(rays)
+
+        if number_of_rays == 0: return numpy.zeros((0, 18)), numpy.zeros(0)
+
+        x_sol_1 = (-b - numpy.sqrt(discriminant)) / (2 * a)
+        x_sol_2 = (-b + numpy.sqrt(discriminant)) / (2 * a)
+
+        point_1 = numpy.stack([x_0 + x_sol_1, y_0 + k_1 * x_sol_1, z_0 + k_2 * x_sol_1], axis=1)
+        point_2 = numpy.stack([x_0 + x_sol_2, y_0 + k_1 * x_sol_2, z_0 + k_2 * x_sol_2], axis=1)
+
+        first_is_entry = (point_1[:, 1] < point_2[:, 1])[:, numpy.newaxis]
+
+        entry_point = numpy.where(first_is_entry, point_1, point_2)
+        exit_point  = numpy.where(first_is_entry, point_2, point_1)
+
+        path = numpy.sqrt(numpy.sum((exit_point - entry_point) ** 2, axis=1))
+
+        wavelength_index = numpy.searchsorted(self.wavelengths, ShadowPhysics.getWavelengthFromShadowK(rays[:, 10]))
+
+        if calculate_absorption:
+            c_2 = (y_0 ** 2 + z_0 ** 2 + 2 * displacement_h * y_0 + 2 * displacement_v * z_0) - \
+                  self.capillary_outer_radius ** 2 + (displacement_h ** 2 + displacement_v ** 2)
+
+            discriminant_2 = b ** 2 - 4 * a * c_2
+
+            x_sol_1_out = (-b - numpy.sqrt(discriminant_2)) / (2 * a)
+            x_sol_2_out = (-b + numpy.sqrt(discriminant_2)) / (2 * a)
+
+            # y, z of the second outer point are calculated with the inner solution, as in the original ray-by-ray algorithm
+            point_1_out = numpy.stack([x_0 + x_sol_1_out, y_0 + k_1 * x_sol_1_out, z_0 + k_2 * x_sol_1_out], axis=1)
+            point_2_out = numpy.stack([x_0 + x_sol_2_out, y_0 + k_1 * x_sol_2, z_0 + k_2 * x_sol_2], axis=1)
+
+            entry_point_out = numpy.where(first_is_entry, point_1_out, point_2_out)
+
+            mu = self.mu[wavelength_index]
+            mu_capillary = self.mu_capillary[wavelength_index]
+
+            # AbsorptionRandom(mu, path)
+            step = path / self.RANDOM_GENERATOR_BINS
+            points = numpy.arange(self.RANDOM_GENERATOR_BINS + 1) * step[:, numpy.newaxis]
+
+            random_path = self.sampleDiscreteDistributions(numpy.cumsum(numpy.floor(10000 * numpy.exp(-mu[:, numpy.newaxis] * points)), axis=1),
+                                                             points,
+                                                             self.number_of_origin_points,
+                                                             random_generator)
+        else:
+            mu = numpy.zeros(0)
+            random_path = path[:, numpy.newaxis] * random_generator.random((number_of_rays, self.number_of_origin_points))
+
+        v_in = rays[:, 3:6]
+
+        # calcolo di un punto casuale sul segmento congiungente: rays x origin points
+
+        origin_point = entry_point[:, numpy.newaxis, :] + random_path[:, :, numpy.newaxis] * v_in[:, numpy.newaxis, :]
+
+        x_axis = numpy.array([1.0, 0.0, 0.0])
+
+        z_axis_ray = numpy.cross(x_axis, v_in)
+        rotation_axis_diffraction = numpy.cross(v_in, z_axis_ray)
+        rotation_axis_debye_circle = v_in
+
+        # angles: rays x origin points x reflections
+
+        twotheta_reflection = numpy.zeros((number_of_rays, self.number_of_origin_points, len(self.relative_intensities)))
+
+        for reflection_index in range(len(self.relative_intensities)):
+            ray_bragg_angle = self.bragg_angles[wavelength_index, reflection_index][:, numpy.newaxis]
+
+            delta_theta_darwin = (random_generator.random(twotheta_reflection.shape[:2]) - 0.5) * \
+                                 self.darwin_widths[wavelength_index, reflection_index][:, numpy.newaxis] # darwin width fluctuations
+
+            if not self.beta_sizes is None:
+                # LorentzianRandom(beta)
+                fwhm = self.beta_sizes[wavelength_index, reflection_index] * (2 / numpy.pi)
+                gamma = (fwhm / 2)[:, numpy.newaxis]
+                step = 40 * fwhm / self.RANDOM_GENERATOR_BINS
+
+                points = -20 * fwhm[:, numpy.newaxis] + numpy.arange(self.RANDOM_GENERATOR_BINS + 1) * step[:, numpy.newaxis]
+
+                delta_theta_size = self.sampleDiscreteDistributions(numpy.cumsum(1 / ((numpy.pi * gamma) * (1 + (points / gamma) ** 2)), axis=1),
+                                                                      points,
+                                                                      self.number_of_origin_points,
+                                                                      random_generator) # residual size effects
+            else:
+                delta_theta_size = 0.0
+
+            twotheta_reflection[:, :, reflection_index] = 2 * (ray_bragg_angle + delta_theta_darwin + delta_theta_size)
+
+        # rotazione del vettore d'onda pari all'angolo di bragg (formula di Rodrigues)
+
+        v_out_temp = self.rotateVectors(rotation_axis_diffraction[:, numpy.newaxis, numpy.newaxis, :],
+                                         twotheta_reflection,
+                                         v_in[:, numpy.newaxis, numpy.newaxis, :])
+
+        # intersezione raggi con sfera di raggio distanza con il detector. le intersezioni con Z < 0 vengono rigettate
+
+        origin_point = origin_point[:, :, numpy.newaxis, :]
+
+        t_0 = -1 * numpy.sum(origin_point * v_out_temp, axis=-1, keepdims=True)
+        P_0 = origin_point + v_out_temp * t_0
+
+        with numpy.errstate(invalid="ignore"):
+            a = numpy.sqrt(self.distance ** 2 - numpy.sum(P_0 ** 2, axis=-1, keepdims=True))
+
+            # N.B. punti di uscita hanno solo direzione in avanti: ok se P2 con z > 0
+            ray_index, origin_point_index, reflection_index = numpy.nonzero((origin_point + v_out_temp * (t_0 + a))[..., 2] >= 0)
+
+        origin_point = origin_point[ray_index, origin_point_index, 0]
+        v_out_temp   = v_out_temp[ray_index, origin_point_index, reflection_index]
+
+        # rotazione del vettore di delta, asse rot = v_in: diffracted rays x rotated rays
+
+        delta_random = random_generator.random((len(ray_index), self.number_of_rotated_rays)) * self.delta_angle_limit
+        discriminant = random_generator.random((len(ray_index), self.number_of_rotated_rays))
+
+        delta_angles = numpy.where(discriminant < 0.5, delta_random, -delta_random)
+
+        v_out = self.rotateVectors(rotation_axis_debye_circle[ray_index, numpy.newaxis, :],
+                                    delta_angles,
+                                    v_out_temp[:, numpy.newaxis, :])
+
+        reduction_factor = self.relative_intensities[reflection_index][:, numpy.newaxis] * numpy.ones(delta_angles.shape)
+
+        if calculate_absorption:
+            reduction_factor *= self.calculateAbsorption(mu[ray_index, numpy.newaxis],
+                                                          mu_capillary[ray_index, numpy.newaxis],
+                                                          entry_point[ray_index, numpy.newaxis, :],
+                                                          entry_point_out[ray_index, numpy.newaxis, :],
+                                                          origin_point[:, numpy.newaxis, :],
+                                                          v_out)
+
+        reduction_factor = numpy.sqrt(reduction_factor)[..., numpy.newaxis]
+
+        input_rays = rays[ray_index, numpy.newaxis, :]
+
+        diffracted_rays = numpy.empty(delta_angles.shape + (18,))
+        diffracted_rays[:, :, 0:3]   = origin_point[:, numpy.newaxis, :]             # X, Y, Z
+        diffracted_rays[:, :, 3:6]   = v_out                                         # director cosines
+        diffracted_rays[:, :, 6:9]   = input_rays[:, :, 6:9] * reduction_factor      # Es
+        diffracted_rays[:, :, 9:15]  = input_rays[:, :, 9:15]                        # good/lost, |k|, ray index, optical path, Es_phi, Ep_phi
+        diffracted_rays[:, :, 15:18] = input_rays[:, :, 15:18] * reduction_factor    # Ep
+
+        return diffracted_rays.reshape((-1, 18)), mu
+
+    def calculateAbsorption(self, mu, mu_capillary, entry_point, entry_point_out, origin_point, direction_versor):
+        # points and versors are arrays of vectors (last axis), mu are the linear absorption coefficients (cm-1)
+
+        displacement_h = self.displacement_h
+        displacement_v = self.displacement_v
+
+        #
+        # calcolo intersezione del raggio con superficie interna ed esterna del capillare:
+        #
+        # x = xo + x' t
+        # y = yo + y' t
+        # z = zo + z' t
+        #
+        # (y-dh)^2 + (z-dv)^2 = (Dc/2)^2
+        # (y-dh)^2 + (z-dv)^2 = ((Dc+thickness)/2)^2
+
+        x_0 = origin_point[..., 0]
+        y_0 = origin_point[..., 1]
+        z_0 = origin_point[..., 2]
+
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            k_1 = direction_versor[..., 1]/direction_versor[..., 0]
+            k_2 = direction_versor[..., 2]/direction_versor[..., 0]
+
+            #
+            # parametri a b c per l'equazione a(x-x0)^2 + b(x-x0) + c = 0
+            #
+
+            a = (k_1**2 + k_2**2)
+            b = 2*(k_1*(y_0+displacement_h) + k_2*(z_0+displacement_v))
+            c = (y_0**2 + z_0**2 + 2*displacement_h*y_0 + 2*displacement_v*z_0) - self.capillary_radius**2 + (displacement_h**2 + displacement_v**2)
+            c_2 = (y_0**2 + z_0**2 + 2*displacement_h*y_0 + 2*displacement_v*z_0) - self.capillary_outer_radius**2 + (displacement_h**2 + displacement_v**2)
+
+            discriminant = b**2 - 4*a*c
+            discriminant_2 = b**2 - 4*a*c_2
+
+            # equazioni risolte per x-x0
+            x_1 = (-b + numpy.sqrt(discriminant))/(2*a) # (x-x0)_1
+            x_2 = (-b - numpy.sqrt(discriminant))/(2*a) # (x-x0)_2
+
+            x_1_out = (-b + numpy.sqrt(discriminant_2))/(2*a) # (x-x0)_1
+            x_2_out = (-b - numpy.sqrt(discriminant_2))/(2*a) # (x-x0)_2
+
+            # solutions only with z > 0 and
+            # se y-y0 > 0 allora il versore deve avere y' > 0
+            # se y-y0 < 0 allora il versore deve avere y' < 0
+
+            z_1 = z_0 + k_2*x_1
+            z_2 = z_0 + k_2*x_2
+
+            solution_1 = (discriminant > 0) & \
+                         ((z_1 >= 0) | ((z_1 < 0) & (direction_versor[..., 1] > 0))) & \
+                         (numpy.sign(k_1*x_1) == numpy.sign(direction_versor[..., 1]))
+            solution_2 = (discriminant > 0) & numpy.logical_not(solution_1) & \
+                         ((z_2 >= 0) | ((z_1 < 0) & (direction_versor[..., 1] > 0))) & \
+                         (numpy.sign(k_1*x_2) == numpy.sign(direction_versor[..., 1]))
+
+            x_sol = numpy.where(solution_1, x_1, x_2)
+            x_sol_out = numpy.where(solution_1, x_1_out, x_2_out)
+
+            exit_point = numpy.stack([x_sol + x_0, y_0 + k_1*x_sol, z_0 + k_2*x_sol], axis=-1)
+            exit_point_out = numpy.stack([x_sol_out + x_0, y_0 + k_1*x_sol_out, z_0 + k_2*x_sol_out], axis=-1)
+
+            distance = numpy.sqrt(numpy.sum((entry_point - origin_point)**2, axis=-1)) + numpy.sqrt(numpy.sum((origin_point - exit_point)**2, axis=-1))
+            distance *= self.workspace_units_to_cm
+            distance_out = numpy.sqrt(numpy.sum((entry_point_out - entry_point)**2, axis=-1)) + numpy.sqrt(numpy.sum((exit_point - exit_point_out)**2, axis=-1))
+            distance_out *= self.workspace_units_to_cm
+
+            absorption = numpy.exp(-mu_capillary*distance_out)*numpy.exp(-mu*distance)*self.absorption_normalization_factor
+
+        return numpy.where(solution_1 | solution_2, absorption, 0.0) # no solution: kill the ray
+
+    # ShadowMath.vector_rotate (Rodrigues formula), on arrays of vectors (last axis)
+    @classmethod
+    def rotateVectors(cls, rotation_axis, rotation_angle, vector):
+        cos_angle = numpy.cos(rotation_angle)[..., numpy.newaxis]
+        sin_angle = numpy.sin(rotation_angle)[..., numpy.newaxis]
+
+        return vector * cos_angle + \
+               numpy.cross(rotation_axis, vector) * sin_angle + \
+               rotation_axis * numpy.sum(rotation_axis * vector, axis=-1, keepdims=True) * (1 - cos_angle)
+
+    # same as AbstractRandom.random() (see random_generator.py), for a different distribution on each row:
+    # one search over all the rows, each one shifted above the previous one
+    @classmethod
+    def sampleDiscreteDistributions(cls, prefix, points, number_of_samples, random_generator):
+        number_of_rows, number_of_points = prefix.shape
+
+        r = random_generator.random((number_of_rows, number_of_samples)) * prefix[:, -1:] + 1
+
+        shift = numpy.arange(number_of_rows)[:, numpy.newaxis] * (numpy.max(prefix[:, -1]) + 2)
+
+        index = numpy.searchsorted((prefix + shift).ravel(), (r + shift).ravel()).reshape(r.shape) - \
+                numpy.arange(number_of_rows)[:, numpy.newaxis] * number_of_points
+        index[index >= number_of_points] = number_of_points - 1 # ceiling not found: last point
+
+        return numpy.take_along_axis(points, index, axis=1)
+
 class RockingCurveElement:
     delta_theta=0.0
     intensity=0.0
@@ -250,6 +250,7 @@ class Source(ow_generic_element.GenericElement):
 
         if show_effective_source_size and not self.view_type == 2:
             effective_source_size_beam = beam_out.duplicate(history=False)
+            effective_source_size_beam.detach_rays()
             effective_source_size_beam._beam.retrace(0)
 
             variables = self.getVariablestoPlot()
@@ -1,4 +1,3 @@
-import copy
 import numpy
 import sys
 
@@ -11,8 +10,8 @@ from oasys.widgets.gui import ConfirmDialog
 from oasys.util.oasys_util import TriggerIn
 
 
-from orangecontrib.shadow.util.shadow_objects import ShadowBeam
-from orangecontrib.shadow.util.shadow_util import ShadowCongruence
+from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowBeamAccumulator
+from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowBeamAnalysis
 from orangecontrib.shadow.widgets.gui.ow_automatic_element import AutomaticElement
 
 class AccumulatingLoopPoint(AutomaticElement):
@@ -36,7 +35,8 @@ class AccumulatingLoopPoint(AutomaticElement):
                 "doc": "Feedback signal to start a new beam simulation",
                 "id": "Trigger"}]
 
-    input_beam = None
+    accumulator = None
+    scanned_variable_data = None
 
     want_main_area = 0
 
@@ -57,6 +57,8 @@ class AccumulatingLoopPoint(AutomaticElement):
     def __init__(self):
         super().__init__()
 
+        self.accumulator = ShadowBeamAccumulator()
+
         self.setFixedWidth(570)
         self.setFixedHeight(410)
 
@@ -140,7 +142,10 @@ class AccumulatingLoopPoint(AutomaticElement):
         self.left_box_1_2.setVisible(self.kind_of_accumulation==1)
 
     def sendSignal(self):
-        self.send("Accumulated Beam", self.input_beam)
+        accumulated_beam = self.accumulator.get_accumulated_beam()
+        if not accumulated_beam is None: accumulated_beam.setScanningData(self.scanned_variable_data)
+
+        self.send("Accumulated Beam", accumulated_beam)
         self.send("Trigger", TriggerIn(interrupt=True))
 
     def callResetSettings(self):
@@ -149,7 +154,7 @@ class AccumulatingLoopPoint(AutomaticElement):
             self.current_intensity = 0.0
             self.current_number_of_lost_rays = 0
             self.current_number_of_total_rays = 0
-            self.input_beam = None
+            self.accumulator.reset()
 
     def setBeam(self, beam):
         if ShadowCongruence.checkEmptyBeam(beam):
@@ -160,14 +165,12 @@ class AccumulatingLoopPoint(AutomaticElement):
                     proceed = False
 
             if proceed:
-                scanned_variable_data = beam.scanned_variable_data
-
-                go = numpy.where(beam._beam.rays[:, 9] == 1)
+                analysis = ShadowBeamAnalysis.get_analysis(beam._beam) # shared with the accumulator and the plots
 
-                nr_good = len(beam._beam.rays[go])
-                nr_total = len(beam._beam.rays)
+                nr_good = analysis.get_number_of_rays(nolost=1)
+                nr_total = analysis.get_number_of_rays(nolost=0)
                 nr_lost = nr_total - nr_good
-                intensity = beam._beam.histo1(1, nolost=1, ref=23)['intensity']
+                intensity = analysis.get_intensity(nolost=1, ref=23) # as histo1(..., nolost=1, ref=23)
 
                 self.current_number_of_rays += nr_good
                 self.current_intensity += intensity
@@ -177,16 +180,9 @@ class AccumulatingLoopPoint(AutomaticElement):
 
                 if (self.kind_of_accumulation == 0 and self.current_number_of_rays <= self.number_of_accumulated_rays) or \
                    (self.kind_of_accumulation == 1 and self.current_intensity <= self.number_of_accumulated_rays):
-                    if self.keep_go_rays == 1:
-                        beam._beam.rays = copy.deepcopy(beam._beam.rays[go])
-
-                    if not self.input_beam is None:
-                        self.input_beam = ShadowBeam.mergeBeams(self.input_beam, beam)
-                    else:
-                        beam._beam.rays[:, 11] = numpy.arange(1, len(beam._beam.rays) + 1, 1) # ray_index
-                        self.input_beam = beam
-
-                    self.input_beam.setScanningData(scanned_variable_data)
+                    # only the new rays are copied, the accumulated beam is built when sent
+                    self.accumulator.append(beam, good_only=self.keep_go_rays == 1)
+                    self.scanned_variable_data = beam.scanned_variable_data
 
                     self.send("Trigger", TriggerIn(new_object=True))
                 else:
@@ -197,7 +193,7 @@ class AccumulatingLoopPoint(AutomaticElement):
                         self.current_intensity = 0.0
                         self.current_number_of_lost_rays = 0
                         self.current_number_of_total_rays = 0
-                        self.input_beam = None
+                        self.accumulator.reset()
                     else:
                         QtWidgets.QMessageBox.critical(self, "Error",
                                                    "Number of Accumulated Rays reached, please push \'Send Signal\' button",
@@ -10,7 +10,7 @@ from oasys.widgets import congruence
 from oasys.util.oasys_util import EmittingStream, TTYGrabber, TriggerIn
 
 from orangecontrib.shadow.util.shadow_objects import ShadowOpticalElement, ShadowBeam
-from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowPhysics, ShadowMath
+from orangecontrib.shadow.util.shadow_util import ShadowCongruence, ShadowPhysics, ShadowMath, ShadowMaterialTables
 from orangecontrib.shadow.widgets.gui.ow_generic_element import GenericElement
 
 import xraylib
@@ -751,21 +751,7 @@ class ZonePlate(GenericElement):
         return output_beam
 
     def get_output_beam(self, focused_beam):
-
-        empty_element = ShadowOpticalElement.create_empty_oe()
-
-        empty_element._oe.DUMMY = 1.0 # self.workspace_units_to_cm
-
-        empty_element._oe.T_SOURCE     = 0.0
-        empty_element._oe.T_IMAGE      = self.image_plane_distance
-        empty_element._oe.T_INCIDENCE  = 0.0
-        empty_element._oe.T_REFLECTION = 180.0
-        empty_element._oe.ALPHA        = 0.0
-
-        empty_element._oe.FWRITE = 3
-        empty_element._oe.F_ANGLE = 0
-
-        return ShadowBeam.traceFromOE(focused_beam, empty_element, history=True)
+        return ShadowBeam.traceFreeSpace(focused_beam, self.image_plane_distance, history=True)
 
     # ALGORITHM EXTRACTED FROM webAbsorb.py by 11BM - Argonne National Laboratory
     @classmethod
@@ -785,10 +771,7 @@ class ZonePlate(GenericElement):
     
     @classmethod  
     def get_material_weight_factor(cls, shadow_rays, material, thickness):
-        mu = numpy.zeros(len(shadow_rays))
-        
-        for i in range(0, len(mu)):
-            mu[i] = xraylib.CS_Total_CP(material, ShadowPhysics.getEnergyFromShadowK(shadow_rays[i, 10])/1000) # energy in KeV
+        mu = ShadowMaterialTables.get_mass_attenuation_coefficient(material, ShadowPhysics.getEnergyFromShadowK(shadow_rays[:, 10]))
         
         rho = ZonePlate.get_material_density(material)
                     
@@ -797,22 +780,15 @@ class ZonePlate(GenericElement):
     
     @classmethod  
     def get_delta_beta(cls, shadow_rays, material):
-        beta = numpy.zeros(len(shadow_rays))
-        delta = numpy.zeros(len(shadow_rays))
         density = xraylib.ElementDensity(xraylib.SymbolToAtomicNumber(material))
     
-        for i in range(0, len(shadow_rays)):
-            energy_in_KeV = ShadowPhysics.getEnergyFromShadowK(shadow_rays[i, 10])/1000
-            delta[i] = (1-xraylib.Refractive_Index_Re(material, energy_in_KeV, density))
-            beta[i]  = xraylib.Refractive_Index_Im(material, energy_in_KeV, density)
-    
-        return delta, beta 
+        return ShadowMaterialTables.get_delta_beta(material, density, ShadowPhysics.getEnergyFromShadowK(shadow_rays[:, 10]))
     
     @classmethod
     def analyze_zone(cls, zones, focused_beam, p_zp, workspace_units_to_m):
-        to_analyze = numpy.where(focused_beam._beam.rays[:, 9] == LOST_ZP)
+        to_analyze = numpy.where(focused_beam.get_column(10) == LOST_ZP)
 
-        candidate_rays = copy.deepcopy(focused_beam._beam.rays[to_analyze])
+        candidate_rays = focused_beam.select_rays(to_analyze)
 
         if len(candidate_rays) > 0:
             xp = candidate_rays[:, 3]
@@ -825,47 +801,54 @@ class ZonePlate(GenericElement):
 
             r = numpy.sqrt(candidate_rays[:, 0]**2 + candidate_rays[:, 2]**2)
 
-            for zone in zones:
-                t = numpy.where(numpy.logical_and(r >= zone[0], r <= zone[1]))
+            # zones are sorted and disjoint: one search gives the zone of each ray (the last one starting before it)
+            zones = numpy.asarray(zones, dtype=float).reshape((-1, 2))
 
-                intercepted_rays_f = candidate_rays[t]
+            zone_index = numpy.searchsorted(zones[:, 0], r, side="right") - 1
 
-                if len(intercepted_rays_f) > 0:
-                    xp_int = intercepted_rays_f[:, 3]
-                    zp_int = intercepted_rays_f[:, 5]
+            if len(zones) > 0: t = numpy.where(numpy.logical_and(zone_index >= 0, r <= zones[numpy.maximum(zone_index, 0), 1]))
+            else:              t = (numpy.zeros(0, dtype=int),)
 
-                    k_mod_int = intercepted_rays_f[:, 10] # CM-1
+            intercepted_rays_f = candidate_rays[t]
 
-                    k_x_int = k_mod_int*xp_int # CM-1
-                    k_z_int = k_mod_int*zp_int # CM-1
+            if len(intercepted_rays_f) > 0:
+                xp_int = intercepted_rays_f[:, 3]
+                zp_int = intercepted_rays_f[:, 5]
 
-                    # (see formulas in A.G. Michette, "X-ray science and technology"
-                    #  Institute of Physics Publishing (1993))
-                    # par. 8.6, pg. 332-337
-                    x_int_f = intercepted_rays_f[:, 0] # WS Units
-                    z_int_f = intercepted_rays_f[:, 2] # WS Units
+                k_mod_int = intercepted_rays_f[:, 10] # CM-1
 
-                    r_int = numpy.sqrt((x_int_f)**2 + (z_int_f)**2) # WS Units
+                k_x_int = k_mod_int*xp_int # CM-1
+                k_z_int = k_mod_int*zp_int # CM-1
 
-                    d = (zone[1] - zone[0])*workspace_units_to_m*100  # to CM
+                # (see formulas in A.G. Michette, "X-ray science and technology"
+                #  Institute of Physics Publishing (1993))
+                # par. 8.6, pg. 332-337
+                x_int_f = intercepted_rays_f[:, 0] # WS Units
+                z_int_f = intercepted_rays_f[:, 2] # WS Units
 
-                    # computing G (the "grating" wavevector in workspace units^-1)
-                    gx = -(numpy.pi / d) * x_int_f/r_int
-                    gz = -(numpy.pi / d) * z_int_f/r_int
+                r_int = numpy.sqrt((x_int_f)**2 + (z_int_f)**2) # WS Units
 
-                    k_x_out = k_x_int + gx
-                    k_z_out = k_z_int + gz
+                intercepted_zones = zones[zone_index[t]]
 
-                    k_y_out = numpy.sqrt(k_mod_int**2 - (k_z_out**2 + k_x_out**2)) # keep energy of the photon constant
+                d = (intercepted_zones[:, 1] - intercepted_zones[:, 0])*workspace_units_to_m*100  # to CM
 
-                    xp_out = k_x_out / k_mod_int
-                    yp_out = k_y_out / k_mod_int
-                    zp_out = k_z_out / k_mod_int
+                # computing G (the "grating" wavevector in workspace units^-1)
+                gx = -(numpy.pi / d) * x_int_f/r_int
+                gz = -(numpy.pi / d) * z_int_f/r_int
 
-                    candidate_rays[t, 3] = xp_out
-                    candidate_rays[t, 4] = yp_out
-                    candidate_rays[t, 5] = zp_out
-                    candidate_rays[t, 9] = GOOD_ZP
+                k_x_out = k_x_int + gx
+                k_z_out = k_z_int + gz
+
+                k_y_out = numpy.sqrt(k_mod_int**2 - (k_z_out**2 + k_x_out**2)) # keep energy of the photon constant
+
+                xp_out = k_x_out / k_mod_int
+                yp_out = k_y_out / k_mod_int
+                zp_out = k_z_out / k_mod_int
+
+                candidate_rays[t, 3] = xp_out
+                candidate_rays[t, 4] = yp_out
+                candidate_rays[t, 5] = zp_out
+                candidate_rays[t, 9] = GOOD_ZP
 
             focused_beam._beam.rays[to_analyze] = candidate_rays
 
@@ -885,6 +868,7 @@ class ZonePlate(GenericElement):
         max_zones_number = int(diameter*1000/(4*delta_rn))
 
         focused_beam = zone_plate_beam.duplicate(history=True)
+        focused_beam.detach_rays()
 
         go = numpy.where(focused_beam._beam.rays[:, 9] == GOOD)
 
@@ -898,14 +882,11 @@ class ZonePlate(GenericElement):
             focused_beam._beam.rays[go, 16] = focused_beam._beam.rays[go, 16]*substrate_weight_factor[:]
             focused_beam._beam.rays[go, 17] = focused_beam._beam.rays[go, 17]*substrate_weight_factor[:]
         
-        clear_zones = []
-        dark_zones = []
-        r_zone_i_previous = 0.0
-        for i in range(1, max_zones_number+1):
-            r_zone_i = numpy.sqrt(i*diameter*1e-6*delta_rn*1e-9)/workspace_units_to_m # to workspace unit
-            if i % 2 == 0: clear_zones.append([r_zone_i_previous, r_zone_i])
-            else: dark_zones.append([r_zone_i_previous, r_zone_i])
-            r_zone_i_previous = r_zone_i
+        r_zones = numpy.sqrt(numpy.arange(1, max_zones_number+1)*diameter*1e-6*delta_rn*1e-9)/workspace_units_to_m # to workspace unit
+        zones = numpy.stack([numpy.append(0.0, r_zones[:-1]), r_zones], axis=1)
+
+        clear_zones = zones[1::2] # even zone numbers
+        dark_zones = zones[0::2]
                
         focused_beam._beam.rays[go, 9] = LOST_ZP
         
@@ -179,6 +179,7 @@ class FocNew(ow_automatic_element.AutomaticElement):
 
                         dist = self.image_plane_new_position - image_plane
 
+                    new_shadow_beam.detach_rays()
                     new_shadow_beam._beam.retrace(dist)
 
                     beam_to_analize = new_shadow_beam._beam
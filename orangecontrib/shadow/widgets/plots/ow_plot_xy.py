@@ -743,6 +743,7 @@ class PlotXY(AutomaticElement):
         self.shadow_output.ensureCursorVisible()
 
     def retrace_beam(self, new_shadow_beam, dist):
+        new_shadow_beam.detach_rays()
         new_shadow_beam._beam.retrace(dist)
 
     def getConversionActive(self):
@@ -673,6 +673,7 @@ class Histogram(ow_automatic_element.AutomaticElement):
         self.shadow_output.ensureCursorVisible()
 
     def retrace_beam(self, new_shadow_beam, dist):
+            new_shadow_beam.detach_rays()
             new_shadow_beam._beam.retrace(dist)
 
     def getConversionActive(self):
@@ -608,6 +608,8 @@ class GeometricalSource(ow_source.Source):
         distribution = stats.truncnorm(a, b, loc=self.gaussian_central_value, scale=self.gaussian_sigma)
         sampled_spectrum = distribution.rvs(len(beam_out._beam.rays))
 
+        beam_out.detach_rays()
+
         beam_out._beam.rays[:, 10] = ShadowPhysics.getShadowKFromEnergy(energy=sampled_spectrum[:]) if self.units == 0 else \
                                      ShadowPhysics.getShadowKFromWavelength(wavelength=sampled_spectrum[:])
 
@@ -618,6 +620,8 @@ class GeometricalSource(ow_source.Source):
                                                      len(beam_out._beam.rays),
                                                      self.user_defined_spectrum_binning)
 
+        beam_out.detach_rays()
+
         beam_out._beam.rays[:, 10] = ShadowPhysics.getShadowKFromEnergy(energy=sampled_spectrum[:]) if self.units == 0 else \
                                      ShadowPhysics.getShadowKFromWavelength(wavelength=sampled_spectrum[:])
 
@@ -651,6 +655,7 @@ class GeometricalSource(ow_source.Source):
     # WEIRD MEMORY INITIALIZATION BY FORTRAN. JUST A FIX.
     def fix_Intensity(self, beam_out):
         if self.polarization == 0:
+            beam_out.detach_rays()
             beam_out._beam.rays[:, 15] = 0
             beam_out._beam.rays[:, 16] = 0
             beam_out._beam.rays[:, 17] = 0
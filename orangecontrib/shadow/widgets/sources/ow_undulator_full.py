@@ -28,6 +28,7 @@ from silx.gui.plot import Plot2D
 
 from orangecontrib.shadow.util.undulator.source_undulator import SourceUndulator
 from orangecontrib.shadow.util.undulator.source_undulator_input_output import SourceUndulatorInputOutput
+from orangecontrib.shadow.util.undulator.source_undulator_cache import SourceUndulatorCache
 from Shadow import Beam as Shadow3Beam
 from orangecontrib.shadow.util.shadow_objects import ShadowSource, ShadowBeam, ShadowOEHistoryItem
 
@@ -64,7 +65,11 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
     ng_p = Setting(11)
     ng_j = Setting(20)
     ng_e = Setting(11)
-    code_undul_phot = Setting(0) # 0=internal 1=pySRU 2=SRW
+    code_undul_phot = Setting(0) # 0=internal 1=pySRU 2=SRW 3=internal (vectorized)
+    number_of_processes = Setting(1)
+    use_radiation_cache = Setting(0) # 0=No 1=Yes
+    radiation_cache_directory = Setting(SourceUndulatorCache.DEFAULT_DIRECTORY)
+    radiation_cache_max_size = Setting(1024) # MB
     flag_size = Setting(1) # 0=Point 1=Gaussian 2=backpropagate divergences
     coherent = Setting(0)  # 0=No 1=Yes
 
@@ -169,7 +174,18 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
         oasysgui.lineEdit(left_box_5, self, "ng_j", "Points in electron trajectory", tooltip="Points in electron trajectory", labelWidth=260, valueType=int, orientation="horizontal")
 
         gui.comboBox(left_box_5, self, "code_undul_phot", label="Calculation method", labelWidth=120,
-                     items=["internal", "pySRU","SRW"],sendSelectedValue=False, orientation="horizontal")
+                     items=["internal", "pySRU","SRW","internal (vectorized)"],sendSelectedValue=False, orientation="horizontal")
+        oasysgui.lineEdit(left_box_5, self, "number_of_processes", "Number of processes (photon energies in parallel)", tooltip="Number of processes", labelWidth=260, valueType=int, orientation="horizontal")
+
+        gui.comboBox(left_box_5, self, "use_radiation_cache", label="Reuse radiation from disk cache", labelWidth=260,
+                     items=["No", "Yes"],sendSelectedValue=False, orientation="horizontal", callback=self.set_UseRadiationCache)
+
+        self.box_radiation_cache = oasysgui.widgetBox(left_box_5, "", addSpace=False, orientation="vertical")
+
+        oasysgui.lineEdit(self.box_radiation_cache, self, "radiation_cache_directory", "Cache directory", tooltip="Directory of the radiation files", labelWidth=100, valueType=str, orientation="horizontal")
+        oasysgui.lineEdit(self.box_radiation_cache, self, "radiation_cache_max_size", "Maximum cache size [MB] (least recently used files removed)", tooltip="Maximum cache size [MB]", labelWidth=260, valueType=float, orientation="horizontal")
+
+        self.set_UseRadiationCache()
 
         gui.comboBox(left_box_5, self, "flag_size", label="Radiation Size", labelWidth=120,
                      items=["point", "Gaussian", "Far field backpropagated"],sendSelectedValue=False, orientation="horizontal")
@@ -230,6 +246,9 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
         self.box_maxangle_urad.setVisible(self.set_at_resonance == 0)
         self.box_harmonic.setVisible(self.set_at_resonance > 0)
 
+    def set_UseRadiationCache(self):
+        self.box_radiation_cache.setVisible(self.use_radiation_cache == 1)
+
     def set_PlotAuxGraphs(self):
         # self.progressBarInit()
 
@@ -560,7 +579,7 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
             print(ebeam.info())
 
 
-            codes = ["internal","pySRU","SRW"]
+            codes = ["internal","pySRU","SRW","internal_vectorized"]
             selected_code = codes[self.code_undul_phot]
 
             self.sourceundulator = SourceUndulator(
@@ -576,7 +595,10 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
                 ng_t=self.ng_t,
                 ng_p=self.ng_p,
                 ng_j=self.ng_j,
-                code_undul_phot=selected_code)
+                code_undul_phot=selected_code,
+                number_of_processes=self.number_of_processes,
+                cache=SourceUndulatorCache(directory=self.radiation_cache_directory,
+                                           max_size=int(self.radiation_cache_max_size*1024**2)) if self.use_radiation_cache else None)
 
             if self.set_at_resonance == 0:
                 if self.delta_e == 0:
@@ -667,6 +689,7 @@ class UndulatorFull(ow_source.Source, WidgetDecorator):
                 "ng_p"               : self.ng_p,
                 "ng_j"               : self.ng_j,
                 "code_undul_phot"    : selected_code,
+                "number_of_processes": self.number_of_processes,
                 "user_unit_to_m"     : self.workspace_units_to_m,
                 "F_COHER"            : self.coherent,
                 "SEED"               : self.seed,
@@ -738,7 +761,8 @@ sourceundulator = SourceUndulator(
     ng_t={ng_t},
     ng_p={ng_p},
     ng_j={ng_j},
-    code_undul_phot="{code_undul_phot}")
+    code_undul_phot="{code_undul_phot}",
+    number_of_processes={number_of_processes})
     
 sourceundulator._EMIN = {EMIN}
 sourceundulator._EMAX = {EMAX}
@@ -792,6 +816,11 @@ Shadow.ShadowTools.plotxy(beam,1,3,nbins=101,nolost=1,title="Real space")
         self.ng_p = int( congruence.checkStrictlyPositiveNumber(self.ng_p,"Number of points in phi") )
         self.ng_j = int( congruence.checkStrictlyPositiveNumber(self.ng_j,"Number of points in trajectory") )
         self.ng_e = int( congruence.checkStrictlyPositiveNumber(self.ng_e,"Number of points in energy") )
+        self.number_of_processes = int( congruence.checkStrictlyPositiveNumber(self.number_of_processes,"Number of processes") )
+
+        if self.use_radiation_cache == 1:
+            congruence.checkEmptyString(self.radiation_cache_directory, "Cache directory")
+            self.radiation_cache_max_size = congruence.checkStrictlyPositiveNumber(self.radiation_cache_max_size, "Maximum cache size")
 
 
     def receive_syned_data(self, data):
@@ -319,6 +319,7 @@ def hy_check_congruence(input_parameters=HybridInputParameters(), calculation_pa
                         raise Exception("Simple Aperture calculation runs for apertures only")
 
                     beam_at_the_slit = beam_before.duplicate(history=False)
+                    beam_at_the_slit.detach_rays()
                     beam_at_the_slit._beam.retrace(oe_before._oe.T_SOURCE) # TRACE INCIDENT BEAM UP TO THE SLIT
 
                     # TODO: MANAGE CASE OF ROTATED SLITS (OE MOVEMENT OR SOURCE MOVEMENT)
@@ -355,6 +356,7 @@ def hy_check_congruence(input_parameters=HybridInputParameters(), calculation_pa
                 oes_list = history_entry._shadow_oe_end._oe.list
 
                 beam_at_the_slit = beam_before.duplicate(history=False)
+                beam_at_the_slit.detach_rays()
                 beam_at_the_slit._beam.retrace(oes_list[0].T_SOURCE) # TRACE INCIDENT BEAM UP TO THE SLIT
 
                 is_infinite = True
@@ -711,7 +713,7 @@ def hy_readfiles(input_parameters=HybridInputParameters(), calculation_parameter
 
         # read in angle files
 
-        angle_inc, angle_ref = sh_readangle("angle." + str_n_oe, mirror_beam)   #xshi change from 0 to 1
+        angle_inc, angle_ref = sh_readangle("angle." + str_n_oe, mirror_beam, input_parameters.shadow_beam.get_angles())   #xshi change from 0 to 1
 
         calculation_parameters.angle_inc = (90.0 - angle_inc)/180.0*1e3*numpy.pi
         calculation_parameters.angle_ref = (90.0 - angle_ref)/180.0*1e3*numpy.pi
@@ -982,11 +984,13 @@ def hy_create_shadow_beam(input_parameters=HybridInputParameters(), calculation_
 
     if do_nf:
         calculation_parameters.nf_beam = calculation_parameters.image_plane_beam.duplicate(history=False)
+        calculation_parameters.nf_beam.detach_rays()
         calculation_parameters.nf_beam._oe_number = input_parameters.shadow_beam._oe_number
 
     if input_parameters.ghy_diff_plane == 1: #1d calculation in x direction
         if calculation_parameters.do_ff_x:
             calculation_parameters.ff_beam = calculation_parameters.image_plane_beam.duplicate(history=False)
+            calculation_parameters.ff_beam.detach_rays()
             calculation_parameters.ff_beam._oe_number = input_parameters.shadow_beam._oe_number
 
             angle_perpen = numpy.arctan(calculation_parameters.zp_screen/calculation_parameters.yp_screen)
@@ -1008,6 +1012,7 @@ def hy_create_shadow_beam(input_parameters=HybridInputParameters(), calculation_
     elif input_parameters.ghy_diff_plane == 2: #1d calculation in z direction
         if calculation_parameters.do_ff_z:
             calculation_parameters.ff_beam = calculation_parameters.image_plane_beam.duplicate(history=False)
+            calculation_parameters.ff_beam.detach_rays()
             calculation_parameters.ff_beam._oe_number = input_parameters.shadow_beam._oe_number
 
             angle_perpen = numpy.arctan(calculation_parameters.xp_screen/calculation_parameters.yp_screen)
@@ -1029,6 +1034,7 @@ def hy_create_shadow_beam(input_parameters=HybridInputParameters(), calculation_
     elif input_parameters.ghy_diff_plane == 3: # 2d calculation
         if calculation_parameters.do_ff_x or calculation_parameters.do_ff_z:
             calculation_parameters.ff_beam = calculation_parameters.image_plane_beam.duplicate(history=False)
+            calculation_parameters.ff_beam.detach_rays()
             calculation_parameters.ff_beam._oe_number = input_parameters.shadow_beam._oe_number
 
             angle_num = numpy.sqrt(1+(numpy.tan(calculation_parameters.dz_conv))**2+(numpy.tan(calculation_parameters.dx_conv))**2)
@@ -1686,22 +1692,14 @@ def get_delta(input_parameters, calculation_parameters):
 #########################################################
 
 def read_shadow_beam(shadow_beam, lost=False):
-    cursor_go = numpy.where(shadow_beam._beam.rays[:, 9] == 1)
-
-    image_beam_rays = copy.deepcopy(shadow_beam._beam.rays[cursor_go])
-    image_beam_rays[:, 11] = numpy.arange(1, len(image_beam_rays) + 1, 1)
+    good = shadow_beam.get_column(10) == 1
 
     out_beam_go = ShadowBeam()
-    out_beam_go._beam.rays = image_beam_rays
+    out_beam_go._beam.rays = shadow_beam.select_rays(good, renumber=True)
 
     if lost:
-        cursor_lo = numpy.where(shadow_beam._beam.rays[:, 9] != 1)
-
-        lost_rays = copy.deepcopy(shadow_beam._beam.rays[cursor_lo])
-        lost_rays[:, 11] = numpy.arange(1, len(lost_rays) + 1, 1)
-
         out_beam_lo = ShadowBeam()
-        out_beam_lo._beam.rays = lost_rays
+        out_beam_lo._beam.rays = shadow_beam.select_rays(~good, renumber=True)
 
         return out_beam_go, out_beam_lo
     else:
@@ -1717,20 +1715,19 @@ def sh_readsh(shfilename):
 
 #########################################################
 
-def sh_readangle(filename, mirror_beam=None):
-    values = numpy.loadtxt(congruence.checkFile(filename))
+def sh_readangle(filename, mirror_beam=None, angles=None):
+    # angles: in memory from the traced beam (ShadowBeam.get_angles()), otherwise read from file
+    values = ShadowBeam.read_angle_file(congruence.checkFile(filename)) if angles is None else angles
     dimension = len(mirror_beam._beam.rays)
 
     angle_inc = numpy.zeros(dimension)
     angle_ref = numpy.zeros(dimension)
 
-    ray_index = 0
-    for index in range(0, len(values)):
-        if values[index, 3] == 1:
-            angle_inc[ray_index] = values[index, 1]
-            angle_ref[ray_index] = values[index, 2]
+    good_only = values[:, 3] == 1
+    good_rays = numpy.count_nonzero(good_only)
 
-            ray_index += 1
+    angle_inc[:good_rays] = values[good_only, 1]
+    angle_ref[:good_rays] = values[good_only, 2]
 
     return angle_inc, angle_ref
 
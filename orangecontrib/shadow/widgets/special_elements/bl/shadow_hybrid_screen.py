@@ -282,22 +282,14 @@ class _ShadowOEHybridScreen():
 
     @staticmethod
     def _process_shadow_beam(shadow_beam, lost=False):
-        cursor_go = numpy.where(shadow_beam._beam.rays[:, 9] == 1)
-    
-        image_beam_rays = copy.deepcopy(shadow_beam._beam.rays[cursor_go])
-        image_beam_rays[:, 11] = numpy.arange(1, len(image_beam_rays) + 1, 1)
+        good = shadow_beam.get_column(10) == 1
     
         out_beam_go = ShadowBeam()
-        out_beam_go._beam.rays = image_beam_rays
+        out_beam_go._beam.rays = shadow_beam.select_rays(good, renumber=True)
     
         if lost:
-            cursor_lo = numpy.where(shadow_beam._beam.rays[:, 9] != 1)
-    
-            lost_rays = copy.deepcopy(shadow_beam._beam.rays[cursor_lo])
-            lost_rays[:, 11] = numpy.arange(1, len(lost_rays) + 1, 1)
-    
             out_beam_lo = ShadowBeam()
-            out_beam_lo._beam.rays = lost_rays
+            out_beam_lo._beam.rays = shadow_beam.select_rays(~good, renumber=True)
     
             return out_beam_go, out_beam_lo
         else:
@@ -322,6 +314,7 @@ class _ShadowOEHybridScreen():
 
         if input_parameters.diffraction_plane == HybridDiffractionPlane.BOTH_2D:
             ff_beam = image_plane_beam.duplicate(history=False)
+            ff_beam.detach_rays()
             ff_beam._oe_number = input_parameters.original_beam.wrapped_beam._oe_number
 
             angle_num = numpy.sqrt(1 + (numpy.tan(calculation_parameters.dz_convolution)) ** 2 + (numpy.tan(calculation_parameters.dx_convolution)) ** 2)
@@ -336,6 +329,7 @@ class _ShadowOEHybridScreen():
                 # FAR FIELD PROPAGATION
                 if input_parameters.propagation_type in [HybridPropagationType.FAR_FIELD, HybridPropagationType.BOTH]:
                     ff_beam = image_plane_beam.duplicate(history=False)
+                    ff_beam.detach_rays()
                     ff_beam._oe_number = oe_number
 
                     angle_perpen = numpy.arctan(calculation_parameters.zp_screen / calculation_parameters.yp_screen)
@@ -349,6 +343,7 @@ class _ShadowOEHybridScreen():
                 # NEAR FIELD PROPAGATION
                 if input_parameters.propagation_type in [HybridPropagationType.NEAR_FIELD, HybridPropagationType.BOTH]:
                     nf_beam = image_plane_beam.duplicate(history=False)
+                    nf_beam.detach_rays()
                     nf_beam._oe_number = oe_number
 
                     nf_beam._beam.rays[:, 0] = copy.deepcopy(calculation_parameters.xx_image_nf)*to_user_units
@@ -358,6 +353,7 @@ class _ShadowOEHybridScreen():
                 if input_parameters.propagation_type in [HybridPropagationType.FAR_FIELD, HybridPropagationType.BOTH]:
                     if ff_beam is None:
                         ff_beam = image_plane_beam.duplicate(history=False)
+                        ff_beam.detach_rays()
                         ff_beam._oe_number = oe_number
 
                     angle_perpen = numpy.arctan(calculation_parameters.xp_screen / calculation_parameters.yp_screen)
@@ -374,6 +370,7 @@ class _ShadowOEHybridScreen():
                 if input_parameters.propagation_type in [HybridPropagationType.NEAR_FIELD, HybridPropagationType.BOTH]:
                     if nf_beam is None:
                         nf_beam = image_plane_beam.duplicate(history=False)
+                        nf_beam.detach_rays()
                         nf_beam._oe_number = oe_number
 
                     nf_beam._beam.rays[:, 2] = copy.deepcopy(calculation_parameters.zz_image_nf)*to_user_units
@@ -419,6 +416,7 @@ class _ShadowApertureHybridScreen(_ShadowOEHybridScreen):
             if oe_before._oe.I_STOP[0] == 1: raise Exception("Simple Aperture calculation runs for apertures only")
 
             beam_at_the_slit = beam_before.duplicate(history=False)
+            beam_at_the_slit.detach_rays()
             beam_at_the_slit._beam.retrace(oe_before._oe.T_SOURCE)  # TRACE INCIDENT BEAM UP TO THE SLIT
 
             # TODO: MANAGE CASE OF ROTATED SLITS (OE MOVEMENT OR SOURCE MOVEMENT)
@@ -502,8 +500,9 @@ class _ShadowOEWithSurfaceHybridScreen(_ShadowOEHybridScreen):
 
     def _get_rays_angles(self, input_parameters: HybridInputParameters, calculation_parameters: AbstractHybridScreen.CalculationParameters) -> Tuple[numpy.ndarray, numpy.ndarray]:
         mirror_beam = calculation_parameters.get("mirror_beam")
+        shadow_beam = calculation_parameters.get("shadow_beam")
 
-        return self._read_shadow_angles("angle." + self._get_oe_string(input_parameters), mirror_beam) # in radians
+        return self._read_shadow_angles("angle." + self._get_oe_string(input_parameters), mirror_beam, shadow_beam.get_angles()) # in radians
 
     def _has_pitch_displacement(self, input_parameters: HybridInputParameters, calculation_parameters : AbstractHybridScreen.CalculationParameters) -> Tuple[bool, float]:
         shadow_oe = calculation_parameters.get("shadow_oe_end")
@@ -543,20 +542,19 @@ class _ShadowOEWithSurfaceHybridScreen(_ShadowOEHybridScreen):
         return shadow_oe._oe.SIMAG * to_m
 
     @staticmethod
-    def _read_shadow_angles(filename, mirror_beam=None) -> Tuple[numpy.ndarray, numpy.ndarray]:
-        values    = numpy.loadtxt(congruence.checkFile(filename))
+    def _read_shadow_angles(filename, mirror_beam=None, angles=None) -> Tuple[numpy.ndarray, numpy.ndarray]:
+        # angles: in memory from the traced beam (ShadowBeam.get_angles()), otherwise read from file
+        values    = ShadowBeam.read_angle_file(congruence.checkFile(filename)) if angles is None else angles
         dimension = len(mirror_beam._beam.rays)
 
         incidence_angle  = numpy.zeros(dimension)
         reflection_angle = numpy.zeros(dimension)
 
-        ray_index = 0
-        for index in range(0, len(values)):
-            if values[index, 3] == 1:
-                incidence_angle[ray_index] = values[index, 1]
-                reflection_angle[ray_index] = values[index, 2]
+        good_only = values[:, 3] == 1
+        good_rays = numpy.count_nonzero(good_only)
 
-                ray_index += 1
+        incidence_angle[:good_rays]  = values[good_only, 1]
+        reflection_angle[:good_rays] = values[good_only, 2]
 
         incidence_angle  = numpy.radians(90.0 - incidence_angle)
         reflection_angle = numpy.radians(90.0 - reflection_angle)
@@ -613,6 +611,7 @@ class _ShadowOELensHybridScreen(_ShadowApertureHybridScreen):
         oes_list = history_entry._shadow_oe_end._oe.list
 
         beam_at_the_slit = beam_before.duplicate(history=False)
+        beam_at_the_slit.detach_rays()
         beam_at_the_slit._beam.retrace(oes_list[0].T_SOURCE)  # TRACE INCIDENT BEAM UP TO THE SLIT
 
         is_infinite = True
@@ -747,6 +746,8 @@ class _ShadowOEKBMirrorHybridScreen():
         if   len(go_beam_2[0]) < len(go_beam_1[0]): go_beam_1 = go_beam_1[0][0 : len(go_beam_2[0])]
         elif len(go_beam_2[0]) > len(go_beam_1[0]): go_beam_2 = go_beam_2[0][0 : len(go_beam_1[0])]
 
+        beam_2.wrapped_beam.detach_rays()
+
         beam_2.wrapped_beam._beam.rays[go_beam_2, 0] = beam_1.wrapped_beam._beam.rays[go_beam_1, 2] # tangential component 1 becomes the sagittal 2
         beam_2.wrapped_beam._beam.rays[go_beam_2, 3] = beam_1.wrapped_beam._beam.rays[go_beam_1, 5]
 
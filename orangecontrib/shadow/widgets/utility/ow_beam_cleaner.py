@@ -95,8 +95,7 @@ class BeamCleaner(widget.OWWidget):
         if ShadowCongruence.checkEmptyBeam(beam):
             output_beam = beam.duplicate(history=True)
 
-            good = numpy.where(output_beam._beam.rays[:, 9] == 1)
-            output_beam._beam.rays = copy.deepcopy(output_beam._beam.rays[good])
+            output_beam._beam.rays = beam.select_rays(beam.get_column(10) == 1)
 
             self.send("Beam", output_beam)
             self.send("Trigger", TriggerIn(new_object=True))
@@ -6,7 +6,7 @@ from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui, congruence
 from oasys.widgets import widget as oasyswidget
 
-from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowOpticalElement, ShadowOEHistoryItem
+from orangecontrib.shadow.util.shadow_objects import ShadowBeam, ShadowBeamFile, ShadowOpticalElement, ShadowOEHistoryItem
 
 
 class BeamFileReader(oasyswidget.OWWidget):
@@ -70,7 +70,9 @@ class BeamFileReader(oasyswidget.OWWidget):
                 beam_out._oe_number = 0
 
                 # just to create a safe history for possible re-tracing
-                beam_out.traceFromOE(beam_out, self.create_dummy_oe(), history=True)
+                # (not for the columnar files: the memory-mapped rays would be read and copied)
+                if not ShadowBeamFile.is_columnar_file(self.beam_file_name):
+                    beam_out.traceFromOE(beam_out, self.create_dummy_oe(), history=True)
 
                 path, file_name = os.path.split(self.beam_file_name)
 
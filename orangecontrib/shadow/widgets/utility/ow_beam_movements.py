@@ -144,38 +144,14 @@ class OWBeamMovement(GenericElement):
 
     def moveBeam(self):
         if not self.input_beam is None:
-            def rotate(rays, theta, axis=1):
-                theta1 = theta
-                a1     = rays.copy()
-
-                if axis == 1:   torot = [2, 3]
-                elif axis == 2: torot = [1, 3]
-                elif axis == 3: torot = [1, 2]
-
-                costh = numpy.cos(theta1)
-                sinth = numpy.sin(theta1)
-
-                tstart = numpy.array([1, 4, 7, 16])
-
-                for i in range(len(tstart)):
-                    newaxis = axis + tstart[i] - 1
-                    newaxisi = newaxis - 1
-                    newtorot = torot + tstart[i] - 1
-                    newtoroti = newtorot - 1
-
-                    rays[:, newtoroti[0]] = a1[:, newtoroti[0]] * costh + a1[:, newtoroti[1]] * sinth
-                    rays[:, newtoroti[1]] = -a1[:, newtoroti[0]] * sinth + a1[:, newtoroti[1]] * costh
-                    rays[:, newaxisi] = a1[:, newaxisi]
             try:
                 shadow_beam_out = self.input_beam.duplicate()
+                shadow_beam_out.detach_rays()
 
-                if self.translation_x != 0.0: shadow_beam_out._beam.rays[:, 0] += self.translation_x
-                if self.translation_y != 0.0: shadow_beam_out._beam.rays[:, 1] += self.translation_y
-                if self.translation_z != 0.0: shadow_beam_out._beam.rays[:, 2] += self.translation_z
+                matrix, offset = self.get_movement_transform([self.translation_x, self.translation_y, self.translation_z],
+                                                             numpy.radians([self.rotation_x, self.rotation_y, self.rotation_z]))
 
-                if self.rotation_x != 0.0: rotate(shadow_beam_out._beam.rays, numpy.radians(self.rotation_x), axis=1)
-                if self.rotation_y != 0.0: rotate(shadow_beam_out._beam.rays, numpy.radians(self.rotation_y), axis=2)
-                if self.rotation_z != 0.0: rotate(shadow_beam_out._beam.rays, numpy.radians(self.rotation_z), axis=3)
+                self.apply_movement_transform(shadow_beam_out._beam.rays, matrix, offset)
 
                 self.setStatusMessage("")
 
@@ -184,4 +160,45 @@ class OWBeamMovement(GenericElement):
             except Exception as e:
                 self.setStatusMessage("")
 
-                QMessageBox.critical(self, "Error", str(e), QMessageBox.Ok)
\ No newline at end of file
+                QMessageBox.critical(self, "Error", str(e), QMessageBox.Ok)
+
+    @classmethod
+    def get_movement_transform(cls, translation, rotation):
+        """
+        Composes the translation and the rotations around X, Y and Z (in this order) into a single transform:
+        position -> matrix.position + offset, vectors -> matrix.vector
+
+        :param translation: [x, y, z] translation (workspace units)
+        :param rotation: [x, y, z] rotation angles (radians)
+        :return: matrix (3x3), offset (3)
+        """
+        matrix = numpy.identity(3)
+
+        for axis, theta in enumerate(rotation):
+            if theta != 0.0:
+                costh = numpy.cos(theta)
+                sinth = numpy.sin(theta)
+
+                i, j = [index for index in range(3) if index != axis]
+
+                rotation_matrix = numpy.identity(3)
+                rotation_matrix[i, i] = costh
+                rotation_matrix[i, j] = sinth
+                rotation_matrix[j, i] = -sinth
+                rotation_matrix[j, j] = costh
+
+                matrix = numpy.dot(rotation_matrix, matrix)
+
+        return matrix, numpy.dot(matrix, numpy.array(translation, dtype=float))
+
+    @classmethod
+    def apply_movement_transform(cls, rays, matrix, offset):
+        """
+        Moves the rays in place: position (cols 1-3), direction (4-6), Es (7-9) and Ep (16-18)
+        """
+        if not numpy.array_equal(matrix, numpy.identity(3)):
+            # position, direction and Es are adjacent columns: the reshape is a view, multiplied in place with Ep
+            for vectors in [rays[:, 0:9].reshape((rays.shape[0], 3, 3)), rays[:, 15:18]]:
+                numpy.matmul(vectors, matrix.T, out=vectors)
+
+        if numpy.any(offset != 0.0): rays[:, 0:3] += offset
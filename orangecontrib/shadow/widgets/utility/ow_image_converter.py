@@ -1,4 +1,6 @@
+import os
 import numpy
+import h5py
 from oasys.widgets import widget
 from oasys.widgets import gui as oasysgui
 
@@ -48,8 +50,11 @@ class ImageToBeamConverter(widget.OWWidget):
     number_of_rays = Setting(50000)
     number_of_x_bins = Setting(10)
     number_of_z_bins = Setting(5)
+    stack_frame_index = Setting(0)
 
     image_nparray = None
+    image_stack = None
+    number_of_frames = 0
 
     input_beam = None
 
@@ -57,6 +62,8 @@ class ImageToBeamConverter(widget.OWWidget):
         self.setFixedWidth(700)
         self.setFixedHeight(600)
 
+        self.image_operations = []
+
 
         left_box_1 = oasysgui.widgetBox(self.controlArea, "CCD Image", addSpace=True, orientation="vertical")
 
@@ -77,6 +84,15 @@ class ImageToBeamConverter(widget.OWWidget):
 
         self.preview_box.setKeepDataAspectRatio(True)
 
+        #########################################  image stack
+        self.stack_box = oasysgui.widgetBox(left_box_1, "", addSpace=True, orientation="horizontal")
+        oasysgui.lineEdit(self.stack_box, self, "stack_frame_index", "Stack Frame", labelWidth=100, valueType=int, orientation="horizontal")
+        self.le_number_of_frames = oasysgui.lineEdit(self.stack_box, self, "number_of_frames", "of", labelWidth=20, valueType=int, orientation="horizontal")
+        self.le_number_of_frames.setReadOnly(True)
+        gui.button(self.stack_box, self, "Load Frame", callback=self.loadStackFrame)
+        gui.button(self.stack_box, self, "Convert All Frames To Beams", callback=self.convertStackToBeams)
+        self.stack_box.setVisible(False)
+
         #########################################  image operations
         operations_box = oasysgui.widgetBox(left_box_1, "", addSpace=True, orientation="horizontal")
         gui.button(operations_box, self, "Flip Vertically",callback=self.flip_v)
@@ -100,6 +116,11 @@ class ImageToBeamConverter(widget.OWWidget):
         if self.image_file_name != "":
             self.loadFileToNumpyArray()
 
+    def onDeleteWidget(self):
+        self.closeImageStack()
+
+        super().onDeleteWidget()
+
 
     def setBeam(self, input_beam):
         if ShadowCongruence.checkEmptyBeam(input_beam):
@@ -114,7 +135,7 @@ class ImageToBeamConverter(widget.OWWidget):
 
     def selectFile(self):
         self.image_file_name = oasysgui.selectFileFromDialog(self, self.image_file_name, "Open Image",
-                                file_extension_filter="(*.png *.jpg *.jpeg *csv)")
+                                file_extension_filter="(*.png *.jpg *.jpeg *csv *.edf *.h5 *.hdf5)")
         self.loadFileToNumpyArray()
 
     def preview(self):
@@ -131,8 +152,20 @@ class ImageToBeamConverter(widget.OWWidget):
             return False
 
     def loadFileToNumpyArray(self):
+        self.closeImageStack()
+        self.image_operations = []
 
-        if self.is_remote():
+        if not self.is_remote() and ImageStack.is_stack_file(self.image_file_name):
+            try:
+                self.image_stack = ImageStack(self.image_file_name)
+                self.number_of_frames = self.image_stack.get_number_of_frames()
+                self.stack_frame_index = min(max(0, self.stack_frame_index), self.number_of_frames - 1)
+                self.image_nparray = self.getStackFrame(self.stack_frame_index)
+            except Exception as exception:
+                self.closeImageStack()
+                QMessageBox.information(self, "QMessageBox.information()",
+                        "Impossible to load image stack %s:\n%s"%(self.image_file_name, str(exception)), QMessageBox.Ok)
+        elif self.is_remote():
             try:
                 response = requests.get(self.image_file_name)
                 img = Image.open(BytesIO(response.content))
@@ -153,25 +186,86 @@ class ImageToBeamConverter(widget.OWWidget):
                     self.image_nparray = numpy.loadtxt(self.image_file_name,delimiter=",")
                 except:
                     QMessageBox.information(self, "QMessageBox.information()",
-                            "Impossible to load file %s. Use jpg, png or csv file"%self.image_file_name,QMessageBox.Ok)
+                            "Impossible to load file %s. Use jpg, png, csv, edf or hdf5 file"%self.image_file_name,QMessageBox.Ok)
+
+        self.stack_box.setVisible(not self.image_stack is None)
 
         self.preview()
 
-    def flip_h(self):
-        self.image_nparray = numpy.flip(self.image_nparray,axis=1)
+    ########################################################################
+    # image stacks: the file is kept open and the frames are read one by one
+
+    def closeImageStack(self):
+        if not self.image_stack is None:
+            self.image_stack.close()
+            self.image_stack = None
+
+        self.number_of_frames = 0
+
+    def getStackFrame(self, frame_index):
+        # detector frames are (row, column): same orientation of the images, intensities are not inverted
+        image = numpy.rot90(numpy.array(self.image_stack.get_frame(frame_index), dtype=float), axes=(1, 0))
+
+        for operation in self.image_operations: image = operation(image)
+
+        return image
+
+    def loadStackFrame(self):
+        if self.image_stack is None: return
+
+        if self.stack_frame_index < 0 or self.stack_frame_index >= self.number_of_frames:
+            QMessageBox.critical(self, "Error", "Stack Frame should be between 0 and %d" % (self.number_of_frames - 1), QMessageBox.Ok)
+            return
+
+        self.image_nparray = self.getStackFrame(self.stack_frame_index)
         self.preview()
 
-    def flip_v(self):
-        self.image_nparray = numpy.flip(self.image_nparray,axis=0)
+    def convertStackToBeams(self):
+        if self.image_stack is None: return
+
+        self.progressBarInit()
+
+        try:
+            for frame_index in range(self.number_of_frames):
+                self.setStatusMessage("Converting Frame %d of %d" % (frame_index + 1, self.number_of_frames))
+
+                self.stack_frame_index = frame_index
+                self.image_nparray = self.getStackFrame(frame_index)
+
+                x0s, x1s = self.sample_points()
+
+                self.send("Beam", self.convertMapToBeam(x0s, x1s))
+
+                self.progressBarSet(100 * (frame_index + 1) / self.number_of_frames)
+                QApplication.processEvents()
+
+            self.preview()
+        except Exception as exception:
+            QMessageBox.critical(self, "Error", str(exception), QMessageBox.Ok)
+
+        self.setStatusMessage("")
+        self.progressBarFinished()
+
+    ########################################################################
+
+    def addImageOperation(self, operation):
+        # kept to be applied to all the frames of a stack
+        self.image_operations.append(operation)
+
+        self.image_nparray = operation(self.image_nparray)
         self.preview()
 
+    def flip_h(self):
+        self.addImageOperation(lambda image: numpy.flip(image, axis=1))
+
+    def flip_v(self):
+        self.addImageOperation(lambda image: numpy.flip(image, axis=0))
+
     def rot_cw(self):
-        self.image_nparray = numpy.rot90(self.image_nparray,axes=(1,0))
-        self.preview()
+        self.addImageOperation(lambda image: numpy.rot90(image, axes=(1,0)))
 
     def rot_ccw(self):
-        self.image_nparray = numpy.rot90(self.image_nparray,axes=(0,1))
-        self.preview()
+        self.addImageOperation(lambda image: numpy.rot90(image, axes=(0,1)))
 
 
     def sample_points(self):
@@ -179,15 +273,57 @@ class ImageToBeamConverter(widget.OWWidget):
             x0 = numpy.arange(self.image_nparray.shape[0])
             x1 = numpy.arange(self.image_nparray.shape[1])
 
-            s2d = Sampler2D(self.image_nparray, x0, x1)
-            x0s, x1s = s2d.get_n_sampled_points(self.number_of_rays)
+            cdf2, cdf1 = Sampler2D(self.image_nparray, x0, x1).cdf()
 
-            return x0s, x1s
+            random0 = numpy.random.random(self.number_of_rays)
+            random1 = numpy.random.random(self.number_of_rays)
+
+            return self.get_sampled_points(cdf2, cdf1, x0, x1, random0, random1)
 
         except:
             QMessageBox.information(self, "QMessageBox.information()",
                         "Cannot sample points from data type: %s"%type(self.image_nparray))
 
+    @classmethod
+    def get_sampled_points(cls, cdf2, cdf1, x0, x1, random0, random1):
+        """
+        Same result of Sampler2D.get_sampled(), with all the points at once: the intervals of the cdfs
+        are found by binary search instead of a scan per point.
+        """
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            index0, delta0 = cls.__get_deltas(cdf1, numpy.searchsorted(cdf1, random0, side="left"), random0)
+
+            # all the rows of the conditional cdf in one sorted array: row i is shifted by 2*i, empty (nan) rows
+            # are pushed above the edges of their row, so that no point falls in them (as in Sampler2D)
+            rows = index0 + 1
+            offsets = 2.0*numpy.arange(cdf2.shape[0])
+            flat_cdf2 = (numpy.where(numpy.isnan(cdf2), 1.5, cdf2) + offsets[:, numpy.newaxis]).ravel()
+
+            index1 = numpy.searchsorted(flat_cdf2, random1 + offsets[rows], side="left") - rows*cdf2.shape[1]
+            index1, delta1 = cls.__get_deltas(cdf2[rows], index1, random1)
+
+        return x0[index0] + delta0*(x0[1] - x0[0]), x1[index1] + delta1*(x1[1] - x1[0])
+
+    @classmethod
+    def __get_deltas(cls, cdfs, index, edges):
+        size = cdfs.shape[-1]
+
+        index[index >= size] = 0 # edge not found
+        index[index > 0] -= 1
+
+        last = index == size - 1
+        next_index = numpy.where(last, index, index + 1)
+
+        if cdfs.ndim == 1:
+            lower, upper = cdfs[index], cdfs[next_index]
+        else:
+            rows = numpy.arange(cdfs.shape[0])
+            lower, upper = cdfs[rows, index], cdfs[rows, next_index]
+
+        delta = numpy.where(last, 0.0, (edges - lower) / (upper - lower))
+
+        return index, delta
+
     def convertToBeam(self):
 
         x0s, x1s = self.sample_points()
@@ -220,6 +356,7 @@ class ImageToBeamConverter(widget.OWWidget):
             beam_out = ShadowBeam(number_of_rays=number_of_rays)
         else:
             beam_out = self.input_beam.duplicate()
+            beam_out.detach_rays()
 
 
         x = x0s - self.image_nparray.shape[0] / 2
@@ -228,31 +365,95 @@ class ImageToBeamConverter(widget.OWWidget):
         x *= self.pixel_size*1e-6 / self.workspace_units_to_m
         z *= self.pixel_size*1e-6 / self.workspace_units_to_m
 
-        for index in range(0, beam_out._beam.nrays()):
-            ray = beam_out._beam.rays[index]
-
-            ray[0]  = x[index]                         # X
-            ray[2]  = z[index]                         # Z
-            if self.input_beam is None:
-                ray[1]  = 0.0                              # Y
-                ray[3]  = 0                                # director cos x
-                ray[4]  = 1                                # director cos y
-                ray[5]  = 0                                # director cos z
-                ray[6]  = 1.0/numpy.sqrt(2)                # Es_x
-                ray[7]  = 0.0                              # Es_y
-                ray[8]  = 0.0                              # Es_z
-                ray[9]  = 1                                # good/lost
-                ray[10] = 2*numpy.pi/1e-8                  # wavenumber
-                ray[11] = index                            # ray index
-                ray[12] = 1                                # good only
-                ray[13] = 0.0                              # Es_phi
-                ray[14] = 0.0                              # Ep_phi
-                ray[15] = 0.0                              # Ep_x
-                ray[16] = 0.0                              # Ep_y
-                ray[17] = 1.0/numpy.sqrt(2)                # Ep_z
+        rays = beam_out._beam.rays
+
+        rays[:, 0]  = x                                # X
+        rays[:, 2]  = z                                # Z
+        if self.input_beam is None:
+            rays[:, 1]  = 0.0                              # Y
+            rays[:, 3]  = 0                                # director cos x
+            rays[:, 4]  = 1                                # director cos y
+            rays[:, 5]  = 0                                # director cos z
+            rays[:, 6]  = 1.0/numpy.sqrt(2)                # Es_x
+            rays[:, 7]  = 0.0                              # Es_y
+            rays[:, 8]  = 0.0                              # Es_z
+            rays[:, 9]  = 1                                # good/lost
+            rays[:, 10] = 2*numpy.pi/1e-8                  # wavenumber
+            rays[:, 11] = numpy.arange(number_of_rays)     # ray index
+            rays[:, 12] = 1                                # good only
+            rays[:, 13] = 0.0                              # Es_phi
+            rays[:, 14] = 0.0                              # Ep_phi
+            rays[:, 15] = 0.0                              # Ep_x
+            rays[:, 16] = 0.0                              # Ep_y
+            rays[:, 17] = 1.0/numpy.sqrt(2)                # Ep_z
 
         return beam_out
 
+class ImageStack(object):
+    """
+    Frames of an EDF or HDF5 file, read one at a time while the file stays open
+    """
+    EDF_EXTENSIONS = [".edf"]
+    HDF5_EXTENSIONS = [".h5", ".hdf5", ".hdf", ".nxs"]
+
+    def __init__(self, file_name):
+        extension = os.path.splitext(file_name)[1].lower()
+
+        if extension in self.EDF_EXTENSIONS:
+            import fabio
+
+            self.__edf_file = fabio.open(file_name)
+            self.__hdf5_file = None
+            self.__number_of_frames = self.__edf_file.nframes
+        else:
+            self.__edf_file = None
+            self.__hdf5_file = h5py.File(file_name, "r")
+            self.__dataset = self.__find_image_dataset(self.__hdf5_file)
+
+            if self.__dataset is None:
+                self.close()
+                raise ValueError("No 2D or 3D dataset found in file %s" % file_name)
+
+            self.__number_of_frames = 1 if self.__dataset.ndim == 2 else self.__dataset.shape[0]
+
+    @classmethod
+    def is_stack_file(cls, file_name):
+        return os.path.splitext(file_name)[1].lower() in cls.EDF_EXTENSIONS + cls.HDF5_EXTENSIONS
+
+    def get_number_of_frames(self):
+        return self.__number_of_frames
+
+    def get_frame(self, frame_index):
+        if frame_index < 0 or frame_index >= self.__number_of_frames: raise IndexError("Frame %d out of range" % frame_index)
+
+        if not self.__edf_file is None:
+            return self.__edf_file.get_frame(frame_index).data
+        elif self.__dataset.ndim == 2:
+            return self.__dataset[()]
+        else:
+            return self.__dataset[frame_index]
+
+    def close(self):
+        if not self.__edf_file is None: self.__edf_file.close()
+        if not self.__hdf5_file is None: self.__hdf5_file.close()
+
+        self.__edf_file = None
+        self.__hdf5_file = None
+
+    @classmethod
+    def __find_image_dataset(cls, group):
+        # the first 2D or 3D dataset, depth first
+        for name in group:
+            item = group[name]
+
+            if isinstance(item, h5py.Dataset):
+                if item.ndim in (2, 3): return item
+            elif isinstance(item, h5py.Group):
+                dataset = cls.__find_image_dataset(item)
+                if not dataset is None: return dataset
+
+        return None
+
 
 if __name__ == "__main__":
     from PyQt5.QtWidgets import QApplication
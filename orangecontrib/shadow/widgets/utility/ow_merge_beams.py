@@ -1,4 +1,4 @@
-import sys, numpy
+import sys
 from PyQt5 import QtWidgets
 from PyQt5.QtWidgets import QApplication
 from PyQt5.QtGui import QPalette, QColor, QFont
@@ -270,28 +270,23 @@ class MergeBeams(OWWidget):
 
     def merge_beams(self):
         try:
-            merged_beam = None
+            beams   = []
+            weights = []
 
             for index in range(1, 11):
                 current_beam = getattr(self, "input_beam" + str(index))
                 if not current_beam is None:
-                    current_beam = current_beam.duplicate()
-
                     if self.use_weights == 1:
                         weight = getattr(self, "weight_input_beam" + str(index))
                         if not (0.0 <= weight <= 1): raise ValueError(f"Weight #{index} is not in [0, 1]")
+                    else:
+                        weight = 1.0
 
-                        electric_field_factor = numpy.sqrt(weight)
-
-                        current_beam._beam.rays[:, 6]  *= electric_field_factor
-                        current_beam._beam.rays[:, 7]  *= electric_field_factor
-                        current_beam._beam.rays[:, 8]  *= electric_field_factor
-                        current_beam._beam.rays[:, 15] *= electric_field_factor
-                        current_beam._beam.rays[:, 16] *= electric_field_factor
-                        current_beam._beam.rays[:, 17] *= electric_field_factor
+                    beams.append(current_beam)
+                    weights.append(weight)
 
-                    if    merged_beam is None: merged_beam = current_beam
-                    else: merged_beam = ShadowBeam.mergeBeams(merged_beam, current_beam, which_flux=3, merge_history=0)
+            # one allocation for all the rays, weights applied while copying
+            merged_beam = None if len(beams) == 0 else ShadowBeam.mergeBeamsList(beams, weights=weights, which_flux=3, merge_history=0)
 
             self.send("Beam", merged_beam)
         except Exception as e:
@@ -8,7 +8,7 @@ from orangewidget.settings import Setting
 from oasys.widgets import gui as oasysgui
 from oasys.util.oasys_util import TriggerIn
 
-from orangecontrib.shadow.util.shadow_objects import ShadowOpticalElement, ShadowBeam
+from orangecontrib.shadow.util.shadow_objects import ShadowBeam
 from orangecontrib.shadow.util.shadow_util import ShadowCongruence
 from orangecontrib.shadow.widgets.gui.ow_generic_element import GenericElement
 
@@ -82,22 +82,7 @@ class OWRetracer(GenericElement):
     def retrace(self):
         try:
             if not self.input_beam is None:
-                output_beam = self.input_beam.duplicate(history=True)
-
-                empty_element = ShadowOpticalElement.create_empty_oe()
-
-                empty_element._oe.DUMMY = 1.0 # self.workspace_units_to_cm
-
-                empty_element._oe.T_SOURCE     = 0.0
-                empty_element._oe.T_IMAGE      = self.retrace_distance
-                empty_element._oe.T_INCIDENCE  = 0.0
-                empty_element._oe.T_REFLECTION = 180.0
-                empty_element._oe.ALPHA        = 0.0
-
-                empty_element._oe.FWRITE = 3
-                empty_element._oe.F_ANGLE = 0
-
-                output_beam = ShadowBeam.traceFromOE(output_beam, empty_element, history=True)
+                output_beam = ShadowBeam.traceFreeSpace(self.input_beam, self.retrace_distance, history=True)
 
                 self.setStatusMessage("Plotting Results")
 
@@ -0,0 +1,68 @@
+#
+# Tests of the vectorized sampling of the Image To Beam widget against srxraylib Sampler2D
+#
+
+import unittest
+import numpy
+
+from srxraylib.util.inverse_method_sampler import Sampler2D
+
+from orangecontrib.shadow.widgets.utility.ow_image_converter import ImageToBeamConverter
+
+#
+# Auxiliary functions
+#
+
+def _create_image(seed=3):
+    image = numpy.random.default_rng(seed).random((20, 30))
+    image[[3, 7, 8], :] = 0.0 # empty rows: nan in the conditional cdf
+    image[:, 0] = 0.0
+    image[12, 5:] = 0.0
+
+    return image
+
+def _sample(image, random0, random1):
+    x0 = numpy.arange(image.shape[0])
+    x1 = numpy.arange(image.shape[1])
+
+    with numpy.errstate(divide="ignore", invalid="ignore"):
+        sampler = Sampler2D(image, x0, x1)
+        cdf2, cdf1 = sampler.cdf()
+
+        expected = sampler.get_sampled(random0, random1)
+
+    return expected, ImageToBeamConverter.get_sampled_points(cdf2, cdf1, x0, x1, random0.copy(), random1.copy())
+
+#
+# Tests
+#
+
+class TestImageSampling(unittest.TestCase):
+
+    def assertSameSampling(self, image, random0, random1):
+        expected, sampled = _sample(image, random0, random1)
+
+        numpy.testing.assert_array_equal(sampled[0], expected[0])
+        numpy.testing.assert_array_equal(sampled[1], expected[1])
+
+    def test_random_numbers(self):
+        random_generator = numpy.random.default_rng(1234567)
+
+        self.assertSameSampling(_create_image(), random_generator.random(5000), random_generator.random(5000))
+
+    def test_cdf_edges(self):
+        image = _create_image()
+
+        with numpy.errstate(divide="ignore", invalid="ignore"): cdf2, cdf1 = Sampler2D(image).cdf()
+
+        self.assertTrue(numpy.isnan(cdf2).any())
+
+        # 0, 1, the cdf values and their neighbours
+        edges0 = numpy.concatenate([[0.0, 1.0], cdf1, numpy.nextafter(cdf1, 2.0), numpy.nextafter(cdf1, -1.0)])
+        edges0 = edges0[(edges0 >= 0.0) & (edges0 <= 1.0)]
+        edges1 = numpy.concatenate([[0.0, 1.0], cdf2[0], cdf2[12]])
+
+        self.assertSameSampling(image, numpy.repeat(edges0, len(edges1)), numpy.tile(edges1, len(edges0)))
+
+if __name__ == "__main__":
+    unittest.main()